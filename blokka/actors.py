@@ -1,52 +1,486 @@
 #!/usr/bin/env python
 # Author(s): 'Percy Link' <percylink@gmail.com>
-import json
+import itertools
 import logging
-
-import sys
+import threading
+import time
 from collections import Counter
 from datetime import datetime
 
 import pytz
-from pykka import ThreadingActor
+from pykka import ActorDeadError, ThreadingActor, ThreadingFuture, Timeout
 
 from blokka.backends import FileBackend
-from blokka.entities import Block
-
-
-def build_logger(name):
-    handler = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(
-        '%(asctime)-20s - %(name)-10s - %(levelname)-10s - %(message)s'
-    )
-    handler.setFormatter(formatter)
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
-    return logger
+from blokka.bloom import RollingBloomFilter
+from blokka.entities import Block, Chain, validate_blocks
+from blokka.forks import MAX_FORK_DEPTH, BlockTree, block_transactions, longest_chain
+from blokka.ledger import Ledger
+from blokka.logs import RateLimitFilter, build_logger, queue_handler
+from blokka.mempool import Mempool, ORDER_FEE
+from blokka.merkle import merkle_root
+from blokka.metrics import Metrics
+from blokka.mining import Miner
+from blokka.pruning import Snapshot, archive_blocks
+from blokka.verification import VerifiedCache, Verifier, shared_verifier
 
 
 ACCEPTED = 'accepted'
 REJECTED = 'rejected'
 
+# Flush policies: how changes to a node's in-memory chain reach its backend
+FLUSH_SYNC = 'sync'  # save on every change
+FLUSH_DEFERRED = 'deferred'  # save every `flush_every` changes, on flush() and on stop
+
+# Gossip modes: how new transactions reach peers
+GOSSIP_PUSH = 'push'  # send the transactions themselves
+GOSSIP_INVENTORY = 'inventory'  # announce their hashes; peers request the ones they lack
+
 
 class Node(ThreadingActor):
 
     BLOCK_SIZE = 5
     REJECTION_THRESH_FRAC = 0.5
+    # Seconds to wait for each step of sharing the chain with a peer
+    SHARE_TIMEOUT = 5.0
+    # Limits on the pending transactions; the worst are evicted beyond these
+    MEMPOOL_MAX_TRANSACTIONS = 100000
+    MEMPOOL_MAX_BYTES = 32 * 1024 * 1024
+    # Each peer link remembers roughly this many transaction hashes sent or seen
+    PEER_FILTER_CAPACITY = 10000
+    PEER_FILTER_ERROR_RATE = 0.001
+    # Each log message is let through at most LOG_BURST times every LOG_INTERVAL
+    # seconds; the rest are counted and reported with the next one let through
+    LOG_BURST = 20
+    LOG_INTERVAL = 1.0
+    # Hashes of transactions whose signatures checked out, remembered so they are not
+    # checked again
+    VERIFIED_CACHE_SIZE = 100000
 
-    def __init__(self, node_id, backend=None):
+    def __init__(self, node_id, backend=None, flush_policy=FLUSH_SYNC, flush_every=None,
+                 difficulty=None, mining_processes=1, gossip_window=None,
+                 gossip_batch_size=100, gossip_mode=GOSSIP_PUSH, mempool_order=ORDER_FEE,
+                 fork_choice=longest_chain, metrics_path=None, metrics_interval=10.0,
+                 log_level=logging.DEBUG, ledger_path=None, ledger_snapshot_every=100,
+                 require_signatures=False, verify_processes=None, prune_depth=None,
+                 archive_dir=None, snapshot=None):
+        """
+        :type node_id: str
+        :type backend: blokka.backends.ChainBackend
+        :param flush_policy: FLUSH_SYNC or FLUSH_DEFERRED
+        :param flush_every: with FLUSH_DEFERRED, save after this many unsaved changes
+            (None: only on flush() and on stop)
+        :type flush_every: int
+        :param difficulty: proof-of-work difficulty in leading zero bits of a block's
+            hash (None: blocks need no proof of work)
+        :type difficulty: int
+        :param mining_processes: number of processes to search for nonces with
+        :type mining_processes: int
+        :param gossip_window: seconds to collect new transactions for before forwarding
+            them to peers as one batch (None: forward each call's new transactions
+            straight away)
+        :type gossip_window: float
+        :param gossip_batch_size: forward collected transactions as soon as there are
+            this many
+        :type gossip_batch_size: int
+        :param gossip_mode: GOSSIP_PUSH or GOSSIP_INVENTORY
+        :param mempool_order: which pending transactions go into blocks first;
+            blokka.mempool.ORDER_FEE or ORDER_AGE
+        :param fork_choice: rule for whether to switch to another branch, such as
+            blokka.forks.longest_chain or most_work
+        :type fork_choice: (list[blokka.entities.Block], list[blokka.entities.Block])
+            -> bool
+        :param metrics_path: file to write metrics to in the Prometheus text format,
+            every `metrics_interval` seconds and on stop (None: only on request, see
+            metrics and write_metrics)
+        :type metrics_path: str
+        :type metrics_interval: float
+        :param log_level: level of the node's logger; messages logged per transaction
+            or block are rate limited, see LOG_BURST
+        :type log_level: int
+        :param ledger_path: file to snapshot the ledger of account balances to, every
+            `ledger_snapshot_every` blocks applied or rolled back, at the next flush so
+            it follows the chain on the backend, and on stop; a snapshot found there on
+            start saves replaying the chain (None: the ledger is only built when first
+            asked for, and not saved)
+        :type ledger_path: str
+        :type ledger_snapshot_every: int
+        :param require_signatures: drop unsigned transactions, and reject blocks with
+            any; signed transactions are verified either way
+        :type require_signatures: bool
+        :param verify_processes: number of processes to verify signatures with, in a
+            pool of this node's own (default: share the process's pool, see
+            blokka.verification.shared_verifier)
+        :type verify_processes: int
+        :param prune_depth: once the chain has twice this many whole blocks, prune all
+            but the last `prune_depth` (see prune; None: never prune by itself). Needs
+            a ledger_path.
+        :type prune_depth: int
+        :param archive_dir: directory to archive blocks to before they are pruned
+            (None: they are dropped)
+        :type archive_dir: str
+        :param snapshot: a snapshot to start from if the backend has no chain for this
+            node, such as another node's (see snapshot)
+        :type snapshot: blokka.pruning.Snapshot
+        """
         super(Node, self).__init__()
         self.node_id = node_id
         self.peer_proxies = []
+        self._peer_ids = []
         self.chain_backend = backend or FileBackend()
-        self.pending_transactions = {}
+        self.pending_transactions = Mempool(
+            max_transactions=self.MEMPOOL_MAX_TRANSACTIONS,
+            max_bytes=self.MEMPOOL_MAX_BYTES, order=mempool_order)
+        self.flush_policy = flush_policy
+        self.flush_every = flush_every
+        self.difficulty = difficulty
+        self.miner = None
+        if difficulty is not None:
+            self.miner = Miner(difficulty, mining_processes)
+        self.last_mining_result = None
+        self.require_signatures = require_signatures
+        self._own_verifier = verify_processes is not None
+        self.verifier = Verifier(verify_processes) if self._own_verifier else \
+            shared_verifier()
+        self._verified = VerifiedCache(self.VERIFIED_CACHE_SIZE)
+        # Hashes of transactions handed to the verifier and not answered yet
+        self._verifying = set()
+        self.mining_job = None
+        self.fork_choice = fork_choice
+        self.block_tree = BlockTree()
+        self.gossip_window = gossip_window
+        self.gossip_batch_size = gossip_batch_size
+        self.gossip_mode = gossip_mode
+        self._gossip_buffer = []
+        self._gossip_timer = None
+        # Per peer link: hashes of transactions sent to or seen from that peer
+        self._link_filters = {}
+        # Hashes requested from peers and not received yet
+        self._requested = set()
+        self._share_rounds = {}
+        self._share_round_ids = itertools.count(1)
+        self._proxy = None
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self._metrics_timer = None
+        self._init_metrics()
+
+        self.logger = build_logger(
+            ':'.join([self.__class__.__name__, self.node_id]), level=log_level,
+            rate_limit=RateLimitFilter(self.LOG_BURST, self.LOG_INTERVAL))
+
+        # The in-memory chain is authoritative; the backend is only read once, here
+        with self._backend_load_seconds.time():
+            chain = self.chain_backend.load_chain(self.node_id)
+        self._unsaved_changes = 0
+        self._ledger = None
+        if chain is None and snapshot is not None:
+            snapshot.validate(difficulty)
+            chain = snapshot.chain
+            self._ledger = snapshot.ledger
+            self._unsaved_changes = 1
+        self._chain = chain or Chain(blocks=[])
+        self._pruned_height = self._chain.pruned_height
 
-        self.logger = build_logger(':'.join([self.__class__.__name__, self.node_id]))
+        self.ledger_path = ledger_path
+        self.ledger_snapshot_every = ledger_snapshot_every
+        self._ledger_changes = 0
+        if self._ledger is None and ledger_path is not None:
+            self._ledger = Ledger.for_chain(self._chain, Ledger.load(ledger_path))
+        if self._ledger is None and self._pruned_height:
+            raise ValueError('A pruned chain needs its ledger: give a ledger_path')
+        self.prune_depth = prune_depth
+        self.archive_dir = archive_dir
+        if prune_depth is not None and ledger_path is None:
+            raise ValueError('Pruning needs a ledger_path to keep the state in')
+        if self._unsaved_changes:
+            # Started from a snapshot
+            self.flush()
+            if ledger_path is not None:
+                self.save_ledger()
+
+    def _init_metrics(self):
+        m = self._metrics = Metrics(labels={'node': self.node_id})
+        self._transactions_received = m.counter(
+            'transactions_received_total', 'Transactions received, including duplicates')
+        self._transactions_duplicate = m.counter(
+            'transactions_duplicate_total',
+            'Transactions received that were already pending or confirmed')
+        self._transactions_invalid = m.counter(
+            'transactions_invalid_total',
+            'Transactions dropped for an invalid signature, or for none when required')
+        self._signatures_verified = m.counter(
+            'signatures_verified_total', 'Transaction signatures checked')
+        self._signature_cache_hits = m.counter(
+            'signature_cache_hits_total',
+            'Signed transactions not checked again because they were before')
+        self._blocks_mined = m.counter('blocks_mined_total', 'Blocks mined by this node')
+        self._blocks_accepted = m.counter(
+            'blocks_accepted_total', 'Blocks received from peers and added to the chain')
+        self._blocks_rejected = m.counter(
+            'blocks_rejected_total', 'Blocks received from peers and not added')
+        self._backend_load_seconds = m.histogram(
+            'backend_load_seconds', 'Time to load the chain from the backend')
+        self._backend_save_seconds = m.histogram(
+            'backend_save_seconds', 'Time to save the chain to the backend')
+        self._share_chain_seconds = m.histogram(
+            'share_chain_rtt_seconds', 'Time for a peer to answer a shared chain')
+        self._share_chain_unanswered = m.counter(
+            'share_chain_unanswered_total',
+            'Peers that did not answer a shared chain in time, or before it changed')
+        m.gauge('mailbox_depth', 'Messages waiting in the actor\'s inbox',
+                lambda: self.actor_inbox.qsize())
+        m.gauge('mempool_transactions', 'Pending transactions',
+                lambda: len(self.pending_transactions))
+        m.gauge('mempool_bytes', 'Size of the pending transactions, encoded',
+                lambda: self.pending_transactions.nbytes)
+        m.counter('mempool_evicted_total',
+                  'Pending transactions evicted to stay in bounds',
+                  lambda: self.pending_transactions.evicted)
+        m.gauge('chain_length', 'Blocks in the chain', lambda: self._chain.length)
+        m.gauge('chain_pruned_height', 'Blocks in the chain kept as headers only',
+                lambda: self._pruned_height)
+        m.counter('log_records_dropped_total',
+                  'Log records dropped because the log queue was full, in this process',
+                  lambda: queue_handler().dropped)
 
     @property
     def chain(self):
-        return self.chain_backend.load_chain(self.node_id)
+        """
+        :rtype: blokka.entities.Chain
+        """
+        return self._chain
+
+    @property
+    def ledger(self):
+        """
+        Account balances as of the tip of the chain, kept up to date as blocks are
+        added and rolled back
+        :rtype: blokka.ledger.Ledger
+        """
+        if self._ledger is None:
+            self._ledger = Ledger.for_chain(self._chain)
+        return self._ledger
+
+    def balance(self, account):
+        """
+        :type account: str
+        :rtype: float
+        """
+        return self.ledger.balance(account)
+
+    def account_history(self, account, since=0):
+        """
+        :type account: str
+        :param since: leave out blocks below this height
+        :type since: int
+        :return: see blokka.ledger.Ledger.history
+        :rtype: list[(int, str, float)]
+        """
+        return self.ledger.history(account, since)
+
+    def save_ledger(self):
+        """
+        Snapshot the ledger to ledger_path
+        """
+        self.ledger.save(self.ledger_path)
+        self._ledger_changes = 0
+
+    def prune(self, height):
+        """
+        Checkpoint the state at `height`: keep only the headers of the blocks below it,
+        archiving them to archive_dir first if it is set. The chain is flushed first,
+        so that the ledger saved to ledger_path follows it on disk. The ledger keeps
+        the balances the pruned blocks add up to, but forgets their history. Then the
+        chain is saved again, and the backend drops the blocks' data too. Forks from
+        below `height` are rejected from then on.
+        :type height: int
+        """
+        if self.ledger_path is None:
+            raise ValueError('Pruning needs a ledger_path to keep the state in')
+        start = self._pruned_height
+        if height <= start:
+            return
+        self.flush()
+        # Built from the whole blocks, while there still are any
+        ledger = self.ledger
+        pruned = self.chain.prune(height)
+        if self.archive_dir is not None:
+            archive_blocks(self.archive_dir, self.node_id, start, pruned)
+        self._pruned_height = height
+        ledger.forget(height)
+        # The state goes to disk before the blocks it was built from leave it
+        self.save_ledger()
+        self._unsaved_changes += 1
+        self.flush()
+        self.chain_backend.prune(self.node_id, height)
+        self.logger.debug('pruned blocks from height %d to %d', start, height)
+
+    def snapshot(self, recent_blocks=MAX_FORK_DEPTH):
+        """
+        :param recent_blocks: number of blocks at the tip to include whole; the rest
+            are headers only
+        :type recent_blocks: int
+        :return: a pruned copy of the chain with the ledger as of its tip, for a new
+            node to start from
+        :rtype: blokka.pruning.Snapshot
+        """
+        height = max(self.chain.length - recent_blocks, self._pruned_height)
+        chain = Chain(blocks=[self.chain.blocks[h] for h in xrange(self.chain.length)])
+        chain.prune(height)
+        ledger = Ledger.from_dict(self.ledger.to_dict())
+        ledger.forget(height)
+        return Snapshot(chain, ledger)
+
+    def _update_ledger(self, reverted, applied):
+        """
+        :param reverted: blocks rolled back from the tip, in chain order
+        :type reverted: list[blokka.entities.Block]
+        :param applied: blocks added after them
+        :type applied: list[blokka.entities.Block]
+        """
+        if self._ledger is None:
+            return
+        for block in reversed(reverted):
+            self._ledger.revert_block(block)
+        for block in applied:
+            self._ledger.apply_block(block)
+        # The snapshot waits for flush: ahead of the chain on disk, a restart could
+        # not use it
+        self._ledger_changes += len(reverted) + len(applied)
+
+    def on_start(self):
+        self._proxy = self.actor_ref.proxy()
+        if self.metrics_path is not None:
+            self._schedule_metrics()
+
+    def on_stop(self):
+        if self._gossip_timer is not None:
+            self._gossip_timer.cancel()
+        if self._metrics_timer is not None:
+            self._metrics_timer.cancel()
+        self._cancel_mining()
+        if self.miner is not None:
+            self.miner.close()
+        if self._own_verifier:
+            self.verifier.close()
+        self.flush()
+        if self.ledger_path is not None:
+            self.save_ledger()
+        if self.metrics_path is not None:
+            self.write_metrics()
+
+    def metrics(self):
+        """
+        :return: the current value of each metric, by name; see blokka.metrics
+        :rtype: dict
+        """
+        return self._metrics.snapshot()
+
+    def write_metrics(self, path=None):
+        """
+        Write the metrics in the Prometheus text format
+        :param path: default: metrics_path
+        :type path: str
+        """
+        self._metrics.write_prometheus(path or self.metrics_path)
+
+    def _schedule_metrics(self):
+        self._metrics_timer = self._call_later(
+            self.metrics_interval, self._write_metrics_due)
+
+    def _write_metrics_due(self):
+        """
+        Runs on the timer's thread: have the actor write its metrics, then schedule the
+        next write
+        """
+        try:
+            self._proxy.write_metrics()
+        except ActorDeadError:
+            return
+        self._schedule_metrics()
+
+    # Everything a node does off its own actor thread, and every reading of the clock,
+    # goes through these, so another runtime (such as blokka.simulation) can run the
+    # same node logic by overriding them
+
+    def _clock(self):
+        """
+        :return: seconds since the epoch
+        :rtype: float
+        """
+        return time.time()
+
+    def _utcnow(self):
+        """
+        :return: the current time, for timestamping blocks
+        :rtype: datetime.datetime
+        """
+        return pytz.UTC.localize(datetime.utcnow())
+
+    def _call_later(self, delay, func):
+        """
+        Call `func` with no arguments after `delay` seconds, from another thread
+        :type delay: float
+        :return: a handle whose cancel() stops the call if it has not happened yet
+        :rtype: threading.Timer
+        """
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _future(self):
+        """
+        :return: a future for an answer this node gives later, from its own thread
+        :rtype: pykka.ThreadingFuture
+        """
+        return ThreadingFuture()
+
+    def _tell(self, name, *args):
+        """
+        Call one of this node's methods from another thread, such as the verifier's,
+        without waiting for the answer or for room in the mailbox
+        :type name: str
+        """
+        getattr(self._proxy, name)(*args)
+
+    def _run_task(self, task):
+        """
+        Run a task outside the actor, in a thread of its own. A task is a generator that
+        yields futures; each time, it is resumed with the future's value, or has the
+        error raised into it that waiting SHARE_TIMEOUT seconds for the value raised,
+        such as pykka.Timeout.
+        :type task: generator
+        """
+        thread = threading.Thread(target=_drive_task, args=(task, self.SHARE_TIMEOUT))
+        thread.daemon = True
+        thread.start()
+
+    def flush(self):
+        """
+        Save the in-memory chain to the backend if it has unsaved changes, then snapshot
+        the ledger to ledger_path if ledger_snapshot_every blocks have changed it
+        """
+        if self._unsaved_changes:
+            with self._backend_save_seconds.time():
+                self.chain_backend.save_chain(self._chain, self.node_id)
+            self._unsaved_changes = 0
+        if (self.ledger_path is not None and
+                self._ledger_changes >= self.ledger_snapshot_every):
+            self.save_ledger()
+
+    def _chain_changed(self):
+        """
+        Record a change to the in-memory chain, prune it if it has grown by prune_depth
+        since it last was, and write it through according to the flush policy
+        """
+        self._unsaved_changes += 1
+        if (self.prune_depth is not None and
+                self.chain.length - self._pruned_height >= 2 * self.prune_depth):
+            self.prune(self.chain.length - self.prune_depth)
+        if self.flush_policy == FLUSH_SYNC or (
+                self.flush_every is not None and self._unsaved_changes >= self.flush_every):
+            self.flush()
 
     def register_peer(self, peer_proxy):
         """
@@ -54,25 +488,114 @@ class Node(ThreadingActor):
         :type peer_proxy:
         :rtype:
         """
-        self.logger.debug('registering peer: {}'.format(peer_proxy.node_id.get()))
+        self._add_peer(peer_proxy, peer_proxy.node_id.get())
+
+    def _add_peer(self, peer_proxy, peer_id):
+        """
+        :param peer_id: the peer's node_id
+        :type peer_id: str
+        """
+        self.logger.debug('registering peer: %s', peer_id)
         self.peer_proxies.append(peer_proxy)
+        self._peer_ids.append(peer_id)
+
+    def _link_filter(self, peer_id):
+        """
+        :type peer_id: str
+        :rtype: blokka.bloom.RollingBloomFilter
+        """
+        if peer_id not in self._link_filters:
+            self._link_filters[peer_id] = RollingBloomFilter(
+                self.PEER_FILTER_CAPACITY, self.PEER_FILTER_ERROR_RATE)
+        return self._link_filters[peer_id]
 
     def register_transaction(self, transaction):
         """
         :type transaction: blokka.entities.Transaction
         """
-        # First check if it's already in the dict - if not, add to pending transactions
-        # and share with peers
-        if transaction.hash not in self.pending_transactions:
-            self.logger.debug('adding transaction {} to pending transactions'
-                              .format(transaction.to_dict()))
-            self.pending_transactions[transaction.hash] = transaction
-            self.share_transaction(transaction)
-        else:
-            self.logger.debug('transaction {} already in pending transactions'
-                              .format(transaction.to_dict()))
+        self.register_transactions([transaction])
+
+    def register_transactions(self, batch, sender_id=None, requested=()):
+        """
+        :type batch: list[blokka.entities.Transaction]
+        :param sender_id: the peer the transactions came from, if any; they are not
+            gossiped back to it
+        :type sender_id: str
+        :param requested: hashes this node asked the sender for, answered by this batch
+        :type requested: list[str]
+        """
+        self._requested.difference_update(requested)
+        if sender_id is not None:
+            self._link_filter(sender_id).update(t.hash for t in batch)
+        self._transactions_received.inc(len(batch))
+        # Signatures not checked before are checked on the verifier's pool; those
+        # transactions are added when it answers, in transactions_verified
+        ready = []
+        unverified = []
+        for transaction in batch:
+            if transaction.signature is None:
+                if self.require_signatures:
+                    self._transactions_invalid.inc()
+                else:
+                    ready.append(transaction)
+            elif transaction.hash in self._verifying:
+                self._transactions_duplicate.inc()
+            elif transaction.hash in self._verified:
+                self._signature_cache_hits.inc()
+                ready.append(transaction)
+            elif self.pending_transactions.knows(transaction.hash):
+                ready.append(transaction)
+            else:
+                unverified.append(transaction)
+        if unverified:
+            self._verifying.update(t.hash for t in unverified)
+            self.verifier.verify_async(
+                unverified,
+                lambda results: self._tell('transactions_verified', unverified, results))
+        self._add_transactions(ready)
+
+    def transactions_verified(self, transactions, results):
+        """
+        Called by the verifier with the outcome of checking transactions' signatures
+        :type transactions: list[blokka.entities.Transaction]
+        :param results: whether each transaction's signature is valid
+        :type results: list[bool]
+        """
+        self._verifying.difference_update(t.hash for t in transactions)
+        self._signatures_verified.inc(len(transactions))
+        valid = []
+        for transaction, ok in zip(transactions, results):
+            if ok:
+                self._verified.add(transaction.hash)
+                valid.append(transaction)
+            else:
+                self._transactions_invalid.inc()
+                self.logger.warning('dropping transaction %s: invalid signature',
+                                    transaction.hash)
+        self._add_transactions(valid)
+
+    def _add_transactions(self, batch):
+        """
+        Add each to pending transactions, unless already known or not worth keeping,
+        share the ones added with peers, and mine a block if it's time
+        :type batch: list[blokka.entities.Transaction]
+        """
+        new = []
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for transaction in batch:
+            if self.pending_transactions.knows(transaction.hash):
+                self._transactions_duplicate.inc()
+            if self.pending_transactions.add(transaction):
+                if debug:
+                    self.logger.debug('added transaction %s to pending transactions',
+                                      transaction.hash)
+                new.append(transaction)
+            elif debug:
+                self.logger.debug('transaction %s not added to pending transactions',
+                                  transaction.hash)
+        if new:
+            self.share_transactions(new)
 
-        # Mine a block, if it's time
         if self.should_mine():
             self.mine_block()
 
@@ -80,8 +603,72 @@ class Node(ThreadingActor):
         """
         :type transaction: blokka.entities.Transaction
         """
-        for peer in self.peer_proxies:
-            peer.register_transaction(transaction)
+        self.share_transactions([transaction])
+
+    def share_transactions(self, batch):
+        """
+        Queue transactions to be forwarded to peers; they go out once gossip_window has
+        passed or gossip_batch_size have been queued, whichever is first
+        :type batch: list[blokka.entities.Transaction]
+        """
+        self._gossip_buffer.extend(batch)
+        if (self.gossip_window is None or
+                len(self._gossip_buffer) >= self.gossip_batch_size):
+            self.flush_gossip()
+        elif self._gossip_timer is None:
+            self._gossip_timer = self._call_later(
+                self.gossip_window, self._proxy.flush_gossip)
+
+    def flush_gossip(self):
+        """
+        Forward all queued transactions to every peer as one batch
+        """
+        if self._gossip_timer is not None:
+            self._gossip_timer.cancel()
+            self._gossip_timer = None
+        if not self._gossip_buffer:
+            return
+        batch, self._gossip_buffer = self._gossip_buffer, []
+        for peer_id, peer in zip(self._peer_ids, self.peer_proxies):
+            # Skip what this link has already carried, in either direction. A false
+            # positive can hold a transaction back from one peer; others still relay it.
+            link = self._link_filter(peer_id)
+            fresh = [t for t in batch if t.hash not in link]
+            if not fresh:
+                continue
+            link.update(t.hash for t in fresh)
+            if self.gossip_mode == GOSSIP_INVENTORY:
+                peer.announce_transactions(
+                    self._proxy, self.node_id, [t.hash for t in fresh])
+            else:
+                peer.register_transactions(fresh, sender_id=self.node_id)
+
+    def announce_transactions(self, sender, sender_id, hashes):
+        """
+        A peer has these transactions; request the ones this node lacks
+        :param sender: proxy for the announcing peer
+        :type sender_id: str
+        :type hashes: list[str]
+        """
+        self._link_filter(sender_id).update(hashes)
+        missing = [h for h in hashes
+                   if not self.pending_transactions.knows(h) and h not in self._requested]
+        if missing:
+            self._requested.update(missing)
+            sender.request_transactions(self._proxy, self.node_id, missing)
+
+    def request_transactions(self, requester, requester_id, hashes):
+        """
+        Send a peer the requested transactions this node still has
+        :param requester: proxy for the requesting peer
+        :type requester_id: str
+        :type hashes: list[str]
+        """
+        self._link_filter(requester_id).update(hashes)
+        transactions = [self.pending_transactions[h] for h in hashes
+                        if h in self.pending_transactions]
+        requester.register_transactions(
+            transactions, sender_id=self.node_id, requested=hashes)
 
     def should_mine(self):
         """
@@ -91,33 +678,388 @@ class Node(ThreadingActor):
         return len(self.pending_transactions) >= self.BLOCK_SIZE
 
     def mine_block(self):
+        """
+        Build a block from the best BLOCK_SIZE pending transactions and add it to the
+        chain; they leave the pending transactions once the block is added. With a
+        proof-of-work difficulty the nonce search runs in the background and the block
+        is added by block_mined; a search already in progress is left to finish.
+        """
+        if self.mining_job is not None and not self.mining_job.done():
+            return
         self.logger.debug('mining now')
-        t = pytz.UTC.localize(datetime.utcnow())
-        data = json.dumps(
-            {k: v.to_dict() for k, v in self.pending_transactions.iteritems()})
+        t = self._utcnow()
+        transactions = self.pending_transactions.best(self.BLOCK_SIZE)
         new_block = Block(
             timestamp=t,
             prev_hash=self.chain.latest_hash(),
-            data=data)
-        self.chain.add_block(new_block)
+            data={tx.hash: tx.to_dict() for tx in transactions},
+            merkle_root=merkle_root(sorted(tx.hash for tx in transactions)))
+        if self.miner is None:
+            self._add_mined_block(new_block)
+        else:
+            self.mining_job = self.miner.mine_async(new_block, self._proxy.block_mined)
+
+    def block_mined(self, result):
+        """
+        Called by the miner when it finds a nonce. A block that no longer extends the
+        tip is dropped, and mining starts again on the tip if there is enough to mine.
+        :type result: blokka.mining.MiningResult
+        """
+        self.last_mining_result = result
+        if result.block.prev_hash != self.chain.latest_hash():
+            self.logger.debug('dropping mined block; the chain has moved on')
+            if self.should_mine():
+                self.mine_block()
+            return
+        self.mining_job = None
+        self.logger.debug('mined block in %.3fs (%d hashes, %.0f hashes/s)',
+                          result.seconds, result.hashes, result.hashes_per_second)
+        self._add_mined_block(result.block)
+
+    def _add_mined_block(self, block):
+        """
+        :type block: blokka.entities.Block
+        """
+        self.chain.add_block(block)
+        self._update_ledger([], [block])
+        self._blocks_mined.inc()
+        self.pending_transactions.remove_confirmed(block.transaction_hashes())
+        self._chain_changed()
         self.share_chain()
 
+    def _cancel_mining(self):
+        """
+        :return: whether a nonce search was running
+        :rtype: bool
+        """
+        if self.mining_job is None:
+            return False
+        self.mining_job.cancel()
+        self.mining_job = None
+        return True
+
+    def _restart_mining(self):
+        """
+        Stop mining a block that no longer extends the tip, and mine on the tip
+        instead if there is enough to mine
+        """
+        if self._cancel_mining() and self.should_mine():
+            self.mine_block()
+
     def share_chain(self):
-        responses = [peer.receive_chain(self.chain) for peer in self.peer_proxies]
-        counts = Counter([r.get() for r in responses])
-        if float(counts[REJECTED]) / len(responses) > self.REJECTION_THRESH_FRAC:
+        """
+        Offer this node's chain to every peer without blocking. Each peer is sent a
+        block locator to find the prefix it shares with this chain, then only the blocks
+        after that prefix, from a task of its own (see _run_task). Responses come back
+        through chain_share_response, which settles the outcome.
+        :return: resolves to ACCEPTED or REJECTED once enough peers have answered; made
+            by _future, so a node on an event loop can wait on it there
+        :rtype: pykka.ThreadingFuture
+        """
+        outcome = self._future()
+        if not self.peer_proxies:
+            outcome.set(ACCEPTED)
+            return outcome
+        share_round = _ShareRound(next(self._share_round_ids), self.chain.latest_hash(),
+                                  len(self.peer_proxies), outcome)
+        self._share_rounds[share_round.round_id] = share_round
+        locator = self.chain.locator()
+        for peer in self.peer_proxies:
+            self._run_task(self._share_with_peer(share_round, peer, locator))
+        return outcome
+
+    def _share_with_peer(self, share_round, peer, locator):
+        """
+        A task (see _run_task): talk to one peer, then report its answer to the actor
+        """
+        started = self._clock()
+        try:
+            height = yield peer.find_common_length(locator)
+            blocks = yield self._proxy.blocks_since(height, share_round.tip_hash)
+            if blocks is None:
+                # The chain has changed since this round started; the peer will hear
+                # about the new one
+                result = None
+            else:
+                result = yield peer.receive_blocks(height, blocks)
+        except (Timeout, ActorDeadError):
+            result = None
+        except Exception as e:
+            # Such as a peer over a socket failing to encode or answer the call
+            self.logger.warning('sharing chain with a peer failed: %s', e)
+            result = None
+        try:
+            self._proxy.chain_share_response(
+                share_round.round_id, result, self._clock() - started)
+        except ActorDeadError:
+            pass
+
+    def blocks_since(self, height, tip_hash):
+        """
+        :type height: int
+        :param tip_hash: the tip the caller expects this node's chain to have
+        :type tip_hash: str
+        :return: the blocks from `height` onwards, or None if the tip has changed. They
+            are decoded here, so a lazily loaded chain is only read by its own node.
+        :rtype: list[blokka.entities.Block]
+        """
+        if self.chain.latest_hash() != tip_hash:
+            return None
+        return list(self.chain.blocks[height:])
+
+    def chain_share_response(self, round_id, result, seconds=None):
+        """
+        Tally one peer's answer to share_chain. The round is settled as soon as enough
+        peers have answered either way that the rest cannot change the outcome; later
+        answers to a settled round are ignored.
+        :type round_id: int
+        :param result: ACCEPTED, REJECTED, or None if the peer did not answer in time
+        :type result: str
+        :param seconds: how long the exchange with the peer took
+        :type seconds: float
+        """
+        if result is None:
+            self._share_chain_unanswered.inc()
+        elif seconds is not None:
+            self._share_chain_seconds.observe(seconds)
+        share_round = self._share_rounds.get(round_id)
+        if share_round is None:
+            self.logger.debug('ignoring late answer to shared chain: %s', result)
+            return
+        share_round.counts[result] += 1
+        peers = share_round.peers
+        rejected = share_round.counts[REJECTED]
+        answered = sum(share_round.counts.values())
+        if float(rejected) / peers > self.REJECTION_THRESH_FRAC:
             # Keep a count of fraction of peers who accept vs reject
             # If rejected by more than allowed fraction, remove the last block
-            self.logger.warning('{} of {} peers rejected my shared chain; removing last '
-                                'block.'.format(counts[REJECTED], len(responses)))
-            self.chain.remove_latest_block()
+            self.logger.warning('%d of %d peers rejected my shared chain; removing last '
+                                'block.', rejected, peers)
+            if (self.chain.latest_hash() == share_round.tip_hash and
+                    self.chain.length > self._pruned_height):
+                self._switch_to(self.chain.length - 1, [])
+                self._restart_mining()
+                self._chain_changed()
+            del self._share_rounds[round_id]
+            share_round.outcome.set(REJECTED)
+        elif float(rejected + peers - answered) / peers <= self.REJECTION_THRESH_FRAC:
+            # Even if every remaining peer rejects, the chain stands
+            del self._share_rounds[round_id]
+            share_round.outcome.set(ACCEPTED)
 
-    def receive_chain(self, chain):
-        if (chain.length > self.chain.length) or (chain == self.chain):
-            self.chain_backend.save_chain(chain, self.node_id)
-            return ACCEPTED
+    def find_common_length(self, locator):
+        """
+        :param locator: a peer's block locator, from Chain.locator
+        :type locator: list[(int, str)]
+        :return: length of the prefix this node's chain shares with the peer's
+        :rtype: int
+        """
+        return self.chain.common_length(locator)
+
+    def receive_blocks(self, height, blocks):
+        """
+        Consider a peer's chain, given as the blocks from `height` onwards. They may
+        extend this node's chain or a side branch it has kept from before. If the fork
+        choice rule prefers the branch they make, the chain is rolled back to the fork
+        point and the branch replayed from there; otherwise valid blocks are kept in
+        the block tree, in case their branch is extended later.
+        Signatures the node has not checked before are checked on the verifier's pool
+        first, and the blocks considered again once it answers (see blocks_verified).
+        :type height: int
+        :type blocks: list[blokka.entities.Block]
+        :return: ACCEPTED if this node's chain now has all of the blocks; or, while
+            signatures in them are checked, a future for that answer (see _future)
+        :rtype: str
+        """
+        return self._receive_blocks(height, blocks, signatures_checked=False)
+
+    def _receive_blocks(self, height, blocks, signatures_checked):
+        """
+        :param signatures_checked: whether the verifier has already checked the
+            signatures in the blocks
+        :type signatures_checked: bool
+        """
+        received_height = height
+        if blocks and blocks[0].prev_hash in self.block_tree:
+            fork = self.block_tree.branch(blocks[0].prev_hash, self.chain)
+            if fork is None:
+                self._blocks_rejected.inc(len(blocks))
+                return REJECTED
+            fork_height, side_blocks = fork
+            height = fork_height + len(side_blocks)
+            prev_hash = blocks[0].prev_hash
+            new_blocks = blocks
+            branch = side_blocks + blocks
         else:
+            if height > self.chain.length:
+                self._blocks_rejected.inc(len(blocks))
+                return REJECTED
+            fork_height = self.chain.fork_height(height, blocks)
+            if fork_height is None:
+                return ACCEPTED
+            new_blocks = blocks[fork_height - height:]
+            height = fork_height
+            prev_hash = self.chain.hash_at(fork_height - 1) if fork_height > 0 else None
+            branch = new_blocks
+        if fork_height < self._pruned_height:
+            # The blocks this would roll back have been pruned
+            self._blocks_rejected.inc(len(new_blocks))
+            return REJECTED
+        try:
+            validate_blocks(new_blocks, height=height, prev_hash=prev_hash,
+                            difficulty=self.difficulty)
+        except ValueError as e:
+            self.logger.warning('rejecting invalid blocks: %s', e)
+            self._blocks_rejected.inc(len(new_blocks))
             return REJECTED
+        if not signatures_checked:
+            unverified = self._unverified_signatures(new_blocks)
+            if unverified is None:
+                self.logger.warning('rejecting blocks with missing signatures')
+                self._blocks_rejected.inc(len(new_blocks))
+                return REJECTED
+            if unverified:
+                reply = self._future()
+                self.verifier.verify_async(
+                    unverified,
+                    lambda results: self._tell('blocks_verified', received_height,
+                                               blocks, unverified, results, reply))
+                return reply
+        current = [self.chain.blocks[h] for h in xrange(fork_height, self.chain.length)]
+        if not self.fork_choice(current, branch):
+            for i, block in enumerate(new_blocks):
+                self.block_tree.add(block, height + i)
+            self.logger.debug('keeping a branch of %d blocks from height %d on the side',
+                              len(branch), fork_height)
+            self._blocks_rejected.inc(len(new_blocks))
+            return REJECTED
+        self._switch_to(fork_height, branch)
+        self._blocks_accepted.inc(len(new_blocks))
+        self.logger.debug('accepted %d blocks from height %d', len(branch), fork_height)
+        self._restart_mining()
+        self._chain_changed()
+        return ACCEPTED
+
+    def _unverified_signatures(self, blocks):
+        """
+        :type blocks: list[blokka.entities.Block]
+        :return: the signed transactions in blocks from peers whose signatures this node
+            has not checked yet; transactions gossiped to it earlier were checked then.
+            None if a transaction is unsigned and signatures are required.
+        :rtype: list[blokka.entities.Transaction]
+        """
+        unverified = []
+        for block in blocks:
+            if not (self.require_signatures or any(
+                    isinstance(dct, dict) and 'signature' in dct
+                    for dct in block.transaction_dicts().itervalues())):
+                continue
+            for transaction in block_transactions(block):
+                if transaction.signature is None:
+                    if self.require_signatures:
+                        return None
+                elif transaction.hash in self._verified:
+                    self._signature_cache_hits.inc()
+                else:
+                    unverified.append(transaction)
+        return unverified
+
+    def blocks_verified(self, height, blocks, transactions, results, reply):
+        """
+        Called by the verifier with the outcome of checking the signatures in blocks
+        given to receive_blocks. If they are all valid, the blocks are considered again,
+        as the chain may have changed in the meantime; the answer goes to `reply`.
+        :type height: int
+        :type blocks: list[blokka.entities.Block]
+        :param transactions: the transactions whose signatures were checked
+        :type transactions: list[blokka.entities.Transaction]
+        :param results: whether each transaction's signature is valid
+        :type results: list[bool]
+        :param reply: the future receive_blocks answered with
+        """
+        self._signatures_verified.inc(len(transactions))
+        if all(results):
+            for transaction in transactions:
+                self._verified.add(transaction.hash)
+            result = self._receive_blocks(height, blocks, signatures_checked=True)
+        else:
+            self.logger.warning('rejecting blocks with invalid signatures')
+            self._blocks_rejected.inc(len(blocks))
+            result = REJECTED
+        reply.set(result)
+
+    def _switch_to(self, fork_height, branch):
+        """
+        Roll the chain back to `fork_height` and replay `branch` from there. The blocks
+        rolled back go into the block tree, and their transactions back into the
+        pending transactions unless the branch has them too.
+        :type fork_height: int
+        :type branch: list[blokka.entities.Block]
+        """
+        orphaned = [self.chain.blocks[h] for h in xrange(fork_height, self.chain.length)]
+        self.chain.replace_from(fork_height, branch)
+        self._update_ledger(orphaned, branch)
+        self.block_tree.remove(branch)
+        for i, block in enumerate(orphaned):
+            self.block_tree.add(block, fork_height + i)
+        confirmed = set(h for block in branch for h in block.transaction_hashes())
+        self.pending_transactions.restore(
+            [tx for block in orphaned for tx in block_transactions(block)
+             if tx.hash not in confirmed])
+        self.pending_transactions.remove_confirmed(confirmed)
+        self.block_tree.prune(self.chain.length - 1)
+
+    def receive_chain(self, chain):
+        """
+        Consider a peer's whole chain; only the part after the common prefix is applied
+        :type chain: blokka.entities.Chain
+        :rtype: str
+        """
+        height = self.chain.common_length(chain.locator())
+        return self.receive_blocks(height, chain.blocks[height:])
+
+
+def _drive_task(task, timeout):
+    """
+    Run a task (see Node._run_task) to the end, blocking on each future it yields
+    :type task: generator
+    :type timeout: float
+    """
+    resume, value = task.send, None
+    while True:
+        try:
+            future = resume(value)
+        except StopIteration:
+            return
+        try:
+            value = future.get(timeout=timeout)
+            # A call may answer with a future for its answer (see Node.receive_blocks)
+            while isinstance(value, ThreadingFuture):
+                value = value.get(timeout=timeout)
+            resume = task.send
+        except Exception as e:
+            resume, value = task.throw, e
+
+
+class _ShareRound(object):
+    """
+    Bookkeeping for one call to Node.share_chain
+    """
+
+    def __init__(self, round_id, tip_hash, peers, outcome):
+        """
+        :type round_id: int
+        :param tip_hash: the tip of the chain being shared
+        :type tip_hash: str
+        :param peers: number of peers the chain was sent to
+        :type peers: int
+        :type outcome: pykka.ThreadingFuture
+        """
+        self.round_id = round_id
+        self.tip_hash = tip_hash
+        self.peers = peers
+        self.outcome = outcome
+        self.counts = Counter()
 
 
 # new transaction created on one node
@@ -125,6 +1067,6 @@ class Node(ThreadingActor):
 # if so, it builds a block (method complexity TBD) and adds it to the chain
 # it then shares the chain with peers
 # when receiving a transaction, follow the same steps
-# when receiving a chain, compare the contents and the length - if the same, do nothing;
-# if not, choose the longer one... if the same length, do what? and how to not lose
-# whatever pending_transactions were in the discarded block? - somehow parse which ones are not in a block and keep those
+# when receiving a chain, compare the contents after the fork point - the fork choice
+# rule picks a branch; one that loses is kept in the block tree in case it grows later,
+# and transactions in blocks that are rolled back go back to pending_transactions
@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 # Author(s): 'Percy Link' <percylink@gmail.com>
 import abc
-import json
+import io
+import mmap
 import os
+import shutil
+import sqlite3
+import struct
+import zlib
+from Queue import Queue
+from binascii import hexlify, unhexlify
+from collections import Sequence
+from contextlib import contextmanager
+from datetime import datetime
 
-from blokka.entities import Chain
+from blokka import codec
+from blokka.entities import DATEFORMAT, Block, Chain, Transaction
+from blokka.streams import ChainFile, iter_blocks, write_chain
 
 
 class ChainBackend(object):
@@ -19,14 +31,49 @@ class ChainBackend(object):
     def load_chain(self, node_id):
         pass
 
+    def prune(self, node_id, height):
+        """
+        Drop the data of a node's saved blocks below `height`, keeping their headers,
+        once the chain has been pruned (see blokka.entities.Chain.prune) and saved.
+        Backends that rewrite the whole chain on each save have nothing to do.
+        :type node_id: str
+        :type height: int
+        """
+
+
+class MemoryBackend(ChainBackend):
+    """
+    Chains kept in memory only, for simulations
+    """
+
+    def __init__(self):
+        self.chains = {}
+
+    def save_chain(self, chain, node_id):
+        self.chains[node_id] = chain
+
+    def load_chain(self, node_id):
+        return self.chains.get(node_id)
+
 
 class FileBackend(ChainBackend):
+    """
+    One JSON file per node. Chains are written and read one block at a time (see
+    blokka.streams); a lazily loaded chain is a MappedBlocks view that decodes a block
+    only when it is accessed. Lazy loading saves memory rather than time: every block
+    of a chain is read to load it either way, and a node goes on to read most of them.
+    """
 
     FILE_DIR = './tmp'
 
-    def __init__(self):
+    def __init__(self, lazy=False):
+        """
+        :param lazy: load chains as lazy views rather than decoding every block
+        :type lazy: bool
+        """
         if not os.path.exists(self.FILE_DIR):
             os.mkdir(self.FILE_DIR)
+        self.lazy = lazy
 
     def __file_path(self, node_id):
         """
@@ -37,10 +84,19 @@ class FileBackend(ChainBackend):
 
     def save_chain(self, chain, node_id):
         """
+        Write the chain to a temporary file and move it into place, so a lazy chain can
+        keep copying its blocks from the old file while they are written out
         :type chain: blokka.entities.Chain
         :type node_id: str
         """
-        json.dump(chain.to_dict(), open(self.__file_path(node_id), 'w'))
+        path = self.__file_path(node_id)
+        with open(path + '.tmp', 'wb') as f:
+            offsets = write_chain(f, chain.blocks)
+        os.rename(path + '.tmp', path)
+        if isinstance(chain.blocks, MappedBlocks) and isinstance(chain.blocks.segment,
+                                                                 ChainFile):
+            hashes = [chain.hash_at(h) for h in xrange(chain.length)]
+            chain.blocks.remap(ChainFile(open(path, 'rb'), offsets, hashes))
 
     def load_chain(self, node_id):
         """
@@ -48,7 +104,896 @@ class FileBackend(ChainBackend):
         :rtype: blokka.entities.Chain
         """
         try:
-            dct = json.load(open(self.__file_path(node_id), 'r'))
-            return Chain.from_dict(dct)
+            f = open(self.__file_path(node_id), 'rb')
         except IOError:
             return None
+        if self.lazy:
+            chain_file = ChainFile(f)
+            return Chain(blocks=MappedBlocks(chain_file, chain_file.length))
+        with f:
+            return Chain(blocks=list(iter_blocks(f)))
+
+
+class LogFileBackend(ChainBackend):
+    """
+    Append-only backend: each node's chain is a log file with one record per block, so
+    saving a chain only writes the blocks that are not on disk yet.
+
+    A record is a RECORD_HEADER (payload length, CRC32 of the payload) followed by the
+    block's binary encoding (see Block.to_bytes). A record that is incomplete or fails
+    its checksum marks a torn write; it and everything after it are truncated away when
+    the log is opened.
+    """
+
+    RECORD_HEADER = struct.Struct('>II')
+
+    FILE_DIR = './tmp'
+
+    def __init__(self, fsync_every=1):
+        """
+        :param fsync_every: fsync a log after this many saves to it (None: never fsync,
+            leave it to the OS)
+        :type fsync_every: int
+        """
+        if not os.path.exists(self.FILE_DIR):
+            os.mkdir(self.FILE_DIR)
+        self.fsync_every = fsync_every
+        self._logs = {}
+
+    def __file_path(self, node_id):
+        """
+        :type node_id: str
+        :rtype: str
+        """
+        return os.path.join(self.FILE_DIR, node_id + '.log')
+
+    @classmethod
+    def _encode_record(cls, block):
+        """
+        :type block: blokka.entities.Block
+        :rtype: bytes
+        """
+        payload = block.to_bytes()
+        return cls.RECORD_HEADER.pack(
+            len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    @classmethod
+    def _read_record(cls, f):
+        """
+        Read the record at the file's position
+        :type f: io.BufferedRandom
+        :return: the record's length and block, or None if the record is torn or
+            corrupt
+        :rtype: (int, blokka.entities.Block)
+        """
+        header = f.read(cls.RECORD_HEADER.size)
+        if len(header) < cls.RECORD_HEADER.size:
+            return None
+        length, crc = cls.RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or crc != zlib.crc32(payload) & 0xffffffff:
+            return None
+        try:
+            block = Block.from_bytes(payload)
+        except (ValueError, struct.error):
+            return None
+        return cls.RECORD_HEADER.size + length, block
+
+    def _open_log(self, node_id):
+        """
+        Open a node's log, index its records and cut off a torn tail
+        :type node_id: str
+        :rtype: _Log
+        """
+        if node_id not in self._logs:
+            f = io.open(self.__file_path(node_id), 'a+b')
+            f.seek(0)
+            log = _Log(f)
+            offset = 0
+            record = self._read_record(f)
+            while record is not None:
+                log.offsets.append(offset)
+                log.hashes.append(record[1].hash)
+                offset += record[0]
+                record = self._read_record(f)
+            log.truncate(offset)
+            self._logs[node_id] = log
+        return self._logs[node_id]
+
+    def save_chain(self, chain, node_id):
+        """
+        Bring the log in line with the chain: truncate any blocks the chain no longer
+        has, then append the new ones in a single write
+        :type chain: blokka.entities.Chain
+        :type node_id: str
+        """
+        log = self._open_log(node_id)
+        common = min(chain.length, len(log.hashes))
+        while common > 0 and chain.blocks[common - 1].hash != log.hashes[common - 1]:
+            common -= 1
+        if common < len(log.hashes):
+            log.truncate(log.offsets[common])
+            del log.offsets[common:]
+            del log.hashes[common:]
+
+        records = [self._encode_record(b) for b in chain.blocks[common:]]
+        offset = log.size
+        for block, record in zip(chain.blocks[common:], records):
+            log.offsets.append(offset)
+            log.hashes.append(block.hash)
+            offset += len(record)
+        log.append(b''.join(records))
+        log.commit(self.fsync_every)
+
+    def prune(self, node_id, height):
+        """
+        Rewrite a node's log with only the headers of its blocks below `height`. The
+        records after them are copied over as they are; the new log replaces the old
+        one in a single rename.
+        :type node_id: str
+        :type height: int
+        """
+        log = self._open_log(node_id)
+        height = min(height, len(log.offsets))
+        path = self.__file_path(node_id)
+        with io.open(path + '.tmp', 'wb') as f:
+            log.file.seek(0)
+            for _ in xrange(height):
+                f.write(self._encode_record(self._read_record(log.file)[1].header()))
+            shutil.copyfileobj(log.file, f)
+            f.flush()
+            os.fsync(f.fileno())
+        log.file.close()
+        os.rename(path + '.tmp', path)
+        del self._logs[node_id]
+        self._open_log(node_id)
+
+    def remove_latest_block(self, node_id):
+        """
+        Truncate the last block from a node's log
+        :type node_id: str
+        """
+        log = self._open_log(node_id)
+        if log.offsets:
+            log.truncate(log.offsets.pop())
+            log.hashes.pop()
+            log.commit(self.fsync_every)
+
+    def load_chain(self, node_id):
+        """
+        :type node_id: str
+        :rtype: blokka.entities.Chain
+        """
+        if node_id not in self._logs and not os.path.exists(self.__file_path(node_id)):
+            return None
+        log = self._open_log(node_id)
+        log.file.seek(0)
+        blocks = [self._read_record(log.file)[1] for _ in log.offsets]
+        return Chain(blocks=blocks)
+
+    def close(self):
+        """
+        fsync and close all open logs
+        """
+        for log in self._logs.values():
+            log.commit(1)
+            log.file.close()
+        self._logs = {}
+
+
+class _Log(object):
+    """
+    An open log file plus the byte offset and hash of each of its records
+    """
+
+    def __init__(self, f):
+        self.file = f
+        self.offsets = []
+        self.hashes = []
+        self.size = 0
+        self.unsynced_saves = 0
+
+    def append(self, data):
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(data)
+        self.size += len(data)
+
+    def truncate(self, size):
+        self.file.truncate(size)
+        self.size = size
+
+    def commit(self, fsync_every):
+        """
+        Flush buffered writes, and fsync once every `fsync_every` commits
+        """
+        self.file.flush()
+        self.unsynced_saves += 1
+        if fsync_every is not None and self.unsynced_saves >= fsync_every:
+            os.fsync(self.file.fileno())
+            self.unsynced_saves = 0
+
+
+class MmapBackend(ChainBackend):
+    """
+    Binary block store: each node's blocks live in a segment file of fixed-header
+    records, with a side index file of (offset, hash) entries, one per height. Both are
+    memory-mapped, so loading a chain is constant time and returns a lazy MappedBlocks
+    view that decodes a block only when it is accessed.
+    """
+
+    FILE_DIR = './tmp'
+
+    def __init__(self, fsync_every=1):
+        """
+        :param fsync_every: fsync a node's files after this many saves to them (None:
+            never fsync, leave it to the OS)
+        :type fsync_every: int
+        """
+        if not os.path.exists(self.FILE_DIR):
+            os.mkdir(self.FILE_DIR)
+        self.fsync_every = fsync_every
+        self._segments = {}
+
+    def __file_path(self, node_id, extension):
+        """
+        :type node_id: str
+        :type extension: str
+        :rtype: str
+        """
+        return os.path.join(self.FILE_DIR, node_id + extension)
+
+    def _open_segment(self, node_id):
+        """
+        :type node_id: str
+        :rtype: _Segment
+        """
+        if node_id not in self._segments:
+            self._segments[node_id] = _Segment(
+                self.__file_path(node_id, '.blocks'), self.__file_path(node_id, '.idx'))
+        return self._segments[node_id]
+
+    def save_chain(self, chain, node_id):
+        """
+        Truncate any blocks the chain no longer has, then append the new ones
+        :type chain: blokka.entities.Chain
+        :type node_id: str
+        """
+        segment = self._open_segment(node_id)
+        blocks = chain.blocks
+        common = min(len(blocks), segment.length)
+        while common > 0 and _block_hash(blocks, common - 1) != segment.hash_at(common - 1):
+            common -= 1
+        segment.truncate(common)
+        segment.append([blocks[i] for i in xrange(common, len(blocks))])
+        segment.commit(self.fsync_every)
+        if isinstance(blocks, MappedBlocks) and blocks.segment is segment:
+            blocks.rebase()
+
+    def prune(self, node_id, height):
+        """
+        Rewrite a node's segment with only the headers of its blocks below `height`
+        (see _Segment.prune)
+        :type node_id: str
+        :type height: int
+        """
+        self._open_segment(node_id).prune(height)
+
+    def load_chain(self, node_id):
+        """
+        :type node_id: str
+        :rtype: blokka.entities.Chain
+        """
+        if (node_id not in self._segments and
+                not os.path.exists(self.__file_path(node_id, '.idx'))):
+            return None
+        segment = self._open_segment(node_id)
+        return Chain(blocks=MappedBlocks(segment, segment.length))
+
+    def close(self):
+        """
+        fsync and close all open segments
+        """
+        for segment in self._segments.values():
+            segment.commit(1)
+            segment.close()
+        self._segments = {}
+
+
+def _block_hash(blocks, height):
+    """
+    Hash of the block at `height`, without decoding it if the blocks are mapped
+    :type blocks: list[blokka.entities.Block] | MappedBlocks
+    :type height: int
+    :rtype: str
+    """
+    if isinstance(blocks, MappedBlocks):
+        return blocks.hash_at(height)
+    return blocks[height].hash
+
+
+class MappedBlocks(Sequence):
+    """
+    Lazy, list-like view of the first `length` blocks of a segment, plus any blocks
+    appended in memory since. Slices from the start are views too, and truncate drops
+    blocks without reading any, so rolling a chain back costs the depth of the roll
+    back rather than the length of the chain.
+    """
+
+    def __init__(self, segment, length, tail=None, pruned=0):
+        """
+        :param segment: where the blocks are read from
+        :type segment: _Segment | blokka.streams.ChainFile
+        :type length: int
+        :param tail: blocks appended after the mapped ones, not saved yet
+        :type tail: list[blokka.entities.Block]
+        :param pruned: the mapped blocks below this height are read as headers (see
+            prune)
+        :type pruned: int
+        """
+        self.segment = segment
+        self._length = length
+        self._tail = tail or []
+        self._pruned = pruned
+
+    def __len__(self):
+        return self._length + len(self._tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if start == 0 and step == 1:
+                stop = max(stop, 0)
+                return MappedBlocks(self.segment, min(stop, self._length),
+                                    self._tail[:max(stop - self._length, 0)],
+                                    min(stop, self._pruned))
+            return [self[i] for i in xrange(start, stop, step)]
+        index = self._check_index(index)
+        if index >= self._length:
+            return self._tail[index - self._length]
+        if index < self._pruned:
+            return self.segment.block_at(index).header()
+        return self.segment.block_at(index)
+
+    def __eq__(self, other):
+        return (isinstance(other, (list, MappedBlocks)) and len(self) == len(other) and
+                all(_block_hash(self, i) == _block_hash(other, i) and self[i] == other[i]
+                    for i in xrange(len(self))))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _check_index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('block index out of range')
+        return index
+
+    def hash_at(self, height):
+        """
+        :type height: int
+        :rtype: str
+        """
+        height = self._check_index(height)
+        if height >= self._length:
+            return self._tail[height - self._length].hash
+        return self.segment.hash_at(height)
+
+    def height_of(self, block_hash):
+        """
+        :type block_hash: str
+        :return: height of the block with this hash, or None if it is not in the view
+        :rtype: int
+        """
+        height = self.segment.height_of(block_hash)
+        if height is not None and height < self._length:
+            return height
+        for i, block in enumerate(self._tail):
+            if block.hash == block_hash:
+                return self._length + i
+        return None
+
+    def append(self, block):
+        """
+        :type block: blokka.entities.Block
+        """
+        self._tail.append(block)
+
+    def truncate(self, height):
+        """
+        Drop the blocks from `height` onwards; the segment keeps them until the chain
+        is saved
+        :type height: int
+        """
+        if height >= self._length:
+            del self._tail[height - self._length:]
+        else:
+            self._length = height
+            self._tail = []
+            self._pruned = min(self._pruned, height)
+
+    def encoded_at(self, height):
+        """
+        :type height: int
+        :return: the segment's encoding of the block at `height`, to copy it without
+            decoding it; None if the block is not read from the segment as it is there,
+            being in the tail or pruned
+        :rtype: bytes
+        """
+        if self._pruned <= height < self._length:
+            return self.segment.encoded_at(height)
+        return None
+
+    def prune(self, height):
+        """
+        Read the blocks below `height` as headers from now on, without decoding any
+        now; once the backend has pruned them too, the segment holds only headers
+        :type height: int
+        """
+        self._pruned = max(self._pruned, min(height, self._length))
+        tail_height = max(height - self._length, 0)
+        self._tail[:tail_height] = [block.header() for block in self._tail[:tail_height]]
+
+    def rebase(self):
+        """
+        Map the in-memory tail once it has been saved to the segment
+        """
+        self._length += len(self._tail)
+        self._tail = []
+
+    def remap(self, segment):
+        """
+        Read all of the blocks from `segment` once they have been saved to it; the
+        segment read from until now is closed
+        """
+        if segment is not self.segment:
+            self.segment.close()
+        self.segment = segment
+        self._length = segment.length
+        self._tail = []
+
+
+class _Segment(object):
+    """
+    A node's segment and index files. A segment record is a RECORD_HEADER (payload
+    length, raw block hash) followed by the block's binary encoding; index entry `h`
+    holds the offset and raw hash of the block at height `h`.
+    """
+
+    RECORD_HEADER = struct.Struct('>I32s')
+    INDEX_ENTRY = struct.Struct('>Q32s')
+
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.unsynced_saves = 0
+        self._data_map = None
+        self._index_map = None
+        self._heights = None
+        self._finish_prune()
+        self._open()
+
+    def _open(self):
+        self.data = io.open(self.data_path, 'a+b')
+        self.index = io.open(self.index_path, 'a+b')
+        self.length = os.fstat(self.index.fileno()).st_size // self.INDEX_ENTRY.size
+        self.size = os.fstat(self.data.fileno()).st_size
+        self._recover()
+
+    def _finish_prune(self):
+        """
+        Complete a prune that was interrupted after both new files were written (see
+        prune), or throw away one interrupted before
+        """
+        if os.path.exists(self.index_path + '.new'):
+            if os.path.exists(self.data_path + '.tmp'):
+                os.rename(self.data_path + '.tmp', self.data_path)
+            os.rename(self.index_path + '.new', self.index_path)
+        for path in (self.data_path + '.tmp', self.index_path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _recover(self):
+        """
+        Drop index entries whose records did not make it into the segment, and any
+        partial index entry or record after the last complete block
+        """
+        end = 0
+        while self.length > 0:
+            offset, raw_hash = self._entry(self.length - 1)
+            if offset + self.RECORD_HEADER.size <= self.size:
+                payload_length, record_hash = self.RECORD_HEADER.unpack_from(
+                    self._map_data(), offset)
+                end = offset + self.RECORD_HEADER.size + payload_length
+                if end <= self.size and record_hash == raw_hash:
+                    break
+            self.length -= 1
+            end = 0
+        self._unmap()
+        self.index.truncate(self.length * self.INDEX_ENTRY.size)
+        self.data.truncate(end)
+        self.size = end
+
+    def _map(self, f, current, needed):
+        if current is not None and len(current) >= needed:
+            return current
+        if current is not None:
+            current.close()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _map_data(self):
+        self._data_map = self._map(self.data, self._data_map, self.size)
+        return self._data_map
+
+    def _map_index(self):
+        self._index_map = self._map(
+            self.index, self._index_map, self.length * self.INDEX_ENTRY.size)
+        return self._index_map
+
+    def _unmap(self):
+        for m in (self._data_map, self._index_map):
+            if m is not None:
+                m.close()
+        self._data_map = None
+        self._index_map = None
+
+    def _entry(self, height):
+        return self.INDEX_ENTRY.unpack_from(self._map_index(), height * self.INDEX_ENTRY.size)
+
+    def hash_at(self, height):
+        """
+        :type height: int
+        :rtype: str
+        """
+        return hexlify(self._entry(height)[1]).decode('ascii')
+
+    def height_of(self, block_hash):
+        """
+        :type block_hash: str
+        :rtype: int
+        """
+        if self._heights is None:
+            self._heights = {self.hash_at(h): h for h in xrange(self.length)}
+        return self._heights.get(block_hash)
+
+    def block_at(self, height):
+        """
+        :type height: int
+        :rtype: blokka.entities.Block
+        """
+        offset = self._entry(height)[0]
+        data = self._map_data()
+        payload_length = self.RECORD_HEADER.unpack_from(data, offset)[0]
+        start = offset + self.RECORD_HEADER.size
+        return Block.from_bytes(data[start:start + payload_length])
+
+    def append(self, blocks):
+        """
+        Write records for `blocks` to the segment, then their index entries
+        :type blocks: list[blokka.entities.Block]
+        """
+        records = []
+        entries = []
+        offset = self.size
+        for block in blocks:
+            payload = block.to_bytes()
+            raw_hash = unhexlify(block.hash)
+            records.append(self.RECORD_HEADER.pack(len(payload), raw_hash) + payload)
+            entries.append(self.INDEX_ENTRY.pack(offset, raw_hash))
+            offset += len(records[-1])
+        self.data.seek(0, os.SEEK_END)
+        self.data.write(b''.join(records))
+        self.data.flush()
+        self.index.seek(0, os.SEEK_END)
+        self.index.write(b''.join(entries))
+        self.index.flush()
+        if self._heights is not None:
+            for i, block in enumerate(blocks):
+                self._heights[block.hash] = self.length + i
+        self.length += len(blocks)
+        self.size = offset
+
+    def truncate(self, length):
+        """
+        Drop the blocks at heights `length` and above
+        :type length: int
+        """
+        if length >= self.length:
+            return
+        end = self._entry(length)[0]
+        if self._heights is not None:
+            for h in xrange(length, self.length):
+                del self._heights[self.hash_at(h)]
+        # A mapping must not outlive the end of its file
+        self._unmap()
+        self.index.truncate(length * self.INDEX_ENTRY.size)
+        self.data.truncate(end)
+        self.length = length
+        self.size = end
+
+    def prune(self, height):
+        """
+        Rewrite the segment with only the headers of the blocks below `height`, and the
+        index with their records' new offsets. The records after them are copied over
+        as they are. Both new files are written and synced before either replaces the
+        old one; the index is marked complete by renaming it to '.new' first, so a
+        prune cut short after that is finished when the segment is next opened.
+        :type height: int
+        """
+        height = min(height, self.length)
+        records = []
+        entries = []
+        offset = 0
+        for h in xrange(height):
+            block = self.block_at(h).header()
+            payload = block.to_bytes()
+            raw_hash = unhexlify(block.hash)
+            records.append(self.RECORD_HEADER.pack(len(payload), raw_hash) + payload)
+            entries.append(self.INDEX_ENTRY.pack(offset, raw_hash))
+            offset += len(records[-1])
+        start = self._entry(height)[0] if height < self.length else self.size
+        for h in xrange(height, self.length):
+            old_offset, raw_hash = self._entry(h)
+            entries.append(self.INDEX_ENTRY.pack(old_offset - start + offset, raw_hash))
+        with io.open(self.data_path + '.tmp', 'wb') as f:
+            f.write(b''.join(records))
+            self.data.seek(start)
+            shutil.copyfileobj(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        with io.open(self.index_path + '.tmp', 'wb') as f:
+            f.write(b''.join(entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.rename(self.index_path + '.tmp', self.index_path + '.new')
+        self._finish_prune()
+        self._open()
+
+    def commit(self, fsync_every):
+        """
+        fsync once every `fsync_every` commits; the segment goes first, so an index
+        entry never points at a record that is not on disk
+        """
+        self.unsynced_saves += 1
+        if fsync_every is not None and self.unsynced_saves >= fsync_every:
+            os.fsync(self.data.fileno())
+            os.fsync(self.index.fileno())
+            self.unsynced_saves = 0
+
+    def close(self):
+        self._unmap()
+        self.data.close()
+        self.index.close()
+
+
+class SQLiteBackend(ChainBackend):
+    """
+    Stores every node's chain in one SQLite database, with a table of blocks indexed by
+    height and hash and a table of the transactions decoded from each block's data.
+    Block timestamps are stored as microseconds since the epoch and block data in its
+    binary encoding (see blokka.codec). Transaction amounts and fees are stored
+    untyped, so an integer stays an integer and the transaction keeps its hash.
+    Share one instance between nodes to share its database and connection pool.
+    """
+
+    FILE_DIR = './tmp'
+    DB_NAME = 'blokka.db'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blocks (
+            node_id TEXT NOT NULL,
+            height INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            prev_hash TEXT,
+            timestamp INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            merkle_root TEXT,
+            nonce INTEGER,
+            PRIMARY KEY (node_id, height)
+        );
+        CREATE INDEX IF NOT EXISTS blocks_hash ON blocks (node_id, hash);
+        CREATE TABLE IF NOT EXISTS transactions (
+            node_id TEXT NOT NULL,
+            height INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            seller_id TEXT,
+            buyer_id TEXT,
+            timestamp TEXT,
+            amount,
+            fee,
+            signature TEXT,
+            PRIMARY KEY (node_id, height, hash)
+        );
+        CREATE INDEX IF NOT EXISTS transactions_hash ON transactions (node_id, hash);
+    """
+
+    # Columns read back to rebuild a Block, in _row_to_block's order
+    BLOCK_COLUMNS = 'timestamp, prev_hash, data, merkle_root, nonce, hash'
+
+    def __init__(self, path=None, pool_size=4):
+        """
+        :param path: database file (default: DB_NAME in FILE_DIR)
+        :type path: str
+        :type pool_size: int
+        """
+        if path is None:
+            if not os.path.exists(self.FILE_DIR):
+                os.mkdir(self.FILE_DIR)
+            path = os.path.join(self.FILE_DIR, self.DB_NAME)
+        self._pool = _ConnectionPool(path, pool_size)
+        with self._pool.connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def save_chain(self, chain, node_id):
+        """
+        Delete any blocks the chain no longer has, then insert the new ones in one batch
+        :type chain: blokka.entities.Chain
+        :type node_id: str
+        """
+        with self._pool.connection() as conn:
+            with conn:
+                common = min(chain.length, self._length(conn, node_id))
+                while common > 0 and (chain.blocks[common - 1].hash !=
+                                      self._hash_at(conn, node_id, common - 1)):
+                    common -= 1
+                conn.execute('DELETE FROM blocks WHERE node_id = ? AND height >= ?',
+                             (node_id, common))
+                conn.execute('DELETE FROM transactions WHERE node_id = ? AND height >= ?',
+                             (node_id, common))
+                new_blocks = [(h, chain.blocks[h]) for h in xrange(common, chain.length)]
+                conn.executemany(
+                    'INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(node_id, h, b.hash, b.prev_hash, codec.timestamp_micros(b.timestamp),
+                      _encode_data(b.data), b.merkle_root, b.nonce)
+                     for h, b in new_blocks])
+                conn.executemany(
+                    'INSERT OR IGNORE INTO transactions '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(node_id, h, tx_hash, tx['seller_id'], tx['buyer_id'],
+                      tx['timestamp'], tx['amount'], tx.get('fee'), tx.get('signature'))
+                     for h, b in new_blocks
+                     for tx_hash, tx in b.transaction_dicts().iteritems()])
+
+    def prune(self, node_id, height):
+        """
+        Clear the data of a node's blocks below `height`, and delete their
+        transactions. SQLite keeps the pages freed for the rows saved after.
+        :type node_id: str
+        :type height: int
+        """
+        with self._pool.connection() as conn:
+            with conn:
+                conn.execute('UPDATE blocks SET data = ? WHERE node_id = ? AND height < ?',
+                             (_encode_data(None), node_id, height))
+                conn.execute('DELETE FROM transactions WHERE node_id = ? AND height < ?',
+                             (node_id, height))
+
+    def load_chain(self, node_id):
+        """
+        :type node_id: str
+        :rtype: blokka.entities.Chain
+        """
+        with self._pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT ' + self.BLOCK_COLUMNS + ' FROM blocks WHERE node_id = ? '
+                'ORDER BY height', (node_id,)).fetchall()
+        if not rows:
+            return None
+        return Chain(blocks=[self._row_to_block(row) for row in rows])
+
+    def block_at(self, node_id, height):
+        """
+        :type node_id: str
+        :type height: int
+        :rtype: blokka.entities.Block
+        """
+        return self._fetch_block(
+            'SELECT ' + self.BLOCK_COLUMNS + ' FROM blocks '
+            'WHERE node_id = ? AND height = ?',
+            (node_id, height))
+
+    def block_by_hash(self, node_id, block_hash):
+        """
+        :type node_id: str
+        :type block_hash: str
+        :rtype: blokka.entities.Block
+        """
+        return self._fetch_block(
+            'SELECT ' + self.BLOCK_COLUMNS + ' FROM blocks '
+            'WHERE node_id = ? AND hash = ?',
+            (node_id, block_hash))
+
+    def height_of(self, node_id, block_hash):
+        """
+        :type node_id: str
+        :type block_hash: str
+        :rtype: int
+        """
+        with self._pool.connection() as conn:
+            row = conn.execute('SELECT height FROM blocks WHERE node_id = ? AND hash = ?',
+                               (node_id, block_hash)).fetchone()
+        return row[0] if row else None
+
+    def transaction(self, node_id, tx_hash):
+        """
+        Look up a confirmed transaction by its hash
+        :type node_id: str
+        :type tx_hash: str
+        :return: the transaction and the height of the block it is in, or None
+        :rtype: (blokka.entities.Transaction, int)
+        """
+        with self._pool.connection() as conn:
+            row = conn.execute(
+                'SELECT seller_id, buyer_id, timestamp, amount, fee, signature, height '
+                'FROM transactions WHERE node_id = ? AND hash = ? ORDER BY height LIMIT 1',
+                (node_id, tx_hash)).fetchone()
+        if row is None:
+            return None
+        seller_id, buyer_id, timestamp, amount, fee, signature, height = row
+        return Transaction(seller_id=seller_id, buyer_id=buyer_id,
+                           timestamp=datetime.strptime(timestamp, DATEFORMAT),
+                           amount=amount, fee=fee, signature=signature), height
+
+    def close(self):
+        self._pool.close()
+
+    def _fetch_block(self, query, params):
+        with self._pool.connection() as conn:
+            row = conn.execute(query, params).fetchone()
+        return self._row_to_block(row) if row else None
+
+    @staticmethod
+    def _row_to_block(row):
+        timestamp, prev_hash, data, merkle_root, nonce, block_hash = row
+        return Block(timestamp=codec.micros_timestamp(timestamp), prev_hash=prev_hash,
+                     data=codec.decode_value(bytes(data))[0], merkle_root=merkle_root,
+                     nonce=nonce, hash=block_hash)
+
+    @staticmethod
+    def _length(conn, node_id):
+        return conn.execute('SELECT COALESCE(MAX(height) + 1, 0) FROM blocks WHERE node_id = ?',
+                            (node_id,)).fetchone()[0]
+
+    @staticmethod
+    def _hash_at(conn, node_id, height):
+        row = conn.execute('SELECT hash FROM blocks WHERE node_id = ? AND height = ?',
+                           (node_id, height)).fetchone()
+        return row[0] if row else None
+
+
+def _encode_data(data):
+    out = []
+    codec.encode_value(data, out)
+    return sqlite3.Binary(b''.join(out))
+
+
+class _ConnectionPool(object):
+    """
+    A fixed set of SQLite connections in WAL mode, handed out to one thread at a time
+    """
+
+    def __init__(self, path, size):
+        """
+        :type path: str
+        :type size: int
+        """
+        self._connections = Queue()
+        for _ in xrange(size):
+            conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections.put(conn)
+        self._size = size
+
+    @contextmanager
+    def connection(self):
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        for _ in xrange(self._size):
+            self._connections.get().close()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Benchmarks for entities, backends and a network of nodes.
+
+Run with
+
+    python -m blokka.benchmarks [--quick] [--max-blocks N] [--output FILE]
+                                [--baseline FILE] [--threshold FRACTION]
+
+Results are written as JSON:
+
+    {"format": 1, "python": "2.7.18", "platform": "...", "created": "...",
+     "results": {"<name>": {"seconds": 0.0123, "ops": 1000, "ops_per_second": ...,
+                            ...extra measurements}}}
+
+`seconds` is the best of several runs. Baselines are compared on seconds per op, so
+runs of different sizes can still be compared; lower is better. With --baseline, any
+benchmark more than --threshold slower than in the baseline is reported, and the exit
+status is 1.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pytz
+
+from blokka.backends import FileBackend, LogFileBackend
+from blokka.entities import Block, Chain, Transaction
+from blokka.merkle import merkle_root
+
+FORMAT_VERSION = 1
+
+CHAIN_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+
+def best_time(func, repeat=3):
+    """
+    :param func: called with no arguments
+    :return: the shortest of `repeat` wall-clock timings of func, in seconds
+    :rtype: float
+    """
+    timings = []
+    for _ in xrange(repeat):
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+    return min(timings)
+
+
+def result(seconds, ops, **extra):
+    """
+    :param seconds: time taken for `ops` operations
+    :type seconds: float
+    :type ops: int
+    :rtype: dict
+    """
+    extra.update(seconds=seconds, ops=ops,
+                 ops_per_second=ops / seconds if seconds > 0 else None)
+    return extra
+
+
+def make_transactions(count, seed=0):
+    """
+    :rtype: list[blokka.entities.Transaction]
+    """
+    rnd = random.Random(seed)
+    return [Transaction(seller_id='seller%d' % rnd.randint(0, 99),
+                        buyer_id='buyer%d' % rnd.randint(0, 99),
+                        timestamp=datetime(2017, 1, 1, 0, 0, 0, i % 1000000),
+                        amount=rnd.randint(1, 1000) / 10.0)
+            for i in xrange(count)]
+
+
+def make_chain(length, transactions_per_block=5):
+    """
+    A valid chain of `length` blocks, each holding `transactions_per_block`
+    transactions
+    :rtype: blokka.entities.Chain
+    """
+    chain = Chain(blocks=[])
+    transactions = make_transactions(transactions_per_block)
+    for i in xrange(length):
+        chain.add_block(Block(
+            timestamp=datetime(2017, 1, 1, 0, 0, 0, i % 1000000),
+            prev_hash=chain.latest_hash(),
+            data={t.hash: t.to_dict() for t in transactions},
+            merkle_root=merkle_root(sorted(t.hash for t in transactions))))
+    return chain
+
+
+def bench_transaction_hash(count=10000):
+    timestamp = datetime(2017, 1, 1)
+
+    def run():
+        for i in xrange(count):
+            Transaction(seller_id='s', buyer_id='b', timestamp=timestamp, amount=i).hash
+    return {'transaction_hash': result(best_time(run), count)}
+
+
+def bench_block_hash(count=2000):
+    transactions = make_transactions(5)
+    data = {t.hash: t.to_dict() for t in transactions}
+    root = merkle_root(sorted(data))
+    timestamp = datetime(2017, 1, 1)
+
+    def construct():
+        for i in xrange(count):
+            Block(timestamp=timestamp, prev_hash=None, data=data, merkle_root=root,
+                  nonce=i)
+    block = Block(timestamp=timestamp, prev_hash=None, data=data, merkle_root=root)
+
+    def rehash():
+        for _ in xrange(count):
+            block.compute_hash()
+    return {'block_construct': result(best_time(construct), count),
+            'block_hash': result(best_time(rehash), count)}
+
+
+def bench_chain_dict(sizes):
+    results = {}
+    for size in sizes:
+        chain = make_chain(size)
+        repeat = 3 if size <= 10 ** 4 else 1
+        dct = chain.to_dict()
+        results['chain_to_dict_%d' % size] = result(
+            best_time(chain.to_dict, repeat), size)
+        results['chain_from_dict_%d' % size] = result(
+            best_time(lambda: Chain.from_dict(dct), repeat), size)
+    return results
+
+
+def bench_file_backend(sizes):
+    results = {}
+    directory = tempfile.mkdtemp(prefix='blokka-bench-')
+    try:
+        backend_class = type('BenchFileBackend', (FileBackend,), {'FILE_DIR': directory})
+        backend = backend_class()
+        lazy = backend_class(lazy=True)
+        for size in sizes:
+            chain = make_chain(size)
+            repeat = 3 if size <= 10 ** 4 else 1
+            results['file_backend_save_%d' % size] = result(
+                best_time(lambda: backend.save_chain(chain, 'bench'), repeat), size,
+                bytes=os.path.getsize(os.path.join(directory, 'bench.json')))
+            results['file_backend_load_%d' % size] = result(
+                best_time(lambda: backend.load_chain('bench'), repeat), size)
+            results['file_backend_load_lazy_%d' % size] = result(
+                best_time(lambda: lazy.load_chain('bench').latest_hash(), repeat),
+                size)
+            loaded = lazy.load_chain('bench')
+            results['file_backend_save_lazy_%d' % size] = result(
+                best_time(lambda: lazy.save_chain(loaded, 'bench'), repeat), size)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_network(nodes=4, transactions=500, timeout=60.0, seed=0):
+    """
+    Send transactions to random nodes of a fully connected network and watch the first
+    node's chain for the blocks that confirm them
+    """
+    from blokka.actors import Node
+
+    directory = tempfile.mkdtemp(prefix='blokka-bench-')
+    backend_class = type('BenchLogFileBackend', (LogFileBackend,),
+                         {'FILE_DIR': directory})
+    logging.disable(logging.INFO)
+    actors = []
+    try:
+        actors = [Node.start(node_id='bench%d' % i,
+                             backend=backend_class(fsync_every=None))
+                  for i in xrange(nodes)]
+        proxies = [a.proxy() for a in actors]
+        for p in proxies:
+            for q in proxies:
+                if p is not q:
+                    p.register_peer(q).get()
+
+        rnd = random.Random(seed)
+        batch = make_transactions(transactions, seed)
+        submitted = {}
+        confirmed = {}
+        started = time.time()
+        for transaction in batch:
+            submitted[transaction.hash] = time.time()
+            rnd.choice(proxies).register_transaction(transaction)
+
+        watched = proxies[0].chain.get()
+        deadline = started + timeout
+        scanned = 0
+        while len(confirmed) < len(submitted) and time.time() < deadline:
+            now = time.time()
+            # Rescan a few blocks back, in case a reorg replaced them
+            blocks = watched.blocks[max(scanned - 5, 0):]
+            for block in blocks:
+                for tx_hash in block.transaction_hashes():
+                    if tx_hash in submitted:
+                        confirmed.setdefault(tx_hash, now)
+            scanned = max(scanned - 5, 0) + len(blocks)
+            time.sleep(0.005)
+        elapsed = (max(confirmed.values()) if confirmed else time.time()) - started
+
+        latencies = sorted(confirmed[h] - submitted[h] for h in confirmed)
+        return {'network_%d_nodes' % nodes: result(
+            elapsed, len(confirmed),
+            nodes=nodes,
+            submitted=len(submitted),
+            confirmed_fraction=float(len(confirmed)) / len(submitted),
+            latency_p50=_percentile(latencies, 0.5),
+            latency_p95=_percentile(latencies, 0.95),
+            chain_length=watched.length)}
+    finally:
+        for a in actors:
+            a.stop()
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(directory)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_benchmarks(quick=False, max_blocks=10 ** 5):
+    """
+    :param quick: smaller sizes, for a smoke test
+    :type quick: bool
+    :param max_blocks: largest chain to time Chain and FileBackend on
+    :type max_blocks: int
+    :return: results in the JSON result format
+    :rtype: dict
+    """
+    sizes = [s for s in CHAIN_SIZES if s <= max_blocks]
+    if quick:
+        sizes = [100]
+    results = {}
+    results.update(bench_transaction_hash(1000 if quick else 10000))
+    results.update(bench_block_hash(200 if quick else 2000))
+    results.update(bench_chain_dict(sizes))
+    results.update(bench_file_backend(sizes))
+    results.update(bench_network(transactions=50 if quick else 500))
+    return {
+        'format': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': datetime.now(pytz.UTC).isoformat(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    :param results: in the JSON result format
+    :type results: dict
+    :param baseline: in the JSON result format
+    :type baseline: dict
+    :param threshold: slowdown, as a fraction, beyond which a benchmark has regressed
+    :type threshold: float
+    :return: for each benchmark in both, its name, baseline and current seconds per
+        op, and whether it has regressed
+    :rtype: list[(str, float, float, bool)]
+    """
+    if baseline.get('format') != FORMAT_VERSION:
+        raise ValueError('Baseline has result format {}, not {}'
+                         .format(baseline.get('format'), FORMAT_VERSION))
+    rows = []
+    for name in sorted(set(results['results']) & set(baseline['results'])):
+        old = _seconds_per_op(baseline['results'][name])
+        new = _seconds_per_op(results['results'][name])
+        rows.append((name, old, new, old > 0 and new > old * (1 + threshold)))
+    return rows
+
+
+def _seconds_per_op(entry):
+    return entry['seconds'] / max(entry['ops'], 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the blokka benchmarks')
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--max-blocks', type=int, default=10 ** 5,
+                        help='largest chain to benchmark (up to 10**6)')
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument('--baseline', help='compare against results in this file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown that counts as a regression (default 0.2)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(quick=args.quick, max_blocks=args.max_blocks)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = False
+        for name, old, new, slower in compare(results, baseline, args.threshold):
+            regressed = regressed or slower
+            sys.stderr.write('{:40} {:12.3e} {:12.3e} {:+7.1%}{}\n'.format(
+                name, old, new, new / old - 1 if old else 0.0,
+                '  REGRESSED' if slower else ''))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
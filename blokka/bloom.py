@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import math
+import struct
+from hashlib import sha256
+
+
+class BloomFilter(object):
+    """
+    Set membership with no false negatives and a bounded false-positive rate, in a
+    fixed number of bits
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: number of keys the error rate is sized for
+        :type capacity: int
+        :type error_rate: float
+        """
+        # Optimal sizes for the capacity and error rate
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(
+            1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        # Double hashing: the i-th index is h1 + i * h2
+        h1, h2 = struct.unpack_from('>QQ', sha256(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        """
+        :type key: str
+        """
+        for i in self._indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+
+class RollingBloomFilter(object):
+    """
+    Bloom filter that remembers at least the last `capacity` keys added: once the
+    current generation is full it becomes the previous one and a new one is started
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :type capacity: int
+        :type error_rate: float
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = None
+
+    def add(self, key):
+        """
+        :type key: str
+        """
+        if self._current.count >= self.capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+        self._current.add(key)
+
+    def update(self, keys):
+        """
+        :type keys: list[str]
+        """
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        return key in self._current or (self._previous is not None and
+                                        key in self._previous)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Canonical binary encoding.
+
+Entities are hashed, stored and sent in this encoding; JSON remains for debugging and
+export. Timestamps are fixed-width microseconds since the epoch, and JSON-like values
+(ids, amounts, block data) use a tagged encoding: one tag byte, then a fixed-width
+number, or a length prefix and the contents. Strings holding a lowercase hex SHA-256
+digest are written as the raw 32 bytes. Dict keys are sorted, so equal values always
+encode to the same bytes.
+"""
+import codecs
+import struct
+from binascii import hexlify, unhexlify
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+INT64 = struct.Struct('>q')
+UINT32 = struct.Struct('>I')
+UINT64 = struct.Struct('>Q')
+DOUBLE = struct.Struct('>d')
+
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT = b'i'
+_BIG_INT = b'I'
+_FLOAT = b'd'
+_STRING = b's'
+_HASH = b'h'
+_LIST = b'l'
+_DICT = b'm'
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+_unpack_uint32 = UINT32.unpack_from
+_unpack_int64 = INT64.unpack_from
+_unpack_double = DOUBLE.unpack_from
+_utf_8_decode = codecs.utf_8_decode
+
+
+def _is_hex_digest(value):
+    return len(value) == 64 and _HEX_DIGITS.issuperset(value)
+
+
+def timestamp_micros(timestamp):
+    """
+    :param timestamp: taken as wall-clock time, as DATEFORMAT does
+    :type timestamp: datetime.datetime
+    :return: microseconds since the epoch
+    :rtype: int
+    """
+    delta = timestamp.replace(tzinfo=None) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def micros_timestamp(micros):
+    """
+    :param micros: microseconds since the epoch
+    :type micros: int
+    :rtype: datetime.datetime
+    """
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def encode_timestamp(timestamp):
+    """
+    :type timestamp: datetime.datetime
+    :rtype: bytes
+    """
+    return INT64.pack(timestamp_micros(timestamp))
+
+
+def decode_timestamp(data, offset=0):
+    """
+    :type data: bytes
+    :type offset: int
+    :return: the (naive) timestamp and the offset after it
+    :rtype: (datetime.datetime, int)
+    """
+    return micros_timestamp(INT64.unpack_from(data, offset)[0]), offset + INT64.size
+
+
+def encode_value(value, out):
+    """
+    Append the encoding of a JSON-like value to `out`
+    :type value: None | bool | int | long | float | str | unicode | list | dict
+    :type out: list[bytes]
+    :raise ValueError: for values of any other type
+    """
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, (int, long)):
+        if -(1 << 63) <= value < (1 << 63):
+            out.append(_INT + INT64.pack(value))
+        else:
+            digits = str(value)
+            out.append(_BIG_INT + UINT32.pack(len(digits)) + digits)
+    elif isinstance(value, float):
+        out.append(_FLOAT + DOUBLE.pack(value))
+    elif isinstance(value, basestring):
+        if _is_hex_digest(value):
+            out.append(_HASH + unhexlify(value))
+        else:
+            raw = value.encode('utf-8') if isinstance(value, unicode) else value
+            out.append(_STRING + UINT32.pack(len(raw)) + raw)
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST + UINT32.pack(len(value)))
+        for item in value:
+            encode_value(item, out)
+    elif isinstance(value, dict):
+        out.append(_DICT + UINT32.pack(len(value)))
+        for key in sorted(value, key=_sort_key):
+            encode_value(key, out)
+            encode_value(value[key], out)
+    else:
+        raise ValueError('Cannot encode a {}'.format(type(value).__name__))
+
+
+def _sort_key(key):
+    return key.encode('utf-8') if isinstance(key, unicode) else key
+
+
+def decode_value(data, offset=0):
+    """
+    :type data: bytes
+    :type offset: int
+    :return: the value and the offset after it; strings come back as unicode, except
+        hex digests, which come back as str
+    :raise ValueError: on an unknown tag
+    """
+    tag = data[offset]
+    offset += 1
+    # Most frequent first: block data is mostly dicts of strings
+    if tag == _STRING:
+        length = _unpack_uint32(data, offset)[0]
+        start = offset + 4
+        return _utf_8_decode(data[start:start + length])[0], start + length
+    if tag == _DICT:
+        count = _unpack_uint32(data, offset)[0]
+        offset += 4
+        dct = {}
+        for _ in xrange(count):
+            key, offset = decode_value(data, offset)
+            dct[key], offset = decode_value(data, offset)
+        return dct, offset
+    if tag == _HASH:
+        return hexlify(data[offset:offset + 32]), offset + 32
+    if tag == _INT:
+        return _unpack_int64(data, offset)[0], offset + 8
+    if tag == _FLOAT:
+        return _unpack_double(data, offset)[0], offset + 8
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _LIST:
+        count = _unpack_uint32(data, offset)[0]
+        offset += 4
+        items = []
+        for _ in xrange(count):
+            item, offset = decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == _BIG_INT:
+        length = _unpack_uint32(data, offset)[0]
+        start = offset + 4
+        return long(data[start:start + length]), start + length
+    raise ValueError('Unknown value tag {!r} at offset {}'.format(tag, offset - 1))
+
+
+def encode_optional_uint64(value):
+    """
+    :type value: int
+    :return: a presence byte, then the value if it is not None
+    :rtype: bytes
+    """
+    if value is None:
+        return b'\x00'
+    return b'\x01' + UINT64.pack(value)
+
+
+def decode_optional_uint64(data, offset=0):
+    """
+    :type data: bytes
+    :type offset: int
+    :rtype: (int, int)
+    """
+    if data[offset:offset + 1] == b'\x00':
+        return None, offset + 1
+    return UINT64.unpack_from(data, offset + 1)[0], offset + 1 + UINT64.size
+
+
+def encode_sized(items):
+    """
+    :param items: already encoded items
+    :type items: list[bytes]
+    :return: a count, then each item with its length
+    :rtype: bytes
+    """
+    out = [UINT32.pack(len(items))]
+    for item in items:
+        out.append(UINT32.pack(len(item)))
+        out.append(item)
+    return b''.join(out)
+
+
+def decode_sized(data, offset=0):
+    """
+    Inverse of encode_sized
+    :type data: bytes
+    :type offset: int
+    :rtype: list[bytes]
+    """
+    count = UINT32.unpack_from(data, offset)[0]
+    offset += UINT32.size
+    items = []
+    for _ in xrange(count):
+        length = UINT32.unpack_from(data, offset)[0]
+        offset += UINT32.size
+        items.append(data[offset:offset + length])
+        offset += length
+    return items
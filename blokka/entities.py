@@ -2,15 +2,141 @@
 # Author(s): 'Percy Link' <percylink@gmail.com>
 import abc
 import json
+import multiprocessing
+from binascii import hexlify, unhexlify
 from datetime import datetime
 from hashlib import sha256
 
+from blokka import codec, signing
+from blokka.merkle import merkle_proof, merkle_root
+
 DATEFORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
+# Validating at least this many blocks fans hashing out across processes
+PARALLEL_VALIDATION_THRESHOLD = 2000
+VALIDATION_CHUNK_SIZE = 500
+
+
+def block_hash_prefix(timestamp, prev_hash, data, merkle_root=None):
+    """
+    The encoding a block's hash is taken over, up to where the nonce goes: the rest is
+    the nonce as 8 bytes (see nonce_suffix), or nothing for a block without one
+    :param timestamp: encoded with codec.encode_timestamp
+    :type timestamp: bytes
+    :rtype: bytes
+    """
+    out = [timestamp]
+    codec.encode_value(prev_hash, out)
+    codec.encode_value(data, out)
+    codec.encode_value(merkle_root, out)
+    return b''.join(out)
+
+
+def nonce_suffix(nonce):
+    """
+    :type nonce: int
+    :rtype: bytes
+    """
+    return codec.encode_optional_uint64(nonce)
+
+
+def block_canonical_bytes(timestamp, prev_hash, data, merkle_root=None, nonce=None):
+    """
+    The encoding a block with these fields (see Block.hash_fields) is hashed over
+    :rtype: bytes
+    """
+    return block_hash_prefix(timestamp, prev_hash, data, merkle_root) + nonce_suffix(nonce)
+
+
+def block_hash(timestamp, prev_hash, data, merkle_root=None, nonce=None):
+    """
+    Hash of a block with these fields (see Block.hash_fields)
+    :rtype: str
+    """
+    return sha256(
+        block_canonical_bytes(timestamp, prev_hash, data, merkle_root, nonce)).hexdigest()
+
+
+def difficulty_target(difficulty):
+    """
+    :param difficulty: required number of leading zero bits in a block's hash
+    :type difficulty: int
+    :return: the largest digest (as raw bytes) that meets the difficulty
+    :rtype: bytes
+    """
+    return unhexlify('%064x' % ((1 << (256 - difficulty)) - 1))
+
+
+def meets_target(block_hash, difficulty):
+    """
+    :type block_hash: str
+    :type difficulty: int
+    :rtype: bool
+    """
+    return unhexlify(block_hash) <= difficulty_target(difficulty)
+
+
+def _hash_chunk(fields):
+    return [block_hash(*f) for f in fields]
+
+
+def recompute_hashes(blocks, processes=None):
+    """
+    Recompute the hashes of `blocks`, across a process pool if there are at least
+    PARALLEL_VALIDATION_THRESHOLD of them
+    :type blocks: list[Block]
+    :param processes: pool size (default: one per CPU; 1: no pool)
+    :type processes: int
+    :rtype: list[str]
+    """
+    fields = [b.hash_fields() for b in blocks]
+    if processes == 1 or len(fields) < PARALLEL_VALIDATION_THRESHOLD:
+        return _hash_chunk(fields)
+    chunks = [fields[i:i + VALIDATION_CHUNK_SIZE]
+              for i in xrange(0, len(fields), VALIDATION_CHUNK_SIZE)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return [h for chunk in pool.map(_hash_chunk, chunks) for h in chunk]
+    finally:
+        pool.terminate()
+
+
+def validate_blocks(blocks, height=0, prev_hash=None, difficulty=None, processes=None):
+    """
+    Check that each block's hash is what its fields hash to, that it links to the block
+    before it, that its Merkle root matches its transactions and, given a difficulty,
+    that it carries enough proof of work
+    :type blocks: list[Block]
+    :param height: height of the first block, for error messages
+    :type height: int
+    :param prev_hash: hash the first block must link to (None: not checked)
+    :type prev_hash: str
+    :type difficulty: int
+    :param processes: see recompute_hashes
+    :type processes: int
+    :raise ValueError: at the first invalid block
+    """
+    computed_hashes = recompute_hashes(blocks, processes)
+    for i, (block, computed) in enumerate(zip(blocks, computed_hashes)):
+        if block.hash != computed:
+            raise ValueError('Block at height {} has hash {} but hashes to {}'
+                             .format(height + i, block.hash, computed))
+        if prev_hash is not None and block.prev_hash != prev_hash:
+            raise ValueError("Block at height {} does not link to the block before it"
+                             .format(height + i))
+        if not block.has_valid_merkle_root():
+            raise ValueError('Block at height {} has the wrong Merkle root'
+                             .format(height + i))
+        if difficulty is not None and not meets_target(block.hash, difficulty):
+            raise ValueError('Block at height {} does not meet difficulty {}'
+                             .format(height + i, difficulty))
+        prev_hash = block.hash
+
 
 class JSONSerializable(object):
 
     __metaclass__ = abc.ABCMeta
+    __slots__ = ()
 
     @abc.abstractmethod
     def to_dict(self):
@@ -30,6 +156,8 @@ class JSONSerializable(object):
 
 class ObjectEqualMixin(object):
 
+    __slots__ = ()
+
     def __eq__(self, other):
         return isinstance(other, self.__class__) and other.__dict__ == self.__dict__
 
@@ -38,28 +166,167 @@ class ObjectEqualMixin(object):
 
 
 class BaseEntity(JSONSerializable, ObjectEqualMixin):
-    pass
+    __slots__ = ()
+
+
+class ValueEntity(BaseEntity):
+    """
+    Immutable entity identified by a hash over its canonical encoding (see
+    blokka.codec). Two are equal when their hashes, then their encodings, are.
+    """
 
+    __slots__ = ()
 
-class Transaction(BaseEntity):
+    def _init(self, **fields):
+        for name, value in fields.iteritems():
+            object.__setattr__(self, name, value)
 
-    def __init__(self, seller_id, buyer_id, timestamp, amount):
-        self.seller_id = seller_id
-        self.buyer_id = buyer_id
-        self.timestamp = timestamp
-        self.amount = amount
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def _memoized(self, name, compute):
+        value = getattr(self, name, None)
+        if value is None:
+            value = compute()
+            object.__setattr__(self, name, value)
+        return value
+
+    @abc.abstractmethod
+    def canonical_bytes(self):
+        pass
+
+    @abc.abstractmethod
+    def to_bytes(self):
+        pass
+
+    @classmethod
+    def from_bytes(cls, data):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__) and self.hash == other.hash and
+                self.canonical_bytes() == other.canonical_bytes())
+
+    def __hash__(self):
+        return hash(self.hash)
+
+
+class Transaction(ValueEntity):
+
+    __slots__ = ('seller_id', 'buyer_id', 'timestamp', 'amount', 'fee', 'signature',
+                 '_bytes', '_hash')
+
+    def __init__(self, seller_id, buyer_id, timestamp, amount, fee=None, signature=None):
+        """
+        :type seller_id: str
+        :type buyer_id: str
+        :type timestamp: datetime.datetime
+        :type amount: float
+        :param fee: offered to whoever mines the transaction into a block; part of the
+            transaction's hash when set
+        :type fee: float
+        :param signature: hex encoded signature over signed_bytes by the key buyer_id
+            names (see blokka.signing and signed); part of the transaction's hash when
+            set
+        :type signature: str
+        """
+        self._init(seller_id=seller_id, buyer_id=buyer_id, timestamp=timestamp,
+                   amount=amount, fee=fee, signature=signature)
+
+    def __reduce__(self):
+        return self.__class__, (self.seller_id, self.buyer_id, self.timestamp,
+                                self.amount, self.fee, self.signature)
+
+    def signed_bytes(self):
+        """
+        :return: what the signature is over: the canonical encoding without it
+        :rtype: bytes
+        """
+        out = [codec.encode_timestamp(self.timestamp)]
+        for value in (self.seller_id, self.buyer_id, self.amount, self.fee):
+            codec.encode_value(value, out)
+        return b''.join(out)
+
+    def canonical_bytes(self):
+        """
+        :rtype: bytes
+        """
+        def encode():
+            if self.signature is None:
+                return self.signed_bytes()
+            out = [self.signed_bytes()]
+            codec.encode_value(self.signature, out)
+            return b''.join(out)
+        return self._memoized('_bytes', encode)
+
+    def signed(self, secret):
+        """
+        :param secret: the secret key for the account buyer_id names
+        :type secret: bytes
+        :return: a copy of this transaction, signed
+        :rtype: Transaction
+        """
+        return Transaction(seller_id=self.seller_id, buyer_id=self.buyer_id,
+                           timestamp=self.timestamp, amount=self.amount, fee=self.fee,
+                           signature=hexlify(signing.sign(secret, self.signed_bytes())))
+
+    def has_valid_signature(self):
+        """
+        :return: whether the transaction is signed by the key buyer_id names; this takes
+            milliseconds, see blokka.verification
+        :rtype: bool
+        """
+        if self.signature is None:
+            return False
+        try:
+            public = unhexlify(self.buyer_id)
+            signature = unhexlify(self.signature)
+        except (TypeError, ValueError):
+            return False
+        return signing.verify(public, self.signed_bytes(), signature)
 
     @property
     def hash(self):
-        return sha256(self.to_json()).hexdigest()
+        return self._memoized('_hash', lambda: sha256(self.canonical_bytes()).hexdigest())
+
+    def to_bytes(self):
+        """
+        :rtype: bytes
+        """
+        return self.canonical_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :type data: bytes
+        :rtype: Transaction
+        """
+        timestamp, offset = codec.decode_timestamp(data)
+        seller_id, offset = codec.decode_value(data, offset)
+        buyer_id, offset = codec.decode_value(data, offset)
+        amount, offset = codec.decode_value(data, offset)
+        fee, offset = codec.decode_value(data, offset)
+        signature = None
+        if offset < len(data):
+            signature, offset = codec.decode_value(data, offset)
+        return cls(seller_id=seller_id, buyer_id=buyer_id, timestamp=timestamp,
+                   amount=amount, fee=fee, signature=signature)
 
     def to_dict(self):
-        return {
+        dct = {
             'seller_id': self.seller_id,
             'buyer_id': self.buyer_id,
             'timestamp': self.timestamp.strftime(DATEFORMAT),
             'amount': self.amount
         }
+        if self.fee is not None:
+            dct['fee'] = self.fee
+        if self.signature is not None:
+            dct['signature'] = self.signature
+        return dct
 
     @classmethod
     def from_dict(cls, dct):
@@ -67,52 +334,215 @@ class Transaction(BaseEntity):
             seller_id=dct['seller_id'],
             buyer_id=dct['buyer_id'],
             timestamp=datetime.strptime(dct['timestamp'], DATEFORMAT),
-            amount=dct['amount']
+            amount=dct['amount'],
+            fee=dct.get('fee'),
+            signature=dct.get('signature')
         )
 
 
-class Block(BaseEntity):
+class Block(ValueEntity):
+
+    __slots__ = ('timestamp', 'prev_hash', 'data', 'merkle_root', 'nonce', 'hash',
+                 '_bytes')
 
-    def __init__(self, timestamp, prev_hash, data):
+    def __init__(self, timestamp, prev_hash, data, merkle_root=None, nonce=None,
+                 hash=None):
         """
         :type timestamp: datetime.datetime
         :type prev_hash: str
         :type data: dict
+        :param merkle_root: root of the Merkle tree over the hashes of the transactions
+            in `data`, if it holds any; part of the block's hash when set
+        :type merkle_root: str
+        :param nonce: proof-of-work nonce (see blokka.mining); part of the block's hash
+            when set
+        :type nonce: int
+        :param hash: the block's hash as stored or sent, which is trusted until the
+            chain is validated (default: computed from the other fields)
+        :type hash: str
+        """
+        self._init(timestamp=timestamp, prev_hash=prev_hash, data=data,
+                   merkle_root=merkle_root, nonce=nonce)
+        self._init(hash=hash if hash is not None else self.compute_hash())
+
+    def __reduce__(self):
+        return self.__class__, (self.timestamp, self.prev_hash, self.data,
+                                self.merkle_root, self.nonce, self.hash)
+
+    def hash_fields(self):
+        """
+        The arguments to block_hash for this block
+        :rtype: tuple
+        """
+        return (codec.encode_timestamp(self.timestamp), self.prev_hash, self.data,
+                self.merkle_root, self.nonce)
+
+    def hash_prefix(self):
+        """
+        The encoding the block's hash is taken over, up to where the nonce goes. Miners
+        hash this once and only add the nonce for each attempt.
+        :rtype: bytes
+        """
+        return block_hash_prefix(*self.hash_fields()[:4])
+
+    def canonical_bytes(self):
+        """
+        Memoized on first use, not at construction, so blocks that are only ever
+        hashed do not keep a second copy of their data
+        :rtype: bytes
+        """
+        return self._memoized('_bytes', lambda: block_canonical_bytes(*self.hash_fields()))
+
+    def to_bytes(self):
+        """
+        The block's hash as stored or sent, then its canonical encoding
+        :rtype: bytes
+        """
+        out = []
+        codec.encode_value(self.hash, out)
+        out.append(self.canonical_bytes())
+        return b''.join(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :type data: bytes
+        :rtype: Block
+        """
+        block_hash, offset = codec.decode_value(data)
+        timestamp, offset = codec.decode_timestamp(data, offset)
+        prev_hash, offset = codec.decode_value(data, offset)
+        block_data, offset = codec.decode_value(data, offset)
+        root, offset = codec.decode_value(data, offset)
+        nonce, offset = codec.decode_optional_uint64(data, offset)
+        return cls(timestamp=timestamp, prev_hash=prev_hash, data=block_data,
+                   merkle_root=root, nonce=nonce, hash=block_hash)
+
+    def compute_hash(self):
         """
-        self.timestamp = timestamp
-        self.prev_hash = prev_hash
-        self.data = data
+        :rtype: str
+        """
+        return block_hash(*self.hash_fields())
 
-        self.hash = self.__make_hash()
+    def header(self):
+        """
+        :return: this block without its data, carrying the hash it had with it; enough
+            to link the chain, but not to validate
+        :rtype: Block
+        """
+        return Block(timestamp=self.timestamp, prev_hash=self.prev_hash, data=None,
+                     merkle_root=self.merkle_root, nonce=self.nonce, hash=self.hash)
 
-    def __make_hash(self):
-        raw = [self.timestamp.strftime(DATEFORMAT), self.prev_hash, self.data]
-        return sha256(json.dumps(raw)).hexdigest()
+    def is_header(self):
+        """
+        :return: whether this is a header from header(), rather than a whole block
+        :rtype: bool
+        """
+        return self.data is None and self.hash != self.compute_hash()
 
     def to_dict(self):
-        return {
+        dct = {
             'timestamp': self.timestamp.strftime(DATEFORMAT),
             'prev_hash': self.prev_hash,
             'hash': self.hash,
             'data': self.data
         }
+        if self.merkle_root is not None:
+            dct['merkle_root'] = self.merkle_root
+        if self.nonce is not None:
+            dct['nonce'] = self.nonce
+        return dct
 
     @classmethod
     def from_dict(cls, dct):
         return cls(
             timestamp=datetime.strptime(dct['timestamp'], DATEFORMAT),
             prev_hash=dct['prev_hash'],
-            data=dct['data']
+            data=dct['data'],
+            merkle_root=dct.get('merkle_root'),
+            nonce=dct.get('nonce'),
+            hash=dct.get('hash')
         )
 
+    def transaction_dicts(self):
+        """
+        Transactions in this block's data, as mined by Node.mine_block: a dict (or a
+        JSON object) mapping transaction hashes to transaction dicts. Data of any other
+        shape holds no transactions.
+        :rtype: dict
+        """
+        data = self.data
+        if isinstance(data, basestring):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                return {}
+        if not isinstance(data, dict):
+            return {}
+        return {tx_hash: tx for tx_hash, tx in data.iteritems()
+                if isinstance(tx, dict) and
+                all(k in tx for k in ('seller_id', 'buyer_id', 'timestamp', 'amount'))}
+
+    def transaction_hashes(self):
+        """
+        Hashes of this block's transactions, in Merkle tree leaf order
+        :rtype: list[str]
+        """
+        return sorted(self.transaction_dicts())
+
+    def merkle_proof(self, tx_hash):
+        """
+        Inclusion proof for one of this block's transactions; check it against
+        merkle_root with blokka.merkle.verify_proof
+        :type tx_hash: str
+        :rtype: list[(str, str)]
+        """
+        return merkle_proof(self.transaction_hashes(), tx_hash)
+
+    def has_valid_merkle_root(self):
+        """
+        :return: whether merkle_root, if set, matches the transactions in data, and
+            each transaction hashes to the hash it is listed under
+        :rtype: bool
+        """
+        if self.merkle_root is None:
+            return True
+        transactions = self.transaction_dicts()
+        for tx_hash, dct in transactions.iteritems():
+            try:
+                if Transaction.from_dict(dct).hash != tx_hash:
+                    return False
+            except (KeyError, TypeError, ValueError):
+                return False
+        return self.merkle_root == merkle_root(sorted(transactions))
+
 
 class Chain(BaseEntity):
+    """
+    A sequence of blocks, changed in place as blocks are added, rolled back and pruned,
+    so that a long chain, or one mapped from a backend (see
+    blokka.backends.MappedBlocks), is never copied to change its tip. Unlike the
+    blocks in it, a chain is mutable and unhashable.
+    """
+
+    __slots__ = ('blocks', '_verified')
+
+    LOCATOR_DENSE = 10
 
     def __init__(self, blocks):
         """
+        :param blocks: a list, or any list-like sequence supporting append and slicing
+            such as blokka.backends.MappedBlocks
         :type blocks: list[Block]
         """
         self.blocks = blocks
+        # Length and tip hash of the prefix last found valid by validate()
+        self._verified = (0, None)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and other.blocks == self.blocks
+
+    __hash__ = None
 
     def to_dict(self):
         return {
@@ -125,12 +555,27 @@ class Chain(BaseEntity):
             blocks=[Block.from_dict(b) for b in dct['blocks']]
         )
 
+    def to_bytes(self):
+        """
+        :return: the number of blocks, then each block's encoding with its length
+        :rtype: bytes
+        """
+        return codec.encode_sized([b.to_bytes() for b in self.blocks])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :type data: bytes
+        :rtype: Chain
+        """
+        return cls(blocks=[Block.from_bytes(b) for b in codec.decode_sized(data)])
+
     def add_block(self, block):
         """
         Add a block to the end of the chain
         :type block: Block
         """
-        if len(self.blocks) > 0 and block.prev_hash != self.blocks[-1].hash:
+        if len(self.blocks) > 0 and block.prev_hash != self.latest_hash():
             raise ValueError("New block's prev_hash must match the hash of the current "
                              "last block in the chain")
         self.blocks.append(block)
@@ -140,7 +585,152 @@ class Chain(BaseEntity):
         Remove last block in the chain
         """
         if len(self.blocks) > 0:
-            self.blocks = self.blocks[:-1]
+            self._truncate(len(self.blocks) - 1)
+
+    def _truncate(self, height):
+        """
+        Drop the blocks from `height` onwards in place, so neither the rest of the chain
+        is copied nor a lazy sequence replaced by a list
+        :type height: int
+        """
+        if hasattr(self.blocks, 'truncate'):
+            self.blocks.truncate(height)
+        else:
+            del self.blocks[height:]
+
+    @property
+    def pruned_height(self):
+        """
+        Number of blocks at the start of the chain that are only headers (see prune)
+        :rtype: int
+        """
+        low, high = 0, self.length
+        while low < high:
+            middle = (low + high) // 2
+            if self.blocks[middle].is_header():
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def prune(self, height):
+        """
+        Keep only the headers of the blocks below `height`. They still link the chain
+        by hash, and are enough to find common prefixes with other chains, but their
+        data is gone. Their data stays in the backend until it is pruned there too (see
+        blokka.backends.ChainBackend.prune).
+        :type height: int
+        :return: the blocks whose data was dropped
+        :rtype: list[Block]
+        """
+        start = self.pruned_height
+        if height > self.length:
+            raise ValueError('Cannot prune beyond the end of the chain')
+        pruned = [self.blocks[h] for h in xrange(start, height)]
+        if hasattr(self.blocks, 'prune'):
+            # A lazy sequence serves the headers itself, without decoding the rest
+            self.blocks.prune(height)
+        else:
+            self.blocks[start:height] = [block.header() for block in pruned]
+        return pruned
+
+    def hash_at(self, height):
+        """
+        Hash of the block at `height`, without decoding it if the blocks are a lazy
+        sequence that can look hashes up directly
+        :type height: int
+        :rtype: str
+        """
+        if hasattr(self.blocks, 'hash_at'):
+            return self.blocks.hash_at(height)
+        return self.blocks[height].hash
+
+    def locator(self):
+        """
+        Block locator: (height, hash) pairs for the last LOCATOR_DENSE blocks, then at
+        exponentially growing steps back to the first block
+        :rtype: list[(int, str)]
+        """
+        heights = []
+        height = self.length - 1
+        step = 1
+        while height > 0:
+            heights.append(height)
+            if len(heights) >= self.LOCATOR_DENSE:
+                step *= 2
+            height -= step
+        if self.length > 0:
+            heights.append(0)
+        return [(h, self.hash_at(h)) for h in heights]
+
+    def common_length(self, locator):
+        """
+        Length of the prefix this chain shares with the chain a locator was made from.
+        Blocks link by hash, so the highest matching locator entry bounds it from below.
+        :type locator: list[(int, str)]
+        :rtype: int
+        """
+        for height, block_hash in locator:
+            if height < self.length and self.hash_at(height) == block_hash:
+                return height + 1
+        return 0
+
+    def fork_height(self, height, blocks):
+        """
+        First height at which `blocks`, placed from `height` onwards, differ from this
+        chain; None if this chain already has all of them
+        :type height: int
+        :type blocks: list[Block]
+        :rtype: int
+        """
+        for i, block in enumerate(blocks):
+            if height + i >= self.length or self.hash_at(height + i) != block.hash:
+                return height + i
+        return None
+
+    def replace_from(self, height, blocks):
+        """
+        Replace the blocks from `height` onwards with `blocks`. Linkage is checked
+        before anything is changed.
+        :type height: int
+        :type blocks: list[Block]
+        """
+        prev_hash = self.hash_at(height - 1) if height > 0 else None
+        for block in blocks:
+            if prev_hash is not None and block.prev_hash != prev_hash:
+                raise ValueError("Each new block's prev_hash must match the hash of the "
+                                 "block before it")
+            prev_hash = block.hash
+        self._truncate(height)
+        for block in blocks:
+            self.blocks.append(block)
+
+    @property
+    def verified_height(self):
+        """
+        Number of blocks at the start of the chain that validate() has checked and that
+        have not been replaced since
+        :rtype: int
+        """
+        length, tip_hash = self._verified
+        if length > self.length or (length > 0 and self.hash_at(length - 1) != tip_hash):
+            return 0
+        return length
+
+    def validate(self, difficulty=None, processes=None):
+        """
+        Validate the blocks after verified_height (see validate_blocks), then move the
+        checkpoint up to the end of the chain. Headers of pruned blocks are trusted.
+        :type difficulty: int
+        :type processes: int
+        :raise ValueError: at the first invalid block
+        """
+        start = max(self.verified_height, self.pruned_height)
+        prev_hash = self.hash_at(start - 1) if start > 0 else None
+        validate_blocks([self.blocks[h] for h in xrange(start, self.length)],
+                        height=start, prev_hash=prev_hash, difficulty=difficulty,
+                        processes=processes)
+        self._verified = (self.length, self.latest_hash())
 
     def latest_hash(self):
         """
@@ -150,7 +740,7 @@ class Chain(BaseEntity):
         if len(self.blocks) == 0:
             return None
         else:
-            return self.blocks[-1].hash
+            return self.hash_at(len(self.blocks) - 1)
 
     @property
     def length(self):
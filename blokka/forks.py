@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Forks: blocks off the main chain, and the rules for choosing between branches.
+
+A node's main chain is its Chain; a BlockTree indexes the blocks it has seen on other
+branches, by hash, so a branch that overtakes the main chain later can be switched to
+without the peer resending it. A fork choice rule compares two branches from the point
+where they fork, so a reorg only ever looks at the blocks after that point.
+"""
+from blokka.entities import Transaction
+
+# Keep side branches that fork off at most this many blocks below the tip
+MAX_FORK_DEPTH = 100
+
+
+def block_work(block_hash):
+    """
+    The work a block's hash demonstrates: the expected number of hashes it takes to find
+    a hash this small
+    :type block_hash: str
+    :rtype: int
+    """
+    return (1 << 256) // (int(block_hash, 16) + 1)
+
+
+def longest_chain(current, candidate):
+    """
+    Fork choice: the branch with more blocks; the current one on a tie
+    :param current: blocks of the main chain after the fork point
+    :type current: list[blokka.entities.Block]
+    :param candidate: blocks of the other branch after the fork point
+    :type candidate: list[blokka.entities.Block]
+    :return: whether to switch to the candidate
+    :rtype: bool
+    """
+    return len(candidate) > len(current)
+
+
+def most_work(current, candidate):
+    """
+    Fork choice: the branch whose blocks add up to more work (see block_work); the
+    current one on a tie
+    :type current: list[blokka.entities.Block]
+    :type candidate: list[blokka.entities.Block]
+    :rtype: bool
+    """
+    return (sum(block_work(b.hash) for b in candidate) >
+            sum(block_work(b.hash) for b in current))
+
+
+def block_transactions(block):
+    """
+    :type block: blokka.entities.Block
+    :return: the transactions in a block whose hashes match what they are listed under
+    :rtype: list[blokka.entities.Transaction]
+    """
+    transactions = []
+    for tx_hash, dct in block.transaction_dicts().iteritems():
+        try:
+            transaction = Transaction.from_dict(dct)
+        except (KeyError, ValueError):
+            continue
+        if transaction.hash == tx_hash:
+            transactions.append(transaction)
+    return transactions
+
+
+class BlockTree(object):
+    """
+    Blocks on side branches, by hash, with the height each is at
+    """
+
+    def __init__(self, max_depth=MAX_FORK_DEPTH):
+        """
+        :param max_depth: see prune
+        :type max_depth: int
+        """
+        self.max_depth = max_depth
+        self._blocks = {}
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self._blocks
+
+    def add(self, block, height):
+        """
+        :type block: blokka.entities.Block
+        :type height: int
+        """
+        self._blocks[block.hash] = (block, height)
+
+    def height_of(self, block_hash):
+        """
+        :type block_hash: str
+        :rtype: int
+        """
+        entry = self._blocks.get(block_hash)
+        return entry[1] if entry is not None else None
+
+    def branch(self, tip_hash, chain):
+        """
+        Follow a side branch back from its tip to where it leaves `chain`
+        :type tip_hash: str
+        :type chain: blokka.entities.Chain
+        :return: the height the branch forks off at and its blocks from there, or None
+            if it does not lead back to the chain
+        :rtype: (int, list[blokka.entities.Block])
+        """
+        blocks = []
+        block_hash = tip_hash
+        while block_hash in self._blocks:
+            block, height = self._blocks[block_hash]
+            blocks.append(block)
+            block_hash = block.prev_hash
+            if height == 0:
+                break
+            if chain.length >= height and chain.hash_at(height - 1) == block_hash:
+                break
+        else:
+            return None
+        blocks.reverse()
+        return height, blocks
+
+    def remove(self, blocks):
+        """
+        :type blocks: list[blokka.entities.Block]
+        """
+        for block in blocks:
+            self._blocks.pop(block.hash, None)
+
+    def prune(self, tip_height):
+        """
+        Forget blocks more than max_depth below the tip
+        :type tip_height: int
+        """
+        floor = tip_height - self.max_depth
+        for block_hash in [h for h, (_, height) in self._blocks.iteritems()
+                           if height < floor]:
+            del self._blocks[block_hash]
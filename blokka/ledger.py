@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Account balances and histories, kept up to date block by block.
+
+A transaction moves its amount from the buyer to the seller. Fees are not part of
+balances: blocks don't say who mined them, so there is nobody to credit them to.
+
+The ledger follows a chain: apply_block for each block added to the tip and
+revert_block, newest first, for each block rolled back. Both only touch the accounts
+in the block. Each account's history is kept in height order, so a balance is a dict
+lookup and the history from a given height a binary search.
+
+Snapshots save the ledger with the height and tip hash it was built up to; a node
+loads one and applies only the blocks added since, rather than replaying its chain
+from the first block. Once a chain is pruned (see Chain.prune) a snapshot is the only
+record of the state before the pruned height, and history from below it is forgotten.
+"""
+import json
+import os
+from bisect import bisect_left
+
+from blokka.forks import block_transactions
+
+
+class Ledger(object):
+
+    def __init__(self):
+        self.height = 0
+        # Hash of the last block applied
+        self.tip_hash = None
+        # History from below this height has been forgotten
+        self.history_height = 0
+        self._balances = {}
+        # account -> [(height, transaction hash, change in balance)], by height
+        self._history = {}
+        # account -> heights of its history entries, for searching
+        self._heights = {}
+
+    def __len__(self):
+        return len(self._balances)
+
+    def balance(self, account):
+        """
+        :type account: str
+        :rtype: float
+        """
+        return self._balances.get(account, 0)
+
+    def balances(self):
+        """
+        :return: balance of each account that has taken part in a transaction
+        :rtype: dict
+        """
+        return dict(self._balances)
+
+    def history(self, account, since=0):
+        """
+        :type account: str
+        :param since: leave out blocks below this height
+        :type since: int
+        :return: (height, transaction hash, change in balance) for each transaction the
+            account took part in, oldest first; none from below history_height
+        :rtype: list[(int, str, float)]
+        """
+        entries = self._history.get(account, [])
+        return entries[bisect_left(self._heights.get(account, []), since):]
+
+    def apply_block(self, block):
+        """
+        Add the transactions of the block after the last one applied
+        :type block: blokka.entities.Block
+        """
+        if self.height > 0 and block.prev_hash != self.tip_hash:
+            raise ValueError('Block {} does not follow block {}'.format(
+                block.hash, self.tip_hash))
+        if block.is_header():
+            raise ValueError('Block {} has been pruned'.format(block.hash))
+        for transaction in block_transactions(block):
+            self._record(transaction.buyer_id, transaction.hash, -transaction.amount)
+            self._record(transaction.seller_id, transaction.hash, transaction.amount)
+        self.height += 1
+        self.tip_hash = block.hash
+
+    def _record(self, account, transaction_hash, change):
+        self._balances[account] = self._balances.get(account, 0) + change
+        self._history.setdefault(account, []).append(
+            (self.height, transaction_hash, change))
+        self._heights.setdefault(account, []).append(self.height)
+
+    def revert_block(self, block):
+        """
+        Take off the transactions of the last block applied
+        :type block: blokka.entities.Block
+        """
+        if self.height == 0 or block.hash != self.tip_hash:
+            raise ValueError('Block {} is not the last one applied'.format(block.hash))
+        self.height -= 1
+        for transaction in block_transactions(block):
+            for account in (transaction.buyer_id, transaction.seller_id):
+                self._unrecord(account)
+        self.tip_hash = block.prev_hash
+
+    def _unrecord(self, account):
+        history = self._history[account]
+        _, _, change = history.pop()
+        self._heights[account].pop()
+        self._balances[account] -= change
+        if not history:
+            del self._history[account]
+            del self._heights[account]
+            if self._balances[account] == 0:
+                del self._balances[account]
+
+    def forget(self, height):
+        """
+        Drop the history from below `height`; balances are kept
+        :type height: int
+        """
+        for account in self._history.keys():
+            start = bisect_left(self._heights[account], height)
+            if start:
+                del self._history[account][:start]
+                del self._heights[account][:start]
+                if not self._history[account]:
+                    # Nothing left to revert: the balance is settled
+                    del self._history[account]
+                    del self._heights[account]
+        self.history_height = max(self.history_height, height)
+
+    def to_dict(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'height': self.height,
+            'tip_hash': self.tip_hash,
+            'history_height': self.history_height,
+            'balances': self._balances,
+            'history': self._history,
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        """
+        :type dct: dict
+        :rtype: Ledger
+        """
+        ledger = cls()
+        ledger.height = dct['height']
+        ledger.tip_hash = dct['tip_hash']
+        ledger.history_height = dct.get('history_height', 0)
+        ledger._balances = dict(dct['balances'])
+        ledger._history = {account: [tuple(entry) for entry in entries]
+                           for account, entries in dct['history'].iteritems()}
+        ledger._heights = {account: [entry[0] for entry in entries]
+                           for account, entries in ledger._history.iteritems()}
+        return ledger
+
+    def save(self, path):
+        """
+        Write a snapshot, through a temporary file so a reader never sees half of one
+        :type path: str
+        """
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :type path: str
+        :return: the snapshot at `path`, or None if there is none
+        :rtype: Ledger
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        with f:
+            return cls.from_dict(json.load(f))
+
+    def follows(self, chain):
+        """
+        :type chain: blokka.entities.Chain
+        :return: whether the blocks applied are the start of `chain`
+        :rtype: bool
+        """
+        if self.height == 0:
+            return True
+        return (self.height <= chain.length and
+                chain.hash_at(self.height - 1) == self.tip_hash)
+
+    @classmethod
+    def for_chain(cls, chain, snapshot=None):
+        """
+        :type chain: blokka.entities.Chain
+        :param snapshot: a ledger to start from, if it is for a prefix of `chain`
+        :type snapshot: Ledger
+        :return: the ledger of the whole chain
+        :rtype: Ledger
+        """
+        ledger = snapshot if snapshot is not None and snapshot.follows(chain) else cls()
+        for height in xrange(ledger.height, chain.length):
+            ledger.apply_block(chain.blocks[height])
+        return ledger
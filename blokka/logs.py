@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Logging that stays off the actors' threads.
+
+Loggers from build_logger hand their records to a queue and return; one listener
+thread per process takes them off the queue and writes them out. A slow or blocked
+stdout then holds up the listener, never a node. The queue is bounded: when it is
+full, records are dropped and counted rather than waited for.
+
+Messages are formatted by the listener, so callers should pass %-style arguments
+rather than formatting themselves, and pass values that won't change afterwards
+(hashes, counts), not live objects. Messages logged once per transaction or block
+can arrive in floods; RateLimitFilter lets a burst of each through and then sums up
+the rest.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from Queue import Full, Queue
+
+FORMAT = '%(asctime)-20s - %(name)-10s - %(levelname)-10s - %(message)s'
+QUEUE_SIZE = 10000
+
+_lock = threading.Lock()
+_handler = None
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue, for a QueueListener to handle, without blocking
+    """
+
+    def __init__(self, queue):
+        """
+        :type queue: Queue.Queue
+        """
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Make a record safe to hand to another thread. Tracebacks refer to frames that
+        will have moved on by the time the listener gets to them, so they are rendered
+        here; everything else is left for the listener.
+        :type record: logging.LogRecord
+        :rtype: logging.LogRecord
+        """
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """
+    Takes records off a queue on a thread of its own and passes them to handlers
+    """
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        """
+        :type queue: Queue.Queue
+        :type handlers: logging.Handler
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Handle the records queued so far, then stop
+        """
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                return
+            self.handle(record)
+
+    def handle(self, record):
+        """
+        :type record: logging.LogRecord
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class _ProcessQueueHandler(QueueHandler):
+    """
+    A QueueHandler that starts its listener on first use in each process: a forked
+    child inherits the queue but not the listener's thread.
+    """
+
+    def __init__(self, *handlers):
+        QueueHandler.__init__(self, Queue(QUEUE_SIZE))
+        self.handlers = handlers
+        self.listener = None
+        self._pid = None
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        QueueHandler.emit(self, record)
+
+    def _start_listener(self):
+        with _lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = Queue(QUEUE_SIZE)
+            self.listener = QueueListener(self.queue, *self.handlers)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def flush(self):
+        """
+        Write out everything queued so far
+        """
+        if self._pid == os.getpid() and self.listener is not None:
+            self.listener.stop()
+            self.listener.start()
+
+    def close(self):
+        if self._pid == os.getpid() and self.listener is not None:
+            self.listener.stop()
+        QueueHandler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `burst` records with the same logger and message template
+    every `interval` seconds. The first record let through after some were held back
+    says how many were.
+    """
+    # Windows kept at most; messages formatted by the caller would each get their own
+    MAX_WINDOWS = 1000
+
+    def __init__(self, burst=10, interval=1.0, clock=time.time):
+        """
+        :type burst: int
+        :type interval: float
+        :param clock: returns the time in seconds
+        :type clock: () -> float
+        """
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        # (logger, template) -> [window start, records let through, records held back]
+        self._windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = self.clock()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            if window is None and len(self._windows) >= self.MAX_WINDOWS:
+                self._windows.clear()
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = '%s (%d similar messages suppressed)' % (record.msg,
+                                                                      suppressed)
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+def queue_handler():
+    """
+    :return: the handler shared by loggers from build_logger, which writes to stdout
+        from a listener thread
+    :rtype: QueueHandler
+    """
+    global _handler
+    with _lock:
+        if _handler is None:
+            stream_handler = logging.StreamHandler(stream=sys.stdout)
+            stream_handler.setFormatter(logging.Formatter(FORMAT))
+            _handler = _ProcessQueueHandler(stream_handler)
+        return _handler
+
+
+def build_logger(name, level=logging.DEBUG, rate_limit=None):
+    """
+    A logger whose records go through the shared queue_handler. Calling this again
+    with the same name returns the same logger, without adding handlers again.
+    :type name: str
+    :type level: int
+    :param rate_limit: if given, attached to the logger, unless it already has one
+    :type rate_limit: RateLimitFilter
+    :rtype: logging.Logger
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    handler = queue_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    if rate_limit is not None and not any(isinstance(f, RateLimitFilter)
+                                          for f in logger.filters):
+        logger.addFilter(rate_limit)
+    return logger
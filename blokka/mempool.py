@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Pending transactions, waiting to be mined into a block.
+
+The pool is capped in number of transactions and in bytes of canonical encoding. It keeps
+two heaps of the same entries: best first, for block assembly, and worst first, for
+eviction. Removing a transaction only drops it from the index; its heap entries are
+skipped when met and cleared out once they outnumber the live ones.
+"""
+import heapq
+from collections import Mapping, OrderedDict
+
+# Orderings: highest fee first (oldest first among equal fees), or oldest first
+ORDER_FEE = 'fee'
+ORDER_AGE = 'age'
+
+
+class Mempool(Mapping):
+    """
+    Transactions by hash, as a read-only mapping
+    """
+
+    def __init__(self, max_transactions=None, max_bytes=None, order=ORDER_FEE,
+                 confirmed_memory=10000):
+        """
+        :param max_transactions: None: no limit
+        :type max_transactions: int
+        :param max_bytes: limit on the total size of the transactions' canonical
+            encodings (None: no limit)
+        :type max_bytes: int
+        :param order: ORDER_FEE or ORDER_AGE
+        :param confirmed_memory: number of confirmed transaction hashes to remember, so
+            transactions still being gossiped are not taken in again
+        :type confirmed_memory: int
+        """
+        if order not in (ORDER_FEE, ORDER_AGE):
+            raise ValueError('Unknown mempool order {}'.format(order))
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.order = order
+        self.confirmed_memory = confirmed_memory
+        self.nbytes = 0
+        self.evicted = 0
+        # hash -> [best key, worst key, hash, transaction, size]
+        self._entries = {}
+        self._best = []
+        self._worst = []
+        self._confirmed = OrderedDict()
+        self._seq = 0
+
+    def __getitem__(self, tx_hash):
+        return self._entries[tx_hash][3]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._entries
+
+    def knows(self, tx_hash):
+        """
+        :return: whether the transaction is pending or was recently confirmed
+        :rtype: bool
+        """
+        return tx_hash in self._entries or tx_hash in self._confirmed
+
+    def _keys(self, transaction):
+        self._seq += 1
+        if self.order == ORDER_AGE:
+            return (self._seq,), (-self._seq,)
+        fee = transaction.fee or 0
+        return (-fee, self._seq), (fee, -self._seq)
+
+    def _full(self):
+        return ((self.max_transactions is not None and
+                 len(self._entries) > self.max_transactions) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes))
+
+    def add(self, transaction):
+        """
+        Add a transaction, evicting the worst ones if the pool is over its limits
+        :type transaction: blokka.entities.Transaction
+        :return: whether the transaction is new and was kept
+        :rtype: bool
+        """
+        tx_hash = transaction.hash
+        size = len(transaction.canonical_bytes())
+        if self.knows(tx_hash) or (self.max_bytes is not None and size > self.max_bytes):
+            return False
+        best_key, worst_key = self._keys(transaction)
+        entry = [best_key, worst_key, tx_hash, transaction, size]
+        self._entries[tx_hash] = entry
+        self.nbytes += entry[4]
+        heapq.heappush(self._best, (best_key, entry))
+        heapq.heappush(self._worst, (worst_key, entry))
+        while self._full():
+            self.evicted += 1
+            if self._pop_worst() is entry:
+                return False
+        self._compact()
+        return True
+
+    def _pop_worst(self):
+        while True:
+            _, entry = heapq.heappop(self._worst)
+            if self._entries.get(entry[2]) is entry:
+                self._discard(entry[2])
+                return entry
+
+    def _discard(self, tx_hash):
+        entry = self._entries.pop(tx_hash, None)
+        if entry is not None:
+            self.nbytes -= entry[4]
+        return entry
+
+    def _compact(self):
+        # Drop stale heap entries once they make up most of the heaps
+        if len(self._best) > 2 * len(self._entries) + 64:
+            self._best = [(e[0], e) for e in self._entries.itervalues()]
+            self._worst = [(e[1], e) for e in self._entries.itervalues()]
+            heapq.heapify(self._best)
+            heapq.heapify(self._worst)
+
+    def remove(self, tx_hash):
+        """
+        :type tx_hash: str
+        :return: the removed transaction, or None if it was not in the pool
+        :rtype: blokka.entities.Transaction
+        """
+        entry = self._discard(tx_hash)
+        self._compact()
+        return entry[3] if entry is not None else None
+
+    def remove_confirmed(self, tx_hashes):
+        """
+        Remove transactions that have been mined into a block, and remember them as
+        confirmed
+        :type tx_hashes: list[str]
+        """
+        for tx_hash in tx_hashes:
+            self._discard(tx_hash)
+            self._confirmed.pop(tx_hash, None)
+            self._confirmed[tx_hash] = True
+        while len(self._confirmed) > self.confirmed_memory:
+            self._confirmed.popitem(last=False)
+        self._compact()
+
+    def restore(self, transactions):
+        """
+        Take back transactions whose block was rolled back
+        :type transactions: list[blokka.entities.Transaction]
+        """
+        for transaction in transactions:
+            self._confirmed.pop(transaction.hash, None)
+            self.add(transaction)
+
+    def best(self, k):
+        """
+        The `k` best transactions, best first, without removing them. Walks the best
+        first heap as a tree, keeping its frontier in a second heap, so takes
+        O(k log k) besides any stale entries met on the way.
+        :type k: int
+        :rtype: list[blokka.entities.Transaction]
+        """
+        heap = self._best
+        result = []
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier and len(result) < k:
+            (_, entry), i = heapq.heappop(frontier)
+            if self._entries.get(entry[2]) is entry:
+                result.append(entry[3])
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+        return result
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Merkle trees over transaction hashes.
+
+Leaves and inner nodes are hashed with different prefixes, so an inner node can never
+pass for a leaf. A node without a sibling is promoted to the next level unchanged.
+"""
+from hashlib import sha256
+
+LEFT = 'left'
+RIGHT = 'right'
+
+
+def _leaf(tx_hash):
+    return sha256(b'\x00' + tx_hash).hexdigest()
+
+
+def _node(left, right):
+    return sha256(b'\x01' + left + right).hexdigest()
+
+
+def _next_level(level):
+    return [_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in xrange(0, len(level), 2)]
+
+
+def merkle_root(tx_hashes):
+    """
+    :type tx_hashes: list[str]
+    :return: root of the tree over the hashes, in order; the hash of nothing if empty
+    :rtype: str
+    """
+    if not tx_hashes:
+        return sha256(b'').hexdigest()
+    level = [_leaf(h) for h in tx_hashes]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(tx_hashes, tx_hash):
+    """
+    Inclusion proof for one of the hashes: the sibling at each level of the tree on
+    the way up to the root, and which side it is on
+    :type tx_hashes: list[str]
+    :type tx_hash: str
+    :rtype: list[(str, str)]
+    """
+    index = tx_hashes.index(tx_hash)
+    level = [_leaf(h) for h in tx_hashes]
+    proof = []
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append((level[sibling], LEFT if sibling < index else RIGHT))
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(tx_hash, proof, root):
+    """
+    :type tx_hash: str
+    :param proof: from merkle_proof
+    :type proof: list[(str, str)]
+    :type root: str
+    :return: whether the proof shows tx_hash is in the tree with this root
+    :rtype: bool
+    """
+    node = _leaf(tx_hash)
+    for sibling, side in proof:
+        node = _node(sibling, node) if side == LEFT else _node(node, sibling)
+    return node == root
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Counters, gauges and histograms for instrumenting a node.
+
+Recording is a few attribute updates: no locks, no allocation. Each Metrics belongs to
+one actor and is only updated from that actor's thread, so nothing is shared between
+threads; snapshots are taken on the same thread, through the actor. Gauges, and
+counters given one, are read from a callable when a snapshot is taken, so values that
+are already kept elsewhere (a queue's length, a pool's size) cost nothing to track.
+
+Snapshots render to the Prometheus text exposition format, for example for the node
+exporter's textfile collector.
+"""
+import os
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the buckets for timings
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class Counter(object):
+    """
+    A count that only goes up
+    """
+    kind = COUNTER
+
+    def __init__(self, name, help_text, read=None):
+        """
+        :param read: returns the current count, if it is kept elsewhere (None: counted
+            with inc)
+        :type read: () -> int
+        """
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.read = read
+
+    def inc(self, amount=1):
+        """
+        :type amount: int
+        """
+        self.value += amount
+
+    def snapshot(self):
+        if self.read is not None:
+            return self.read()
+        return self.value
+
+
+class Gauge(object):
+    """
+    A value read from a callable when a snapshot is taken
+    """
+    kind = GAUGE
+
+    def __init__(self, name, help_text, read):
+        """
+        :param read: returns the current value
+        :type read: () -> float
+        """
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def snapshot(self):
+        return self.read()
+
+
+class Histogram(object):
+    """
+    Observations counted into fixed buckets, with their count and sum
+    """
+    kind = HISTOGRAM
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets, in increasing order; observations
+            above the last fall into an implicit +Inf bucket
+        :type buckets: tuple[float]
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        :type value: float
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """
+        :return: a context manager that observes the seconds its block takes
+        :rtype: _Timer
+        """
+        return _Timer(self)
+
+    def snapshot(self):
+        """
+        :return: count, sum, and the cumulative count at each bucket's upper bound
+        :rtype: dict
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started)
+
+
+class Metrics(object):
+    """
+    The metrics of one component, by name
+    """
+
+    def __init__(self, prefix='blokka', labels=None):
+        """
+        :param prefix: prepended to every metric's name in the text format
+        :type prefix: str
+        :param labels: added to every sample in the text format, e.g. {'node': 'n1'}
+        :type labels: dict
+        """
+        self.prefix = prefix
+        self.labels = labels or {}
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, read=None):
+        """
+        :type read: () -> int
+        :rtype: Counter
+        """
+        return self._register(Counter(name, help_text, read))
+
+    def gauge(self, name, help_text, read):
+        """
+        :type read: () -> float
+        :rtype: Gauge
+        """
+        return self._register(Gauge(name, help_text, read))
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS):
+        """
+        :rtype: Histogram
+        """
+        return self._register(Histogram(name, help_text, buckets))
+
+    def snapshot(self):
+        """
+        :return: each metric's current value by name; a histogram's is a dict, see
+            Histogram.snapshot
+        :rtype: dict
+        """
+        return {m.name: m.snapshot() for m in self._metrics}
+
+    def to_prometheus(self):
+        """
+        :return: a snapshot in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+        for metric in self._metrics:
+            name = '{}_{}'.format(self.prefix, metric.name)
+            lines.append('# HELP {} {}'.format(name, metric.help_text))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            value = metric.snapshot()
+            if metric.kind != HISTOGRAM:
+                lines.append(self._sample(name, value))
+                continue
+            for bound, count in value['buckets']:
+                lines.append(self._sample(name + '_bucket', count, le=bound))
+            lines.append(self._sample(name + '_sum', value['sum']))
+            lines.append(self._sample(name + '_count', value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _sample(self, name, value, **extra):
+        labels = dict(self.labels)
+        labels.update((k, _format_number(v)) for k, v in extra.items())
+        label_text = ','.join('{}="{}"'.format(k, _escape(labels[k]))
+                              for k in sorted(labels))
+        if label_text:
+            name = '{}{{{}}}'.format(name, label_text)
+        return '{} {}'.format(name, _format_number(value))
+
+    def write_prometheus(self, path):
+        """
+        Write a snapshot in the text format to `path`, replacing it in one step so a
+        collector never reads a partial file
+        :type path: str
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.rename(tmp_path, path)
+
+
+def _format_number(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Proof-of-work mining.
+
+A block meets a difficulty of `d` when its hash, read as a 256-bit number, has at
+least `d` leading zero bits. The nonce search is split into chunks of consecutive
+nonces that are farmed out to a multiprocessing pool; a search can be cancelled
+between chunks.
+"""
+import multiprocessing
+import threading
+import time
+from collections import namedtuple
+from hashlib import sha256
+
+from blokka.codec import UINT64
+from blokka.entities import Block, difficulty_target
+
+MiningResult = namedtuple(
+    'MiningResult', ['block', 'hashes', 'seconds', 'hashes_per_second'])
+
+
+def _search_chunk(hash_prefix, difficulty, start, stop):
+    """
+    Try the nonces in [start, stop)
+    :return: the first nonce that meets the difficulty, or None; and the number of
+        hashes computed
+    :rtype: (int, int)
+    """
+    target = difficulty_target(difficulty)
+    base = sha256(hash_prefix + b'\x01')
+    pack = UINT64.pack
+    for nonce in xrange(start, stop):
+        h = base.copy()
+        h.update(pack(nonce))
+        if h.digest() <= target:
+            return nonce, nonce - start + 1
+    return None, stop - start
+
+
+class MiningJob(object):
+    """
+    A nonce search running in the background
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+
+class Miner(object):
+
+    CHUNK_SIZE = 1 << 14
+
+    def __init__(self, difficulty, processes=1):
+        """
+        :param difficulty: required number of leading zero bits in a block's hash
+        :type difficulty: int
+        :param processes: size of the worker pool; with 1, chunks are searched in the
+            calling process
+        :type processes: int
+        """
+        self.difficulty = difficulty
+        self.processes = processes
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def mine(self, block, cancelled=None):
+        """
+        Search for a nonce that makes `block` meet the difficulty
+        :param block: the block to mine; its own nonce is ignored
+        :type block: blokka.entities.Block
+        :param cancelled: stop searching once this is set
+        :type cancelled: threading.Event
+        :return: the mined block and search statistics, or None if cancelled
+        :rtype: MiningResult
+        """
+        prefix = block.hash_prefix()
+        started = time.time()
+        hashes = 0
+        nonce = None
+        next_start = 0
+
+        if self.processes == 1:
+            while nonce is None and not (cancelled and cancelled.is_set()):
+                nonce, tried = _search_chunk(
+                    prefix, self.difficulty, next_start, next_start + self.CHUNK_SIZE)
+                hashes += tried
+                next_start += self.CHUNK_SIZE
+        else:
+            # Keep one chunk per worker in flight, in nonce order
+            pool = self._get_pool()
+            in_flight = []
+            while nonce is None and not (cancelled and cancelled.is_set()):
+                while len(in_flight) < self.processes:
+                    in_flight.append(pool.apply_async(
+                        _search_chunk,
+                        (prefix, self.difficulty, next_start,
+                         next_start + self.CHUNK_SIZE)))
+                    next_start += self.CHUNK_SIZE
+                nonce, tried = in_flight.pop(0).get()
+                hashes += tried
+
+        if nonce is None:
+            return None
+        seconds = max(time.time() - started, 1e-9)
+        mined = Block(timestamp=block.timestamp, prev_hash=block.prev_hash,
+                      data=block.data, merkle_root=block.merkle_root, nonce=nonce)
+        return MiningResult(block=mined, hashes=hashes, seconds=seconds,
+                            hashes_per_second=hashes / seconds)
+
+    def mine_async(self, block, callback):
+        """
+        Mine a block in a background thread
+        :type block: blokka.entities.Block
+        :param callback: called with the MiningResult once a nonce is found; not called
+            if the job is cancelled first
+        :rtype: MiningJob
+        """
+        job = MiningJob()
+
+        def run():
+            result = self.mine(block, cancelled=job.cancelled)
+            if result is not None and not job.cancelled.is_set():
+                callback(result)
+
+        job.thread = threading.Thread(target=run)
+        job.thread.daemon = True
+        job.thread.start()
+        return job
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
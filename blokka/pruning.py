@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Bounded storage: pruned chains, archives of their old blocks, and state snapshots.
+
+A pruned chain (see Chain.prune) keeps only the headers of its blocks below a
+checkpoint height: hashes still link it and still answer block locators, but the
+transactions are gone. The state they built up lives on in the node's ledger, which
+is why pruning a node needs somewhere to save its ledger. The dropped blocks can be
+archived first, as JSON chain files that read back with blokka.streams.
+
+A Snapshot is a pruned copy of a chain, with its recent blocks whole, plus the ledger
+as of its tip. A new node can start from one instead of downloading and replaying
+every block; it validates the whole blocks and trusts the headers.
+"""
+import json
+import os
+
+from blokka.entities import Chain, meets_target, validate_blocks
+from blokka.ledger import Ledger
+from blokka.streams import write_chain
+
+
+def archive_path(directory, node_id, height):
+    """
+    :type directory: str
+    :type node_id: str
+    :param height: height of the first block in the archive
+    :type height: int
+    :rtype: str
+    """
+    return os.path.join(directory, '{}.{:010d}.json'.format(node_id, height))
+
+
+def archive_blocks(directory, node_id, height, blocks):
+    """
+    Write blocks about to be pruned to an archive file of their own
+    :type directory: str
+    :type node_id: str
+    :param height: height of the first block
+    :type height: int
+    :type blocks: list[blokka.entities.Block]
+    :return: the archive file's path
+    :rtype: str
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    path = archive_path(directory, node_id, height)
+    with open(path + '.tmp', 'wb') as f:
+        write_chain(f, blocks)
+    os.rename(path + '.tmp', path)
+    return path
+
+
+class Snapshot(object):
+
+    def __init__(self, chain, ledger):
+        """
+        :param chain: headers up to the checkpoint, then whole blocks
+        :type chain: blokka.entities.Chain
+        :param ledger: the ledger as of the chain's tip
+        :type ledger: blokka.ledger.Ledger
+        """
+        self.chain = chain
+        self.ledger = ledger
+
+    @property
+    def height(self):
+        """
+        The checkpoint: blocks below it are headers only
+        :rtype: int
+        """
+        return self.chain.pruned_height
+
+    def validate(self, difficulty=None):
+        """
+        Check that the headers link up and, given a difficulty, carry enough proof of
+        work; that the whole blocks are valid (see validate_blocks); and that the
+        ledger is for the chain's tip
+        :type difficulty: int
+        :raise ValueError: if any of these fails
+        """
+        height = self.height
+        prev_hash = None
+        for h in xrange(height):
+            header = self.chain.blocks[h]
+            if h > 0 and header.prev_hash != prev_hash:
+                raise ValueError('Header {} at height {} does not link to the one '
+                                 'before it'.format(header.hash, h))
+            if difficulty is not None and not meets_target(header.hash, difficulty):
+                raise ValueError('Header {} at height {} does not meet difficulty '
+                                 '{}'.format(header.hash, h, difficulty))
+            prev_hash = header.hash
+        validate_blocks([self.chain.blocks[h] for h in xrange(height, self.chain.length)],
+                        height=height, prev_hash=prev_hash, difficulty=difficulty)
+        if (self.ledger.height, self.ledger.tip_hash) != (self.chain.length,
+                                                          self.chain.latest_hash()):
+            raise ValueError('The ledger is not for the tip of the chain')
+
+    def to_dict(self):
+        return {
+            'chain': self.chain.to_dict(),
+            'ledger': self.ledger.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        return cls(chain=Chain.from_dict(dct['chain']),
+                   ledger=Ledger.from_dict(dct['ledger']))
+
+    def save(self, path):
+        """
+        :type path: str
+        """
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :type path: str
+        :rtype: Snapshot
+        """
+        with open(path, 'rb') as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Runtimes for nodes, selectable per deployment with start_node.
+
+With the threads runtime, each node is a pykka ThreadingActor: a thread of its own, and
+a lock and a future for every call to it. With the loop runtime, any number of LoopNodes
+share one EventLoop thread instead. Each still has a mailbox and handles one message at
+a time, and the node logic is Node's own: its timers and tasks (see Node._call_later and
+Node._run_task) run on the loop, so a task waiting on a peer yields the peer's future
+and is resumed by the loop once the answer is in, rather than blocking a thread.
+
+Python 2 has no asyncio, so EventLoop is a small loop in its style: call_soon,
+call_later and call_soon_threadsafe, woken through a pipe.
+
+Mailboxes are bounded. A thread outside any loop that calls a node whose mailbox is
+full waits until there is room. Nothing on a loop may block, so a message from a node
+to a peer whose mailbox is full is dropped and counted instead, as a congested network
+would drop it: gossip still reaches the peer through others, and a chain share round
+counts the peer as not answering.
+
+Loop nodes peer with other loop nodes, on the same loop or on others; threads can call
+them, but they cannot call pykka actors, whose futures cannot resume a task.
+"""
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+from collections import deque
+
+from pykka import ActorDeadError, Timeout
+
+from blokka.actors import Node
+
+RUNTIME_THREADS = 'threads'
+RUNTIME_LOOP = 'loop'
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackFuture(object):
+    """
+    The answer to a call, set once, that calls back whoever is waiting for it. Tasks
+    (see Node._run_task) yield these to wait on them; see run_task.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def get(self, timeout=None):
+        if not self._done:
+            raise Timeout('The answer is not in yet')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def set(self, value=None, error=None):
+        self._value = value
+        self._error = error
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        """
+        :param callback: called with this future once it is set
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    @property
+    def awaited(self):
+        """
+        :return: whether anything is waiting for the answer yet
+        :rtype: bool
+        """
+        return bool(self._callbacks)
+
+
+def run_task(task, timeout, call_later):
+    """
+    Run a task (see Node._run_task) without blocking: each CallbackFuture it yields
+    resumes it once set, or has pykka.Timeout raised into it after `timeout` seconds
+    :type task: generator
+    :type timeout: float
+    :param call_later: schedules a call, returning a handle with cancel()
+    :type call_later: (float, () -> None) -> object
+    """
+    _step_task(task, task.send, None, timeout, call_later)
+
+
+def _step_task(task, resume, value, timeout, call_later):
+    try:
+        future = resume(value)
+    except StopIteration:
+        return
+    waiting = [True]
+
+    def answered(f):
+        if waiting[0] and f._error is None and isinstance(f._value, CallbackFuture):
+            # Answered with a future for the answer (see Node.receive_blocks)
+            f._value.add_callback(answered)
+        elif waiting[0]:
+            waiting[0] = False
+            timer.cancel()
+            if f._error is not None:
+                _step_task(task, task.throw, f._error, timeout, call_later)
+            else:
+                _step_task(task, task.send, f._value, timeout, call_later)
+
+    def timed_out():
+        if waiting[0]:
+            waiting[0] = False
+            _step_task(task, task.throw, Timeout('No answer in {}s'.format(timeout)),
+                       timeout, call_later)
+
+    timer = call_later(timeout, timed_out)
+    future.add_callback(answered)
+
+
+_local = threading.local()
+
+
+def _current_loop():
+    """
+    :return: the loop running on this thread, if any
+    :rtype: EventLoop
+    """
+    return getattr(_local, 'loop', None)
+
+
+class EventLoop(object):
+    """
+    Runs calls one at a time on one thread: those due now in the order they were
+    scheduled, then timers as they come due
+    """
+
+    def __init__(self):
+        self._ready = deque()
+        self._timers = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._incoming = deque()
+        self._read_fd, self._write_fd = os.pipe()
+        self._woken = False
+        self._stopping = False
+        self._thread = None
+
+    def call_soon(self, func, *args):
+        """
+        Only from the loop's own thread
+        """
+        self._ready.append((func, args))
+
+    def call_later(self, delay, func, *args):
+        """
+        Only from the loop's own thread
+        :type delay: float
+        :return: a handle whose cancel() stops the call if it has not happened yet
+        :rtype: _Timer
+        """
+        timer = _Timer(func, args)
+        heapq.heappush(self._timers, (time.time() + delay, next(self._seq), timer))
+        return timer
+
+    def call_soon_threadsafe(self, func, *args):
+        """
+        From any thread
+        """
+        with self._lock:
+            self._incoming.append((func, args))
+            wake = not self._woken
+            self._woken = True
+        if wake:
+            os.write(self._write_fd, b'x')
+
+    def start(self):
+        """
+        Run the loop on a daemon thread of its own
+        """
+        self._thread = threading.Thread(target=self.run_forever, name='EventLoop')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the loop after the calls due now, and wait for it if it is on another thread
+        """
+        self.call_soon_threadsafe(self._set_stopping)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _set_stopping(self):
+        self._stopping = True
+
+    def run_forever(self):
+        """
+        Run the loop on this thread until stop is called
+        """
+        self._thread = threading.current_thread()
+        _local.loop = self
+        try:
+            while not self._stopping:
+                self._run_once()
+        finally:
+            _local.loop = None
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+    def _run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(self._timers[0][0] - time.time(), 0)
+        else:
+            timeout = None
+        readable = select.select([self._read_fd], [], [], timeout)[0]
+        if readable:
+            os.read(self._read_fd, 4096)
+        with self._lock:
+            self._ready.extend(self._incoming)
+            self._incoming.clear()
+            self._woken = False
+        now = time.time()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if not timer.cancelled:
+                self._ready.append((timer.func, timer.args))
+        # Calls made from these run on the next turn, after any new timers and
+        # threadsafe calls
+        for _ in xrange(len(self._ready)):
+            func, args = self._ready.popleft()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Error in event loop call to %s', func)
+
+
+class _Timer(object):
+
+    __slots__ = ('func', 'args', 'cancelled')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class LoopFuture(CallbackFuture):
+    """
+    A CallbackFuture that threads outside the loop can also wait on
+    """
+
+    def __init__(self, loop):
+        super(LoopFuture, self).__init__()
+        self._loop = loop
+
+    def get(self, timeout=None):
+        if not self._done and _current_loop() is not self._loop:
+            event = threading.Event()
+            self._loop.call_soon_threadsafe(self.add_callback, lambda f: event.set())
+            event.wait(timeout)
+        return super(LoopFuture, self).get()
+
+
+class LoopProxy(object):
+    """
+    Stands in for a pykka proxy to a LoopNode: calling a method posts a message to the
+    node's mailbox and returns a LoopFuture for the answer; reading an attribute returns
+    a LoopFuture for its value
+    """
+
+    def __init__(self, node):
+        """
+        :type node: LoopNode
+        """
+        self._node = node
+
+    def __getattr__(self, name):
+        node = self._node
+        if callable(getattr(node, name)):
+            def call(*args, **kwargs):
+                return node.post(name, args, kwargs)
+            return call
+        if _current_loop() is node.loop:
+            future = LoopFuture(node.loop)
+            future.set(getattr(node, name))
+            return future
+        return node.post(getattr, (node, name), {}, bound=False)
+
+
+class _Mailbox(deque):
+
+    def qsize(self):
+        return len(self)
+
+
+class LoopNode(Node):
+    """
+    A Node run on an EventLoop rather than by a thread of its own
+    """
+
+    # Messages a node's mailbox holds at most
+    MAILBOX_SIZE = 10000
+    # Messages handled in a row before letting other nodes on the loop have a turn
+    DRAIN_BATCH = 100
+
+    def __init__(self, loop, node_id, **kwargs):
+        """
+        :type loop: EventLoop
+        :param kwargs: as for Node
+        """
+        super(LoopNode, self).__init__(node_id, **kwargs)
+        self.loop = loop
+        self.actor_inbox = _Mailbox()
+        self._mailbox_dropped = self._metrics.counter(
+            'mailbox_dropped_total', 'Messages from peers dropped on a full mailbox')
+        self._proxy = LoopProxy(self)
+        self._stopped = False
+        self._draining = False
+        # Messages from other threads allowed in but not yet in the mailbox
+        self._reserved = 0
+        self._room = threading.Condition(threading.Lock())
+
+    @classmethod
+    def start(cls, *args, **kwargs):
+        """
+        :param loop: the loop to run the node on (default: see default_loop)
+        :type loop: EventLoop
+        :param args: as for Node
+        :return: a reference to the node, like pykka's ActorRef
+        :rtype: LoopActorRef
+        """
+        loop = kwargs.pop('loop', None) or default_loop()
+        node = cls(loop, *args, **kwargs)
+        ready = node.post('on_start', (), {})
+        ready.get()
+        return LoopActorRef(node)
+
+    def on_start(self):
+        if self.metrics_path is not None:
+            self._schedule_metrics()
+
+    def _call_later(self, delay, func):
+        return self.loop.call_later(delay, func)
+
+    def _future(self):
+        return LoopFuture(self.loop)
+
+    def _run_task(self, task):
+        run_task(task, self.SHARE_TIMEOUT, self.loop.call_later)
+
+    def _tell(self, name, *args):
+        # Let in even when the mailbox is full: the thread telling may serve every node
+        # in the process, as the verifier's pool thread does, so it must not wait here
+        message = (name, args, {}, LoopFuture(self.loop), True)
+        self.loop.call_soon_threadsafe(self._enqueue, message)
+
+    def register_peer(self, peer_proxy):
+        """
+        As Node.register_peer, but without waiting for the peer's id: a peer on another
+        loop is added once its id is in, as nothing on a loop may block
+        :type peer_proxy: LoopProxy
+        """
+        def answered(future):
+            try:
+                peer_id = future.get()
+            except Exception as e:
+                self.logger.warning('could not register peer: %s', e)
+                return
+            self._add_peer(peer_proxy, peer_id)
+        peer_proxy.node_id.add_callback(answered)
+
+    def post(self, name, args, kwargs, bound=True):
+        """
+        Post a message to the node's mailbox, from any thread
+        :param name: of the method to call, or with bound=False, the function to call
+        :return: the answer; from another loop, a future set on that loop
+        :rtype: LoopFuture
+        """
+        future = LoopFuture(self.loop)
+        message = (name, args, kwargs, future, bound)
+        caller = _current_loop()
+        if caller is self.loop:
+            self._accept(message)
+        elif caller is not None:
+            # From another loop, which must not wait for room. The answer is handed
+            # back to that loop, so whatever waits on it runs there.
+            reply = LoopFuture(caller)
+            future.add_callback(lambda f: caller.call_soon_threadsafe(
+                reply.set, f._value, f._error))
+            self.loop.call_soon_threadsafe(self._accept, message)
+            return reply
+        else:
+            with self._room:
+                while len(self.actor_inbox) + self._reserved >= self.MAILBOX_SIZE:
+                    # Polls in case the loop misses that this thread is waiting
+                    self._room.wait(0.01)
+                self._reserved += 1
+            self.loop.call_soon_threadsafe(self._accept_reserved, message)
+        return future
+
+    def _accept_reserved(self, message):
+        with self._room:
+            self._reserved -= 1
+        self._enqueue(message)
+
+    def _accept(self, message):
+        if len(self.actor_inbox) + self._reserved >= self.MAILBOX_SIZE:
+            self._mailbox_dropped.inc()
+            return
+        self._enqueue(message)
+
+    def _enqueue(self, message):
+        if self._stopped:
+            message[3].set(error=ActorDeadError('{} is stopped'.format(self.node_id)))
+            return
+        self.actor_inbox.append(message)
+        if not self._draining:
+            self._draining = True
+            self.loop.call_soon(self._drain)
+
+    def _drain(self):
+        mailbox = self.actor_inbox
+        was_full = len(mailbox) + self._reserved >= self.MAILBOX_SIZE
+        for _ in xrange(min(len(mailbox), self.DRAIN_BATCH)):
+            name, args, kwargs, future, bound = mailbox.popleft()
+            func = getattr(self, name) if bound else name
+            try:
+                value, error = func(*args, **kwargs), None
+            except Exception as e:
+                if not future.awaited:
+                    self.logger.exception('error handling %s', name)
+                value, error = None, e
+            future.set(value, error)
+        if mailbox:
+            self.loop.call_soon(self._drain)
+        else:
+            self._draining = False
+        if was_full:
+            with self._room:
+                self._room.notify_all()
+
+    def _stop(self):
+        if self._stopped:
+            return
+        self.on_stop()
+        self._stopped = True
+        while self.actor_inbox:
+            self.actor_inbox.popleft()[3].set(
+                error=ActorDeadError('{} is stopped'.format(self.node_id)))
+
+
+class LoopActorRef(object):
+    """
+    A reference to a started LoopNode, offering what Node's callers use of pykka's
+    ActorRef
+    """
+
+    def __init__(self, node):
+        self._node = node
+
+    def proxy(self):
+        """
+        :rtype: LoopProxy
+        """
+        return LoopProxy(self._node)
+
+    def is_alive(self):
+        return not self._node._stopped
+
+    def stop(self, block=True, timeout=None):
+        """
+        Stop the node once the messages already in its mailbox have been handled
+        """
+        future = self._node.post('_stop', (), {})
+        if block:
+            try:
+                future.get(timeout)
+            except ActorDeadError:
+                pass
+
+
+_default_loop = None
+_default_loop_lock = threading.Lock()
+
+
+def default_loop():
+    """
+    :return: a loop shared by the process, started on first use
+    :rtype: EventLoop
+    """
+    global _default_loop
+    with _default_loop_lock:
+        if _default_loop is None:
+            _default_loop = EventLoop()
+            _default_loop.start()
+        return _default_loop
+
+
+def start_node(node_id, runtime=RUNTIME_THREADS, loop=None, **kwargs):
+    """
+    Start a node on the chosen runtime
+    :type node_id: str
+    :param runtime: RUNTIME_THREADS or RUNTIME_LOOP
+    :param loop: with RUNTIME_LOOP, the loop to run on (default: see default_loop)
+    :type loop: EventLoop
+    :param kwargs: as for Node
+    :return: a reference to the node, with proxy() and stop()
+    :rtype: pykka.ActorRef | LoopActorRef
+    """
+    if runtime == RUNTIME_THREADS:
+        return Node.start(node_id=node_id, **kwargs)
+    if runtime == RUNTIME_LOOP:
+        return LoopNode.start(node_id, loop=loop, **kwargs)
+    raise ValueError('Unknown node runtime {}'.format(runtime))
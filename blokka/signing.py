@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Ed25519 signatures (RFC 8032).
+
+An account is named by its public key, hex encoded: a signed transaction's buyer_id is
+the public key of whoever pays, and its signature is checked against it. Keys and
+signatures are bytes here; transactions carry them hex encoded.
+
+With PyNaCl installed, keys are derived and messages signed and verified by libsodium.
+Without it, a pure Python implementation here is used instead. It gives the same keys
+and signatures, but it is not constant time: how long signing takes depends on the
+secret key. It is meant for tests and simulations, not for keys that protect anything.
+
+Verifying a signature takes two scalar multiplications, a few milliseconds in pure
+Python, so nodes verify on a worker pool (see blokka.verification) and only once per
+transaction.
+"""
+import os
+from binascii import hexlify, unhexlify
+from hashlib import sha512
+
+try:
+    import nacl.exceptions
+    import nacl.signing
+except ImportError:
+    nacl = None
+
+KEY_SIZE = 32
+SIGNATURE_SIZE = 64
+
+_P = 2 ** 255 - 19
+_Q = 2 ** 252 + 27742317777372353535851937790883648493
+_D = -121665 * pow(121666, _P - 2, _P) % _P
+_SQRT_M1 = pow(2, (_P - 1) // 4, _P)
+
+
+def _from_le(data):
+    return int(hexlify(data[::-1]), 16)
+
+
+def _to_le(n):
+    return unhexlify('%064x' % n)[::-1]
+
+
+def _hash_int(*parts):
+    return _from_le(sha512(b''.join(parts)).digest()) % _Q
+
+
+def _add(p1, p2):
+    # Points are in extended coordinates (X, Y, Z, T), with x = X/Z, y = Y/Z, xy = T/Z
+    a = (p1[1] - p1[0]) * (p2[1] - p2[0]) % _P
+    b = (p1[1] + p1[0]) * (p2[1] + p2[0]) % _P
+    c = 2 * p1[3] * p2[3] * _D % _P
+    d = 2 * p1[2] * p2[2] % _P
+    e, f, g, h = b - a, d - c, d + c, b + a
+    return e * f % _P, g * h % _P, f * g % _P, e * h % _P
+
+
+def _multiply(s, point):
+    result = (0, 1, 1, 0)
+    while s > 0:
+        if s & 1:
+            result = _add(result, point)
+        point = _add(point, point)
+        s >>= 1
+    return result
+
+
+def _equal(p1, p2):
+    return ((p1[0] * p2[2] - p2[0] * p1[2]) % _P == 0 and
+            (p1[1] * p2[2] - p2[1] * p1[2]) % _P == 0)
+
+
+def _recover_x(y, sign):
+    if y >= _P:
+        return None
+    x2 = (y * y - 1) * pow(_D * y * y + 1, _P - 2, _P) % _P
+    if x2 == 0:
+        return None if sign else 0
+    x = pow(x2, (_P + 3) // 8, _P)
+    if (x * x - x2) % _P != 0:
+        x = x * _SQRT_M1 % _P
+    if (x * x - x2) % _P != 0:
+        return None
+    if (x & 1) != sign:
+        x = _P - x
+    return x
+
+
+def _compress(point):
+    z_inv = pow(point[2], _P - 2, _P)
+    x = point[0] * z_inv % _P
+    y = point[1] * z_inv % _P
+    return _to_le(y | ((x & 1) << 255))
+
+
+def _decompress(data):
+    y = _from_le(data)
+    sign = y >> 255
+    y &= (1 << 255) - 1
+    x = _recover_x(y, sign)
+    if x is None:
+        return None
+    return x, y, 1, x * y % _P
+
+
+_G_Y = 4 * pow(5, _P - 2, _P) % _P
+_G_X = _recover_x(_G_Y, 0)
+_G = (_G_X, _G_Y, 1, _G_X * _G_Y % _P)
+
+
+def _expand(secret):
+    if len(secret) != KEY_SIZE:
+        raise ValueError('Secret keys are {} bytes'.format(KEY_SIZE))
+    h = sha512(secret).digest()
+    a = _from_le(h[:32])
+    a &= (1 << 254) - 8
+    a |= 1 << 254
+    return a, h[32:]
+
+
+def generate_secret():
+    """
+    :rtype: bytes
+    """
+    return os.urandom(KEY_SIZE)
+
+
+def public_key(secret):
+    """
+    :type secret: bytes
+    :rtype: bytes
+    """
+    if nacl is not None:
+        return nacl.signing.SigningKey(secret).verify_key.encode()
+    a, _ = _expand(secret)
+    return _compress(_multiply(a, _G))
+
+
+def sign(secret, message):
+    """
+    :type secret: bytes
+    :type message: bytes
+    :rtype: bytes
+    """
+    if nacl is not None:
+        return nacl.signing.SigningKey(secret).sign(message).signature
+    a, prefix = _expand(secret)
+    public = _compress(_multiply(a, _G))
+    r = _hash_int(prefix, message)
+    r_bytes = _compress(_multiply(r, _G))
+    s = (r + _hash_int(r_bytes, public, message) * a) % _Q
+    return r_bytes + _to_le(s)
+
+
+def verify(public, message, signature):
+    """
+    :type public: bytes
+    :type message: bytes
+    :type signature: bytes
+    :rtype: bool
+    """
+    if len(public) != KEY_SIZE or len(signature) != SIGNATURE_SIZE:
+        return False
+    if nacl is not None:
+        try:
+            nacl.signing.VerifyKey(public).verify(message, signature)
+        except nacl.exceptions.CryptoError:
+            return False
+        return True
+    a = _decompress(public)
+    if a is None:
+        return False
+    r_bytes = signature[:32]
+    r = _decompress(r_bytes)
+    if r is None:
+        return False
+    s = _from_le(signature[32:])
+    if s >= _Q:
+        return False
+    h = _hash_int(r_bytes, public, message)
+    return _equal(_multiply(s, _G), _add(r, _multiply(h, a)))
+
+
+def account_id(public):
+    """
+    :param public: a public key
+    :type public: bytes
+    :return: the name of the account the key signs for
+    :rtype: str
+    """
+    return hexlify(public)
@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Deterministic simulation of a network of nodes.
+
+Nodes run the unchanged Node logic, but rather than each being an actor on a thread of
+its own, every message between them is an event on one single-threaded, discrete-event
+scheduler with a simulated clock, and every random choice comes from one seeded
+generator. A network of thousands of nodes runs in one thread, and the same seed always
+gives the same run. The one thing a SimNode adds is relaying: Node shares only the
+blocks it mines, so a SimNode passes blocks it accepts on to its other peers, as a
+deployment's transport would, or they would reach only the miner's own peers.
+
+A message from one node to another goes over the link between them: it is lost with
+probability `loss`; otherwise it waits for the link to finish sending earlier messages,
+takes its size over `bandwidth` to send, and arrives `latency` later. When the sender
+waits for an answer, the answer comes back the same way over the reverse link. Mining
+with a difficulty takes an exponentially distributed time with mean
+2**difficulty / hash_rate; only once that time is up is the nonce searched for, so
+blocks are valid but a search is paid for only by blocks that are actually found.
+
+Run with
+
+    python -m blokka.simulation [--nodes N] [--duration SECONDS] [--seed SEED] ...
+
+to print a report as JSON; see Simulation.report.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import random
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytz
+from pykka import Timeout
+
+from blokka.actors import GOSSIP_INVENTORY, GOSSIP_PUSH, REJECTED, Node
+from blokka.backends import MemoryBackend
+from blokka.entities import Chain, Transaction, ValueEntity
+from blokka.mining import Miner
+from blokka.runtime import CallbackFuture, run_task
+from blokka.verification import Verifier
+
+# Simulated time 0
+EPOCH = datetime(2017, 1, 1)
+
+# Bytes of framing added to every message
+HEADER_SIZE = 32
+
+
+class Scheduler(object):
+    """
+    Calls to make at points in simulated time; calls due at the same time are made in
+    the order they were scheduled
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.events_run = 0
+        self._queue = []
+        self._seq = itertools.count()
+
+    def call_at(self, when, func, *args):
+        """
+        :type when: float
+        :return: a handle whose cancel() stops the call if it has not happened yet
+        :rtype: _Event
+        """
+        event = _Event(func, args)
+        heapq.heappush(self._queue, (when, next(self._seq), event))
+        return event
+
+    def call_later(self, delay, func, *args):
+        """
+        :type delay: float
+        :rtype: _Event
+        """
+        return self.call_at(self.now + delay, func, *args)
+
+    def run(self, until=None):
+        """
+        Make the calls that are due, in order, until there are none left or the next is
+        after `until`; the clock then reads `until`
+        :type until: float
+        """
+        queue = self._queue
+        while queue:
+            when, _, event = queue[0]
+            if until is not None and when > until:
+                break
+            heapq.heappop(queue)
+            if event.cancelled:
+                continue
+            self.now = when
+            self.events_run += 1
+            event.func(*event.args)
+        if until is not None:
+            self.now = max(self.now, until)
+
+
+class _Event(object):
+
+    __slots__ = ('func', 'args', 'cancelled')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimProxy(object):
+    """
+    Stands in for a pykka proxy to `target` held by `sender`: method calls become
+    messages over the link between them, and attributes are read straight away
+    """
+
+    def __init__(self, network, sender, target):
+        """
+        :type network: Network
+        :type sender: SimNode
+        :type target: SimNode
+        """
+        self._network = network
+        self._sender = sender
+        self._target = target
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            future = CallbackFuture()
+            future.set(value)
+            return future
+
+        def call(*args, **kwargs):
+            return self._network.send(self._sender, self._target, name, args, kwargs)
+        return call
+
+
+class _Link(object):
+    """
+    One direction of a connection: messages are sent one after another, then take
+    `latency` to arrive
+    """
+
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.free_at = 0.0
+
+    def arrival(self, now, size):
+        """
+        :return: when a message of `size` bytes sent at `now` arrives
+        :rtype: float
+        """
+        start = max(now, self.free_at)
+        self.free_at = start + (float(size) / self.bandwidth if self.bandwidth else 0.0)
+        return self.free_at + self.latency
+
+
+def message_size(values):
+    """
+    :param values: the arguments, or the answer, of a call
+    :return: estimated size on the wire, in bytes
+    :rtype: int
+    """
+    return HEADER_SIZE + sum(_size(v) for v in values)
+
+
+def _size(value):
+    if isinstance(value, ValueEntity):
+        return len(value.canonical_bytes())
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return 4 + sum(_size(v) for v in value)
+    if isinstance(value, dict):
+        return 4 + sum(_size(k) + _size(v) for k, v in value.iteritems())
+    if isinstance(value, Chain):
+        return 4 + sum(_size(b) for b in value.blocks)
+    return 8
+
+
+class Network(object):
+    """
+    The scheduler, the links between nodes, and what has been seen where
+    """
+
+    def __init__(self, seed=0, latency=0.05, jitter=0.5, bandwidth=1e6, loss=0.0):
+        """
+        :param latency: mean one-way latency of a link, in seconds
+        :type latency: float
+        :param jitter: each link's latency is drawn uniformly from within this fraction
+            of `latency`
+        :type jitter: float
+        :param bandwidth: of each link, in bytes per second (None: unlimited)
+        :type bandwidth: float
+        :param loss: probability that a message is lost
+        :type loss: float
+        """
+        self.rng = random.Random(seed)
+        self.scheduler = Scheduler()
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.messages_sent = 0
+        self.messages_lost = 0
+        self.bytes_sent = 0
+        self._links = {}
+        # block hash -> [when first seen, number of nodes that have had it]
+        self.block_reach = {}
+        self.block_delays = []
+        self.block_full_delays = []
+        # transaction hash -> (when submitted, id of the node it was submitted to)
+        self.submitted = {}
+        # The node whose message is being delivered
+        self.delivering_from = None
+        self.transaction_delays = []
+        self.node_count = 0
+
+    def connect(self, a, b):
+        """
+        Create the links in both directions between two nodes
+        :type a: SimNode
+        :type b: SimNode
+        """
+        for pair in ((a.node_id, b.node_id), (b.node_id, a.node_id)):
+            latency = self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+            self._links[pair] = _Link(latency, self.bandwidth)
+
+    def proxy(self, sender, target):
+        """
+        :type sender: SimNode
+        :type target: SimNode
+        :rtype: SimProxy
+        """
+        return SimProxy(self, sender, target)
+
+    def send(self, sender, target, name, args, kwargs):
+        """
+        Call a method of `target` on behalf of `sender`, as a message over their link
+        :rtype: blokka.runtime.CallbackFuture
+        """
+        future = CallbackFuture()
+        self._transmit(sender, target, message_size(list(args) + kwargs.values()),
+                       self._deliver, sender, target, name, args, kwargs, future)
+        return future
+
+    def _transmit(self, sender, target, size, func, *args):
+        if sender is target:
+            self.scheduler.call_later(0.0, func, *args)
+            return
+        self.messages_sent += 1
+        self.bytes_sent += size
+        if self.loss and self.rng.random() < self.loss:
+            self.messages_lost += 1
+            return
+        link = self._links[sender.node_id, target.node_id]
+        self.scheduler.call_at(link.arrival(self.scheduler.now, size), func, *args)
+
+    def _deliver(self, sender, target, name, args, kwargs, future):
+        # A proxy passed along now belongs to the receiver
+        args = [self._rebind(a, target) for a in args]
+        kwargs = {k: self._rebind(v, target) for k, v in kwargs.iteritems()}
+        self.delivering_from = sender
+        try:
+            value, error = getattr(target, name)(*args, **kwargs), None
+        except Exception as e:
+            if not future.awaited:
+                raise
+            value, error = None, e
+        finally:
+            self.delivering_from = None
+        self._answer(sender, target, value, error, future)
+
+    def _answer(self, sender, target, value, error, future):
+        if isinstance(value, CallbackFuture):
+            # A future for the answer (see Node.receive_blocks): pass it on once it is in
+            value.add_callback(
+                lambda f: self._answer(sender, target, f._value, f._error, future))
+        elif future.awaited:
+            self._transmit(target, sender, message_size([value]),
+                           future.set, value, error)
+        else:
+            future.set(value, error)
+
+    def _rebind(self, value, receiver):
+        if isinstance(value, SimProxy):
+            return self.proxy(receiver, value._target)
+        return value
+
+    def run_task(self, task, timeout):
+        """
+        Run a task (see Node._run_task) on simulated time
+        :type task: generator
+        :type timeout: float
+        """
+        run_task(task, timeout, self.scheduler.call_later)
+
+    def chain_changed(self, node):
+        """
+        Record when a node first has each block of its chain
+        :type node: SimNode
+        """
+        now = self.scheduler.now
+        chain = node.chain
+        for height in xrange(chain.length - 1, -1, -1):
+            block_hash = chain.hash_at(height)
+            if block_hash in node.seen_blocks:
+                break
+            node.seen_blocks.add(block_hash)
+            reach = self.block_reach.get(block_hash)
+            if reach is None:
+                # First seen on the node that mined it
+                self.block_reach[block_hash] = [now, 1]
+                continue
+            reach[1] += 1
+            self.block_delays.append(now - reach[0])
+            if reach[1] == self.node_count:
+                self.block_full_delays.append(now - reach[0])
+
+    def transaction_arrived(self, node, transaction):
+        """
+        :type node: SimNode
+        :type transaction: blokka.entities.Transaction
+        """
+        submitted = self.submitted.get(transaction.hash)
+        if submitted is not None and submitted[1] != node.node_id:
+            self.transaction_delays.append(self.scheduler.now - submitted[0])
+
+
+class SimMiner(Miner):
+    """
+    Mines in simulated time (see the module docstring)
+    """
+
+    def __init__(self, network, difficulty, hash_rate):
+        """
+        :type network: Network
+        :type difficulty: int
+        :param hash_rate: hashes per simulated second
+        :type hash_rate: float
+        """
+        super(SimMiner, self).__init__(difficulty)
+        self.network = network
+        self.hash_rate = hash_rate
+
+    def mine_async(self, block, callback):
+        job = _SimMiningJob()
+        delay = self.network.rng.expovariate(float(self.hash_rate) / 2 ** self.difficulty)
+
+        def found():
+            job.finished = True
+            result = self.mine(block)
+            callback(result._replace(seconds=delay, hashes_per_second=self.hash_rate))
+
+        job.event = self.network.scheduler.call_later(delay, found)
+        return job
+
+
+class _SimMiningJob(object):
+
+    def __init__(self):
+        self.event = None
+        self.finished = False
+
+    def cancel(self):
+        self.event.cancel()
+        self.finished = True
+
+    def done(self):
+        return self.finished
+
+
+class SimVerifier(Verifier):
+    """
+    Verifies signatures on the scheduler's thread, and answers on simulated time
+    """
+
+    def __init__(self, network):
+        """
+        :type network: Network
+        """
+        super(SimVerifier, self).__init__()
+        self.network = network
+
+    def verify_async(self, transactions, callback):
+        self.network.scheduler.call_later(0.0, callback, self.verify(transactions))
+
+    def verify(self, transactions):
+        return [t.has_valid_signature() for t in transactions]
+
+    def close(self):
+        pass
+
+
+class SimNode(Node):
+    """
+    A Node run by a Network rather than by a thread of its own
+    """
+
+    def __init__(self, network, node_id, hash_rate=None, log_level=logging.ERROR,
+                 **kwargs):
+        """
+        :type network: Network
+        :param hash_rate: hashes per simulated second, when mining with a difficulty
+        :type hash_rate: float
+        :param kwargs: as for Node; the backend defaults to a MemoryBackend
+        """
+        kwargs.setdefault('backend', MemoryBackend())
+        super(SimNode, self).__init__(node_id, log_level=log_level, **kwargs)
+        self.network = network
+        if self.miner is not None:
+            self.miner = SimMiner(network, self.difficulty, hash_rate)
+        self.verifier = SimVerifier(network)
+        self._own_verifier = True
+        self._proxy = network.proxy(self, self)
+        self.seen_blocks = set()
+        # tip hash of blocks received -> the node they came from, not to relay them back
+        self._block_senders = {}
+
+    def _clock(self):
+        return self.network.scheduler.now
+
+    def _utcnow(self):
+        return pytz.UTC.localize(EPOCH + timedelta(seconds=self.network.scheduler.now))
+
+    def _call_later(self, delay, func):
+        return self.network.scheduler.call_later(delay, func)
+
+    def _future(self):
+        return CallbackFuture()
+
+    def _run_task(self, task):
+        self.network.run_task(task, self.SHARE_TIMEOUT)
+
+    def register_transactions(self, batch, sender_id=None, requested=()):
+        known = [self.pending_transactions.knows(t.hash) for t in batch]
+        super(SimNode, self).register_transactions(batch, sender_id, requested)
+        for transaction, was_known in zip(batch, known):
+            if not was_known and self.pending_transactions.knows(transaction.hash):
+                self.network.transaction_arrived(self, transaction)
+
+    def _chain_changed(self):
+        super(SimNode, self)._chain_changed()
+        self.network.chain_changed(self)
+
+    def receive_blocks(self, height, blocks):
+        if blocks and self.network.delivering_from is not self:
+            self._block_senders[blocks[-1].hash] = self.network.delivering_from
+        return super(SimNode, self).receive_blocks(height, blocks)
+
+    def _switch_to(self, fork_height, branch):
+        super(SimNode, self)._switch_to(fork_height, branch)
+        if not branch:
+            return
+        # Relay the blocks just accepted, and only those, to every peer but the sender.
+        # A peer missing blocks before them, as relays can overtake each other, rejects
+        # them, and is then brought up to date as share_chain would.
+        sender = self._block_senders.pop(branch[-1].hash, None)
+        for peer in self.peer_proxies:
+            if peer._target is not sender:
+                peer.receive_blocks(fork_height, branch).add_callback(
+                    lambda future, peer=peer: self._relayed(peer, future))
+
+    def _relayed(self, peer, future):
+        if future._value == REJECTED:
+            self._run_task(self._catch_up(peer))
+
+    def _catch_up(self, peer):
+        """
+        A task (see _run_task): send a peer the blocks after the prefix it shares with
+        this node's chain
+        """
+        tip_hash = self.chain.latest_hash()
+        try:
+            height = yield peer.find_common_length(self.chain.locator())
+            blocks = yield self._proxy.blocks_since(height, tip_hash)
+            if blocks:
+                yield peer.receive_blocks(height, blocks)
+        except Timeout:
+            pass
+
+
+class Simulation(object):
+    """
+    A network of SimNodes, each connected to some others at random, and a stream of
+    transactions submitted to random nodes
+    """
+
+    def __init__(self, nodes=100, peers=8, seed=0, latency=0.05, jitter=0.5,
+                 bandwidth=1e6, loss=0.0, hash_rate=None, **node_options):
+        """
+        :param nodes: number of nodes
+        :type nodes: int
+        :param peers: number of others each node connects to; connections go both ways,
+            so most nodes end up with more
+        :type peers: int
+        :type seed: int
+        :param latency: see Network
+        :param jitter: see Network
+        :param bandwidth: see Network
+        :param loss: see Network
+        :param hash_rate: see SimNode
+        :param node_options: passed on to each Node, such as difficulty, gossip_window
+            or gossip_mode
+        """
+        self.network = Network(seed=seed, latency=latency, jitter=jitter,
+                               bandwidth=bandwidth, loss=loss)
+        self.nodes = [SimNode(self.network, 'sim%d' % i, hash_rate=hash_rate,
+                              **node_options)
+                      for i in xrange(nodes)]
+        self.network.node_count = nodes
+        rng = self.network.rng
+        connected = set()
+        for i, node in enumerate(self.nodes):
+            others = [j for j in xrange(nodes) if j != i]
+            for j in rng.sample(others, min(peers, len(others))):
+                pair = (min(i, j), max(i, j))
+                if pair in connected:
+                    continue
+                connected.add(pair)
+                other = self.nodes[j]
+                self.network.connect(node, other)
+                node.register_peer(self.network.proxy(node, other))
+                other.register_peer(self.network.proxy(other, node))
+        self.duration = 0.0
+        self._transaction_count = 0
+
+    def run(self, duration, transaction_rate=10.0, settle=10.0):
+        """
+        Submit transactions for `duration` simulated seconds, then let the network
+        settle for `settle` more
+        :type duration: float
+        :param transaction_rate: mean transactions per second, arriving at random
+        :type transaction_rate: float
+        :type settle: float
+        :return: see report
+        :rtype: dict
+        """
+        scheduler = self.network.scheduler
+        start = scheduler.now
+        end = start + duration
+        self._schedule_transaction(transaction_rate, end)
+        scheduler.run(until=end + settle)
+        self.duration += duration
+        return self.report()
+
+    def _schedule_transaction(self, rate, end):
+        network = self.network
+        when = network.scheduler.now + network.rng.expovariate(rate)
+        if when < end:
+            network.scheduler.call_at(when, self._submit_transaction, rate, end)
+
+    def _submit_transaction(self, rate, end):
+        network = self.network
+        rng = network.rng
+        node = rng.choice(self.nodes)
+        self._transaction_count += 1
+        transaction = Transaction(
+            seller_id='seller%d' % rng.randint(0, 99),
+            buyer_id='buyer%d' % rng.randint(0, 99),
+            timestamp=node._utcnow(),
+            amount=self._transaction_count,
+            fee=rng.randint(0, 10))
+        network.submitted[transaction.hash] = (network.scheduler.now, node.node_id)
+        node.register_transactions([transaction])
+        self._schedule_transaction(rate, end)
+
+    def reference_chain(self):
+        """
+        :return: the chain most nodes agree on; the longest such on a tie
+        :rtype: blokka.entities.Chain
+        """
+        tips = Counter(node.chain.latest_hash() for node in self.nodes)
+        return max(self.nodes, key=lambda node: (
+            tips[node.chain.latest_hash()], node.chain.length, node.chain.latest_hash())
+        ).chain
+
+    def report(self):
+        """
+        :return: simulated seconds of transactions submitted; propagation delays in
+            simulated seconds, as percentiles (of each block's and transaction's
+            arrival at each node, and of each block's arrival at the last node); the
+            fork rate, the fraction of mined blocks that did not end up in the chain
+            most nodes agree on; throughput, in transactions confirmed by that chain
+            per simulated second; the fraction of nodes that agree on it; and network
+            totals
+        :rtype: dict
+        """
+        network = self.network
+        chain = self.reference_chain()
+        confirmed = set()
+        for block in chain.blocks:
+            confirmed.update(h for h in block.transaction_hashes()
+                             if h in network.submitted)
+        tip = chain.latest_hash()
+        mined = len(network.block_reach)
+        return {
+            'nodes': len(self.nodes),
+            'duration': self.duration,
+            'simulated_seconds': network.scheduler.now,
+            'events': network.scheduler.events_run,
+            'transactions_submitted': len(network.submitted),
+            'transactions_confirmed': len(confirmed),
+            'throughput': len(confirmed) / self.duration if self.duration else None,
+            'blocks_mined': mined,
+            'chain_length': chain.length,
+            'fork_rate': 1 - float(chain.length) / mined if mined else None,
+            'consensus': (sum(1 for n in self.nodes if n.chain.latest_hash() == tip) /
+                          float(len(self.nodes))),
+            'block_propagation': _summary(network.block_delays),
+            'block_full_propagation': _summary(network.block_full_delays),
+            'transaction_propagation': _summary(network.transaction_delays),
+            'messages_sent': network.messages_sent,
+            'messages_lost': network.messages_lost,
+            'bytes_sent': network.bytes_sent,
+        }
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0, 'p50': None, 'p90': None, 'max': None}
+    return {'count': len(values),
+            'p50': values[len(values) // 2],
+            'p90': values[min(int(len(values) * 0.9), len(values) - 1)],
+            'max': values[-1]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a network of blokka nodes')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--peers', type=int, default=8,
+                        help='connections each node makes')
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='simulated seconds of transactions')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='transactions per simulated second')
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help='simulated seconds to run on for afterwards')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds')
+    parser.add_argument('--bandwidth', type=float, default=1e6, help='bytes per second')
+    parser.add_argument('--loss', type=float, default=0.0, help='message loss rate')
+    parser.add_argument('--difficulty', type=int, help='proof-of-work difficulty')
+    parser.add_argument('--hash-rate', type=float, default=1000.0,
+                        help='hashes per simulated second, per node')
+    parser.add_argument('--gossip-window', type=float)
+    parser.add_argument('--gossip-mode', choices=[GOSSIP_PUSH, GOSSIP_INVENTORY],
+                        default=GOSSIP_PUSH)
+    args = parser.parse_args(argv)
+
+    simulation = Simulation(
+        nodes=args.nodes, peers=args.peers, seed=args.seed, latency=args.latency,
+        bandwidth=args.bandwidth, loss=args.loss, hash_rate=args.hash_rate,
+        difficulty=args.difficulty, gossip_window=args.gossip_window,
+        gossip_mode=args.gossip_mode)
+    report = simulation.run(args.duration, transaction_rate=args.rate,
+                            settle=args.settle)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Streaming access to JSON chain files, as written by FileBackend: a JSON object whose
+"blocks" member is the list of block dicts.
+
+Blocks are read one at a time from a buffer of bounded size, and written one at a time,
+so neither needs the whole chain in memory. A ChainFile indexes where each block starts
+and its hash, and decodes blocks only when they are accessed.
+"""
+import json
+import re
+from array import array
+from binascii import hexlify, unhexlify
+
+from blokka.entities import Block
+
+CHUNK_SIZE = 1 << 16
+
+_HEADER = re.compile(br'\s*\{\s*"blocks"\s*:\s*\[')
+_WHITESPACE = re.compile(br'[\s,]*')
+_SEPARATORS = b' \t\r\n,'
+_decoder = json.JSONDecoder()
+
+
+def iter_block_dicts(f, chunk_size=CHUNK_SIZE):
+    """
+    Read a JSON chain file one block at a time
+    :param f: opened in binary mode, positioned at the start of the chain
+    :type f: file
+    :param chunk_size: bytes to read at a time; a block larger than this is read in
+        growing chunks
+    :type chunk_size: int
+    :return: each block's offset in the file and its dict
+    :rtype: collections.Iterable[(int, dict)]
+    :raise ValueError: if the file is not a chain file, or is cut short
+    """
+    base = f.tell()
+    buf = f.read(chunk_size)
+    header = _HEADER.match(buf)
+    if header is None:
+        raise ValueError('Not a JSON chain file')
+    pos = header.end()
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos < len(buf) and buf[pos:pos + 1] == b']':
+            return
+        try:
+            if pos == len(buf):
+                raise ValueError('Need more input')
+            dct, end = _decoder.raw_decode(buf, pos)
+        except ValueError:
+            more = f.read(max(chunk_size, len(buf) - pos))
+            if not more:
+                raise ValueError('Chain file is cut short at offset {}'.format(base + pos))
+            buf = buf[pos:] + more
+            base += pos
+            pos = 0
+            continue
+        yield base + pos, dct
+        pos = end
+        if pos >= chunk_size:
+            # Drop what has been consumed, so the buffer stays bounded
+            buf = buf[pos:]
+            base += pos
+            pos = 0
+
+
+def iter_blocks(f, chunk_size=CHUNK_SIZE):
+    """
+    :type f: file
+    :type chunk_size: int
+    :rtype: collections.Iterable[blokka.entities.Block]
+    """
+    for _, dct in iter_block_dicts(f, chunk_size):
+        yield Block.from_dict(dct)
+
+
+def write_chain(f, blocks):
+    """
+    Write a JSON chain file one block at a time; it reads back with json.load, as well
+    as with iter_blocks
+    :param f: opened in binary mode
+    :type f: file
+    :param blocks: any sequence or iterable of blocks. The blocks a lazy view (see
+        blokka.backends.MappedBlocks) reads from a ChainFile unchanged are copied from
+        the file rather than decoded and encoded again.
+    :type blocks: collections.Iterable[blokka.entities.Block]
+    :return: the offset of each block in the file
+    :rtype: array.array
+    """
+    if isinstance(getattr(blocks, 'segment', None), ChainFile):
+        payloads = (blocks.encoded_at(h) or json.dumps(blocks[h].to_dict())
+                    for h in xrange(len(blocks)))
+    else:
+        payloads = (json.dumps(block.to_dict()) for block in blocks)
+    offsets = array('L')
+    f.write(b'{"blocks": [')
+    offset = f.tell()
+    for i, payload in enumerate(payloads):
+        if i > 0:
+            f.write(b', ')
+            offset += 2
+        offsets.append(offset)
+        f.write(payload)
+        offset += len(payload)
+    f.write(b']}')
+    return offsets
+
+
+class ChainFile(object):
+    """
+    A JSON chain file opened for lazy reading. Offers the same lookups as a segment of
+    blokka.backends.MmapBackend, so a MappedBlocks view can be built over it.
+    """
+
+    def __init__(self, f, offsets=None, hashes=None):
+        """
+        :param f: opened in binary mode
+        :type f: file
+        :param offsets: of each block in the file, if already known (default: found by
+            reading the file through once)
+        :type offsets: array.array
+        :param hashes: of each block, if already known along with the offsets
+        :type hashes: list[str]
+        """
+        self.file = f
+        if offsets is None:
+            f.seek(0)
+            offsets = array('L')
+            hashes = []
+            for offset, dct in iter_block_dicts(f):
+                offsets.append(offset)
+                hashes.append(dct.get('hash') or Block.from_dict(dct).hash)
+        self.offsets = offsets
+        self.length = len(offsets)
+        # Raw digests, 32 bytes each, to keep the index small
+        self._hashes = b''.join(unhexlify(h) for h in hashes)
+        f.seek(0, 2)
+        self._size = f.tell()
+        self._heights = None
+        self._last = (None, None)
+
+    def encoded_at(self, height):
+        """
+        :type height: int
+        :return: the block's JSON, as it is in the file
+        :rtype: bytes
+        """
+        start = self.offsets[height]
+        end = self.offsets[height + 1] if height + 1 < self.length else self._size
+        self.file.seek(start)
+        buf = self.file.read(end - start)
+        if len(buf) < end - start:
+            raise ValueError('Chain file is cut short at height {}'.format(height))
+        # Drop the separator after the block, or the end of the list and object
+        buf = buf.rstrip(_SEPARATORS)
+        if height + 1 == self.length:
+            buf = buf[:-1].rstrip()[:-1].rstrip(_SEPARATORS)
+        return buf
+
+    def block_at(self, height):
+        """
+        :type height: int
+        :rtype: blokka.entities.Block
+        """
+        if self._last[0] == height:
+            return self._last[1]
+        block = Block.from_dict(json.loads(self.encoded_at(height)))
+        self._last = (height, block)
+        return block
+
+    def hash_at(self, height):
+        """
+        :type height: int
+        :rtype: str
+        """
+        if not 0 <= height < self.length:
+            raise IndexError('block index out of range')
+        return hexlify(self._hashes[32 * height:32 * (height + 1)])
+
+    def height_of(self, block_hash):
+        """
+        :type block_hash: str
+        :rtype: int
+        """
+        if self._heights is None:
+            self._heights = {self.hash_at(h): h for h in xrange(self.length)}
+        return self._heights.get(block_hash)
+
+    def close(self):
+        self.file.close()
@@ -14,3 +14,6 @@ class MockFileBackend(object):
 
     def load_chain(self, node_id):
         return self.chains.get(node_id)
+
+    def prune(self, node_id, height):
+        pass
@@ -1,16 +1,53 @@
 #!/usr/bin/env python
 # Author(s): 'Percy Link' <percylink@gmail.com>
 import copy
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from datetime import datetime
 
 import pytz
 
-from blokka.actors import Node, ACCEPTED, REJECTED
-from blokka.entities import Chain, Transaction, Block
+from blokka import signing
+from blokka.actors import Node, ACCEPTED, REJECTED, FLUSH_DEFERRED, GOSSIP_INVENTORY
+from blokka.backends import LogFileBackend
+from blokka.entities import Chain, Transaction, Block, meets_target
+from blokka.ledger import Ledger
+from blokka.merkle import merkle_root
+from blokka.mining import MiningResult
 from blokka.test import MockFileBackend
 
 
+class CountingNode(Node):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingNode, self).__init__(*args, **kwargs)
+        self.received = 0
+
+    def register_transactions(self, batch, sender_id=None, requested=()):
+        self.received += len(batch)
+        super(CountingNode, self).register_transactions(batch, sender_id, requested)
+
+    def announce_transactions(self, sender, sender_id, hashes):
+        self.received += len(hashes)
+        super(CountingNode, self).announce_transactions(sender, sender_id, hashes)
+
+
+class StuckNode(Node):
+
+    def receive_blocks(self, height, new_blocks):
+        time.sleep(1)
+        return super(StuckNode, self).receive_blocks(height, new_blocks)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
 class TestNode(unittest.TestCase):
 
     def test_chain(self):
@@ -33,6 +70,53 @@ class TestNode(unittest.TestCase):
         finally:
             node.stop()
 
+    def test_chain_write_through(self):
+        node = None
+        try:
+            node_id = 'aaa'
+            backend = MockFileBackend(chains={})
+            node = Node.start(node_id=node_id, backend=backend)
+            proxy = node.proxy()
+            self.assertEqual(proxy.chain.get(), Chain(blocks=[]))
+            t = Transaction(
+                seller_id='s',
+                buyer_id='b',
+                timestamp=datetime(2017, 11, 1, 1, 2, 3, tzinfo=pytz.UTC),
+                amount=1.0
+            )
+            proxy.register_transaction(t).get()
+            proxy.mine_block().get()
+            self.assertEqual(proxy.chain.get().length, 1)
+            self.assertEqual(proxy.chain.get().blocks[0].transaction_hashes(), [t.hash])
+            # Confirmed transactions leave the pool and are not taken in again
+            self.assertEqual(len(proxy.pending_transactions.get()), 0)
+            proxy.register_transaction(t).get()
+            self.assertEqual(len(proxy.pending_transactions.get()), 0)
+            self.assertTrue(proxy.chain.get().blocks[0].has_valid_merkle_root())
+            self.assertIs(backend.saved[node_id], proxy.chain.get())
+        finally:
+            node.stop()
+
+    def test_chain_deferred_flush(self):
+        node = None
+        try:
+            node_id = 'aaa'
+            backend = MockFileBackend(chains={})
+            node = Node.start(node_id=node_id, backend=backend,
+                              flush_policy=FLUSH_DEFERRED, flush_every=2)
+            proxy = node.proxy()
+            proxy.mine_block().get()
+            self.assertEqual(backend.saved, {})
+            proxy.mine_block().get()
+            self.assertEqual(backend.saved[node_id].length, 2)
+            backend.saved.clear()
+            proxy.mine_block().get()
+            self.assertEqual(backend.saved, {})
+            proxy.flush().get()
+            self.assertEqual(backend.saved[node_id].length, 3)
+        finally:
+            node.stop()
+
     def test_register_peer(self):
         n1 = None
         n2 = None
@@ -70,6 +154,79 @@ class TestNode(unittest.TestCase):
             n1.stop()
             n2.stop()
 
+    def test_register_transactions_batched_gossip(self):
+        n1 = None
+        n2 = None
+        try:
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}), gossip_window=0.05,
+                            gossip_batch_size=3)
+            n2 = Node.start(node_id='2', backend=MockFileBackend({}))
+            p1 = n1.proxy()
+            p2 = n2.proxy()
+            p1.register_peer(p2)
+            ts = [Transaction(
+                seller_id='s',
+                buyer_id='b',
+                timestamp=datetime(2017, 11, 1, 1, 2, 3, tzinfo=pytz.UTC),
+                amount=i
+            ) for i in xrange(4)]
+
+            # A full batch is forwarded at once
+            p1.register_transactions(ts[:3] + ts[:1]).get()
+            self.assertEqual(p2.pending_transactions.get(), {t.hash: t for t in ts[:3]})
+
+            # A partial batch waits for the window
+            p1.register_transactions(ts[3:]).get()
+            self.assertEqual(len(p2.pending_transactions.get()), 3)
+            time.sleep(0.2)
+            self.assertEqual(p2.pending_transactions.get(), {t.hash: t for t in ts})
+        finally:
+            n1.stop()
+            n2.stop()
+
+    def gossip_mesh(self, **kwargs):
+        nodes = [CountingNode.start(node_id=str(i), backend=MockFileBackend({}), **kwargs)
+                 for i in xrange(4)]
+        proxies = [n.proxy() for n in nodes]
+        for p in proxies:
+            for q in proxies:
+                if p is not q:
+                    p.register_peer(q).get()
+        ts = [Transaction(
+            seller_id='s',
+            buyer_id='b',
+            timestamp=datetime(2017, 11, 1, 1, 2, 3, tzinfo=pytz.UTC),
+            amount=i
+        ) for i in xrange(3)]
+        try:
+            proxies[0].register_transactions(ts).get()
+            deadline = time.time() + 5
+            while time.time() < deadline and not all(
+                    len(p.pending_transactions.get()) == 3 for p in proxies):
+                time.sleep(0.01)
+            time.sleep(0.05)
+            for p in proxies:
+                self.assertEqual(p.pending_transactions.get(), {t.hash: t for t in ts})
+            return [p.received.get() for p in proxies]
+        finally:
+            for n in nodes:
+                n.stop()
+
+    def test_gossip_does_not_echo(self):
+        # Node 0 sends to 3 peers, each of which relays to at most the 2 peers it has
+        # not heard from. The first peer can only have heard from node 0, so sends
+        # nothing back; the others only do if a relay overtakes node 0's own copy.
+        received = self.gossip_mesh()
+        self.assertLessEqual(received[0], 3 + 2 * 3)
+        self.assertLessEqual(sum(received), 3 + 3 * 3 + 3 * 3 * 2)
+
+    def test_gossip_inventory(self):
+        # As above, counting announced hashes, plus each peer requesting the 3
+        # transactions once
+        received = self.gossip_mesh(gossip_mode=GOSSIP_INVENTORY)
+        self.assertLessEqual(received[0], 3 + 2 * 3)
+        self.assertLessEqual(sum(received), 3 + 3 * 3 + 3 * 3 * 2 + 3 * 3)
+
     def test_should_mine(self):
         n1 = None
         try:
@@ -82,6 +239,36 @@ class TestNode(unittest.TestCase):
         finally:
             n1.stop()
 
+    def test_mine_block_takes_best_transactions(self):
+        n1 = None
+        n2 = None
+        try:
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}))
+            n2 = Node.start(node_id='2', backend=MockFileBackend({}))
+            p1 = n1.proxy()
+            p2 = n2.proxy()
+            p1.register_peer(p2).get()
+            ts = [Transaction(seller_id='s', buyer_id='b',
+                              timestamp=datetime(2017, 11, 1, 1, 2, 3, tzinfo=pytz.UTC),
+                              amount=i, fee=i % 4)
+                  for i in xrange(Node.BLOCK_SIZE + 3)]
+            # Registering enough transactions mines a block on its own
+            p1.register_transactions(ts).get()
+            chain = p1.chain.get()
+            self.assertEqual(chain.length, 1)
+            best = sorted(ts, key=lambda t: -t.fee)[:Node.BLOCK_SIZE]
+            self.assertEqual(chain.blocks[0].transaction_hashes(),
+                             sorted(t.hash for t in best))
+            self.assertEqual(set(p1.pending_transactions.get()),
+                             set(t.hash for t in ts) - set(t.hash for t in best))
+            # The peer drops the confirmed transactions when it takes the block
+            wait_for(lambda: p2.chain.get().length == 1)
+            self.assertEqual(set(p2.pending_transactions.get()),
+                             set(p1.pending_transactions.get()))
+        finally:
+            n1.stop()
+            n2.stop()
+
     def test_receive_chain_accept(self):
         n1 = None
         try:
@@ -111,6 +298,29 @@ class TestNode(unittest.TestCase):
         finally:
             n1.stop()
 
+    def test_receive_chain_reject_invalid(self):
+        n1 = None
+        try:
+            blk = {
+                'timestamp': '2017-01-02T03:04:05.000123Z',
+                'prev_hash': '1234',
+                'data': {'foo': 'bar'}
+            }
+            chain = Chain.from_dict({'blocks': [blk]})
+            n1 = Node.start(node_id='blah', backend=MockFileBackend({'blah': chain}))
+            p1 = n1.proxy()
+            blk2 = {
+                'timestamp': '2017-01-02T03:04:05.000123Z',
+                'prev_hash': Block.from_dict(blk).hash,
+                'data': {'a': 'b'},
+                'hash': '0' * 64
+            }
+            res = p1.receive_chain(Chain.from_dict({'blocks': [blk, blk2]})).get()
+            self.assertEqual(res, REJECTED)
+            self.assertEqual(p1.chain.get().length, 1)
+        finally:
+            n1.stop()
+
     def test_receive_chain_accept_same(self):
         n1 = None
         try:
@@ -206,6 +416,280 @@ class TestNode(unittest.TestCase):
         finally:
             n1.stop()
 
+    def test_reorg_to_longer_branch(self):
+        n1 = None
+        try:
+            def tx(i):
+                return Transaction(seller_id='s', buyer_id='b',
+                                   timestamp=datetime(2017, 11, 1, 1, 2, 3), amount=i)
+
+            def block(prev, txs, i):
+                return Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                             prev_hash=prev.hash if prev else None,
+                             data={t.hash: t.to_dict() for t in txs},
+                             merkle_root=merkle_root(sorted(t.hash for t in txs)))
+
+            genesis = block(None, [], 0)
+            a1 = block(genesis, [tx(1), tx(2)], 1)
+            b1 = block(genesis, [tx(2), tx(3)], 2)
+            b2 = block(b1, [tx(4)], 3)
+            n1 = Node.start(node_id='1', backend=MockFileBackend(
+                {'1': Chain(blocks=[genesis, a1])}))
+            p1 = n1.proxy()
+
+            # A fork of the same length loses, but is kept
+            self.assertEqual(p1.receive_blocks(1, [b1]).get(), REJECTED)
+            self.assertEqual(p1.chain.get().blocks, [genesis, a1])
+            self.assertEqual(len(p1.block_tree.get()), 1)
+
+            # Once it is extended, only the new block needs sending
+            self.assertEqual(p1.receive_blocks(2, [b2]).get(), ACCEPTED)
+            self.assertEqual(p1.chain.get().blocks, [genesis, b1, b2])
+            # a1's transactions are pending again, except the one b1 also has
+            self.assertEqual(set(p1.pending_transactions.get()), {tx(1).hash})
+            self.assertTrue(a1.hash in p1.block_tree.get())
+            self.assertFalse(b1.hash in p1.block_tree.get())
+
+            # Blocks building on an unknown parent are rejected
+            orphan = block(block(None, [tx(5)], 9), [], 4)
+            self.assertEqual(p1.receive_blocks(5, [orphan]).get(), REJECTED)
+            self.assertEqual(p1.receive_blocks(2, [orphan]).get(), REJECTED)
+            self.assertEqual(len(p1.block_tree.get()), 1)
+            self.assertEqual(p1.chain.get().blocks, [genesis, b1, b2])
+        finally:
+            n1.stop()
+
+    def test_ledger(self):
+        n1 = None
+        directory = tempfile.mkdtemp()
+        try:
+            def tx(i):
+                return Transaction(seller_id='s', buyer_id='b%d' % i,
+                                   timestamp=datetime(2017, 11, 1, 1, 2, 3), amount=i)
+
+            def block(prev, txs, i):
+                return Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                             prev_hash=prev.hash if prev else None,
+                             data={t.hash: t.to_dict() for t in txs},
+                             merkle_root=merkle_root(sorted(t.hash for t in txs)))
+
+            genesis = block(None, [tx(1)], 0)
+            a1 = block(genesis, [tx(2)], 1)
+            b1 = block(genesis, [tx(3)], 2)
+            b2 = block(b1, [tx(4)], 3)
+            path = os.path.join(directory, 'ledger.json')
+            backend = MockFileBackend({'1': Chain(blocks=[genesis, a1])})
+            n1 = Node.start(node_id='1', backend=backend, ledger_path=path,
+                            ledger_snapshot_every=3)
+            p1 = n1.proxy()
+            self.assertEqual(p1.balance('s').get(), 3)
+            self.assertEqual(p1.balance('b2').get(), -2)
+
+            # The reorg takes a1 off and puts b1 and b2 on
+            self.assertEqual(p1.receive_blocks(1, [b1, b2]).get(), ACCEPTED)
+            self.assertEqual(p1.balance('s').get(), 8)
+            self.assertEqual(p1.balance('b2').get(), 0)
+            self.assertEqual(p1.account_history('s', since=2).get(),
+                             [(2, tx(4).hash, 4)])
+            # Three blocks changed, so a snapshot was taken
+            self.assertEqual(Ledger.load(path).height, 3)
+
+            # Mined blocks are added; the snapshot on stop is loaded on restart
+            for i in xrange(5, 5 + Node.BLOCK_SIZE):
+                p1.register_transaction(tx(i))
+            wait_for(lambda: p1.chain.get().length == 4)
+            balance = p1.balance('s').get()
+            n1.stop()
+            self.assertEqual(Ledger.load(path).height, 4)
+            n1 = Node.start(node_id='1', backend=backend, ledger_path=path)
+            self.assertEqual(n1.proxy().balance('s').get(), balance)
+        finally:
+            n1.stop()
+            shutil.rmtree(directory)
+
+    def test_pruning(self):
+        n1 = None
+        n2 = None
+        directory = tempfile.mkdtemp()
+        try:
+            backend = MockFileBackend({})
+            archive_dir = os.path.join(directory, 'archive')
+            n1 = Node.start(node_id='1', backend=backend, prune_depth=2,
+                            ledger_path=os.path.join(directory, '1.ledger'),
+                            archive_dir=archive_dir)
+            p1 = n1.proxy()
+            for i in xrange(4):
+                p1.register_transaction(Transaction(
+                    seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                    amount=i)).get()
+                p1.mine_block().get()
+
+            # The two oldest blocks are headers, and archived
+            chain = p1.chain.get()
+            self.assertEqual((chain.length, chain.pruned_height), (4, 2))
+            self.assertEqual(backend.saved['1'].pruned_height, 2)
+            self.assertEqual(os.listdir(archive_dir), ['1.0000000000.json'])
+            self.assertEqual(p1.balance('s').get(), 6)
+            self.assertEqual(p1.account_history('s').get()[0][0], 2)
+            self.assertEqual(p1.metrics().get()['chain_pruned_height'], 2)
+            fork = Block(timestamp=datetime(2017, 11, 2), prev_hash=chain.hash_at(0),
+                         data={})
+            self.assertEqual(p1.receive_blocks(1, [fork]).get(), REJECTED)
+
+            # A new node starts from a snapshot and keeps up from there
+            snapshot = p1.snapshot(recent_blocks=1).get()
+            self.assertEqual(snapshot.height, 3)
+            n2 = Node.start(node_id='2', backend=MockFileBackend({}), snapshot=snapshot)
+            p2 = n2.proxy()
+            self.assertEqual(p2.balance('s').get(), 6)
+            p1.register_peer(p2).get()
+            p1.mine_block().get()
+            wait_for(lambda: p2.chain.get().length == 5)
+            self.assertEqual(p2.chain.get().latest_hash(), p1.chain.get().latest_hash())
+
+            # Restarting needs the ledger the pruned blocks left behind
+            n1.stop()
+            self.assertRaises(ValueError, Node.start, node_id='1', backend=backend)
+            n1 = Node.start(node_id='1', backend=backend,
+                            ledger_path=os.path.join(directory, '1.ledger'))
+            self.assertEqual(n1.proxy().balance('s').get(), 6)
+        finally:
+            n1.stop()
+            if n2 is not None:
+                n2.stop()
+            shutil.rmtree(directory)
+
+    def test_pruning_on_disk(self):
+        n1 = None
+        directory = tempfile.mkdtemp()
+        backend = LogFileBackend()
+        path = os.path.join(LogFileBackend.FILE_DIR, 'pruned.log')
+        try:
+            n1 = Node.start(node_id='pruned', backend=backend, prune_depth=2,
+                            ledger_path=os.path.join(directory, 'pruned.ledger'))
+            p1 = n1.proxy()
+            for i in xrange(3):
+                p1.register_transaction(Transaction(
+                    seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                    amount=i)).get()
+                p1.mine_block().get()
+            size = os.path.getsize(path)
+            p1.register_transaction(Transaction(
+                seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                amount=3)).get()
+            p1.mine_block().get()
+            # The fourth block is written, and the two oldest shrink to headers
+            self.assertLess(os.path.getsize(path), size)
+            self.assertEqual(LogFileBackend().load_chain('pruned').pruned_height, 2)
+        finally:
+            if n1 is not None:
+                n1.stop()
+            backend.close()
+            os.remove(path)
+            shutil.rmtree(directory)
+
+    def test_pruning_deferred_flush(self):
+        n1 = None
+        n2 = None
+        directory = tempfile.mkdtemp()
+        backend = LogFileBackend()
+        path = os.path.join(LogFileBackend.FILE_DIR, 'deferred.log')
+        ledger_path = os.path.join(directory, 'deferred.ledger')
+        try:
+            n1 = Node.start(node_id='deferred', backend=backend, prune_depth=2,
+                            ledger_path=ledger_path, ledger_snapshot_every=1,
+                            flush_policy=FLUSH_DEFERRED)
+            p1 = n1.proxy()
+            for i in xrange(5):
+                p1.register_transaction(Transaction(
+                    seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                    amount=i)).get()
+                p1.mine_block().get()
+            # The fifth block is not flushed yet, so neither is a snapshot with it
+            self.assertEqual(Ledger.load(ledger_path).height, 4)
+
+            # A node restarted from the disk as it is now, as after a crash, starts
+            # from the snapshot instead of replaying the pruned blocks
+            n2 = Node.start(node_id='deferred', backend=LogFileBackend(),
+                            ledger_path=ledger_path)
+            self.assertEqual(n2.proxy().chain.get().length, 4)
+            self.assertEqual(n2.proxy().balance('s').get(), 6)
+        finally:
+            if n2 is not None:
+                n2.stop()
+            if n1 is not None:
+                n1.stop()
+            backend.close()
+            os.remove(path)
+            shutil.rmtree(directory)
+
+    def test_signed_transactions(self):
+        n1 = None
+        n2 = None
+        try:
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}),
+                            require_signatures=True, verify_processes=1)
+            n2 = Node.start(node_id='2', backend=MockFileBackend({}),
+                            require_signatures=True, verify_processes=1)
+            p1 = n1.proxy()
+            p2 = n2.proxy()
+            p1.register_peer(p2)
+            secret = signing.generate_secret()
+            buyer_id = signing.account_id(signing.public_key(secret))
+
+            def tx(i, buyer_id=buyer_id):
+                return Transaction(seller_id='s', buyer_id=buyer_id,
+                                   timestamp=datetime(2017, 11, 1), amount=i)
+
+            signed = [tx(i).signed(secret) for i in xrange(4)]
+            forged = tx(9).signed(signing.generate_secret())
+            p1.register_transactions(signed + [forged, tx(10)]).get()
+            wait_for(lambda: len(p2.pending_transactions.get()) == 4)
+            self.assertEqual(set(p1.pending_transactions.get()),
+                             set(t.hash for t in signed))
+            self.assertEqual(set(p2.pending_transactions.get()),
+                             set(t.hash for t in signed))
+            metrics = p1.metrics().get()
+            self.assertEqual(metrics['transactions_invalid_total'], 2)
+            self.assertEqual(metrics['signatures_verified_total'], 5)
+
+            # Transactions seen before are not verified again, on their own or in blocks
+            p1.register_transaction(signed[0]).get()
+            p1.mine_block()
+            wait_for(lambda: p2.chain.get().length == 1)
+            self.assertEqual(p2.chain.get(), p1.chain.get())
+            metrics = p1.metrics().get()
+            self.assertEqual(metrics['signatures_verified_total'], 5)
+            self.assertEqual(metrics['signature_cache_hits_total'], 1)
+            metrics = p2.metrics().get()
+            self.assertEqual(metrics['signatures_verified_total'], 4)
+            self.assertEqual(metrics['signature_cache_hits_total'], 4)
+
+            # Blocks with unsigned transactions are rejected
+            unsigned = tx(11, buyer_id='b')
+            block = Block(timestamp=datetime(2017, 11, 2),
+                          prev_hash=p2.chain.get().latest_hash(),
+                          data={unsigned.hash: unsigned.to_dict()},
+                          merkle_root=merkle_root([unsigned.hash]))
+            self.assertEqual(p2.receive_blocks(1, [block]).get(), REJECTED)
+
+            # Signatures not seen before are checked off the node's thread; the answer
+            # is a future, settled once they have been
+            def signed_block(transaction):
+                return Block(timestamp=datetime(2017, 11, 2),
+                             prev_hash=p2.chain.get().latest_hash(),
+                             data={transaction.hash: transaction.to_dict()},
+                             merkle_root=merkle_root([transaction.hash]))
+            reply = p2.receive_blocks(1, [signed_block(forged)]).get()
+            self.assertEqual(reply.get(timeout=5), REJECTED)
+            reply = p2.receive_blocks(1, [signed_block(tx(12).signed(secret))]).get()
+            self.assertEqual(reply.get(timeout=5), ACCEPTED)
+            self.assertEqual(p2.chain.get().length, 2)
+            self.assertEqual(p2.metrics().get()['signatures_verified_total'], 6)
+        finally:
+            n1.stop()
+            n2.stop()
+
     def test_share_chain_accepted(self):
         try:
             blk = {
@@ -246,7 +730,7 @@ class TestNode(unittest.TestCase):
             p1.register_peer(p2)
             p1.register_peer(p3)
             p1.register_peer(p4)
-            p1.share_chain().get()
+            self.assertEqual(p1.share_chain().get().get(timeout=5), ACCEPTED)
             for p in [p1, p2, p3]:
                 self.assertEqual(p.chain.get(), chain)
             self.assertEqual(p4.chain.get(), chain2)
@@ -296,9 +780,12 @@ class TestNode(unittest.TestCase):
             p1.register_peer(p2)
             p1.register_peer(p3)
             p1.register_peer(p4)
-            p1.share_chain().get()
-            self.assertEqual(p1.chain.get(), short_chain)
-            self.assertEqual(p2.chain.get(), short_chain)
+            self.assertEqual(p1.share_chain().get().get(timeout=5), REJECTED)
+            self.assertEqual(p1.chain.get(), Chain.from_dict({'blocks': [blk]}))
+            # p2 accepted the longer chain and keeps its own copy of it; the round may
+            # be decided before p2 has answered
+            wait_for(lambda: p2.chain.get().length == 2)
+            self.assertEqual(p2.chain.get(), Chain.from_dict(dct))
             self.assertEqual(p3.chain.get(), chain2)
             self.assertEqual(p4.chain.get(), chain2)
         finally:
@@ -306,3 +793,210 @@ class TestNode(unittest.TestCase):
             n2.stop()
             n3.stop()
             n4.stop()
+
+    def test_share_chain_sends_suffix(self):
+        n1 = None
+        n2 = None
+        try:
+            chain = Chain(blocks=[])
+            for i in xrange(30):
+                chain.add_block(Block(
+                    timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                    prev_hash=chain.latest_hash(),
+                    data={'i': i}
+                ))
+            prefix = Chain(blocks=chain.blocks[:25])
+            n1 = Node.start(node_id='1', backend=MockFileBackend({'1': chain}))
+            n2 = Node.start(node_id='2', backend=MockFileBackend({'2': prefix}))
+            p1 = n1.proxy()
+            p2 = n2.proxy()
+            self.assertEqual(p2.find_common_length(chain.locator()).get(), 25)
+            p1.register_peer(p2)
+            self.assertEqual(p1.share_chain().get().get(timeout=5), ACCEPTED)
+            self.assertEqual(p2.chain.get(), chain)
+            self.assertEqual(p2.receive_blocks(31, []).get(), REJECTED)
+            self.assertEqual(p2.receive_blocks(10, chain.blocks[10:20]).get(), ACCEPTED)
+        finally:
+            n1.stop()
+            n2.stop()
+
+    def test_share_chain_does_not_wait_for_stuck_peer(self):
+        nodes = []
+        try:
+            chain = Chain(blocks=[])
+            for i in xrange(3):
+                chain.add_block(Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                                      prev_hash=chain.latest_hash(), data={'i': i}))
+            n1 = Node.start(node_id='1', backend=MockFileBackend({'1': chain}))
+            nodes.append(n1)
+            p1 = n1.proxy()
+            p1.SHARE_TIMEOUT = 0.2
+            peers = []
+            for node_id in ['2', '3', '4']:
+                cls = StuckNode if node_id == '4' else Node
+                nodes.append(cls.start(node_id=node_id, backend=MockFileBackend({})))
+                peers.append(nodes[-1].proxy())
+            for peer in peers:
+                p1.register_peer(peer).get()
+            started = time.time()
+            outcome = p1.share_chain().get()
+            # The actor is free while the round is in flight
+            self.assertEqual(p1.chain.get(), chain)
+            self.assertEqual(outcome.get(timeout=5), ACCEPTED)
+            self.assertLess(time.time() - started, 1)
+            self.assertEqual(peers[0].chain.get(), chain)
+            self.assertEqual(peers[1].chain.get(), chain)
+
+            # A peer that times out does not count as a rejection either
+            p1.REJECTION_THRESH_FRAC = 0
+            self.assertEqual(p1.share_chain().get().get(timeout=5), ACCEPTED)
+            self.assertEqual(p1.chain.get(), chain)
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_share_chain_both_ways(self):
+        n1 = None
+        n2 = None
+        try:
+            chain = Chain(blocks=[])
+            for i in xrange(3):
+                chain.add_block(Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                                      prev_hash=chain.latest_hash(), data={'i': i}))
+            n1 = Node.start(node_id='1', backend=MockFileBackend({'1': chain}))
+            n2 = Node.start(node_id='2', backend=MockFileBackend(
+                {'2': Chain(blocks=chain.blocks[:1])}))
+            p1 = n1.proxy()
+            p2 = n2.proxy()
+            p1.register_peer(p2).get()
+            p2.register_peer(p1).get()
+            outcomes = [p1.share_chain(), p2.share_chain()]
+            results = [outcome.get(timeout=5).get(timeout=5) for outcome in outcomes]
+            self.assertEqual(results[0], ACCEPTED)
+            self.assertEqual(p1.chain.get(), chain)
+            wait_for(lambda: p2.chain.get().length == 3)
+            self.assertEqual(p2.chain.get(), chain)
+        finally:
+            n1.stop()
+            n2.stop()
+
+    def test_mine_block_proof_of_work(self):
+        n1 = None
+        n2 = None
+        try:
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}), difficulty=8)
+            n2 = Node.start(node_id='2', backend=MockFileBackend({}), difficulty=8)
+            p1 = n1.proxy()
+            p2 = n2.proxy()
+            p1.register_peer(p2)
+            p1.mine_block().get()
+            deadline = time.time() + 5
+            while p2.chain.get().length == 0 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(p2.chain.get(), p1.chain.get())
+            self.assertTrue(meets_target(p1.chain.get().latest_hash(), 8))
+            self.assertGreater(p1.last_mining_result.get().hashes, 0)
+
+            # Blocks without enough work are rejected
+            easy = Block(timestamp=datetime(2017, 1, 2),
+                         prev_hash=p2.chain.get().latest_hash(), data={}, nonce=0)
+            if not meets_target(easy.hash, 8):
+                self.assertEqual(p2.receive_blocks(1, [easy]).get(), REJECTED)
+        finally:
+            n1.stop()
+            n2.stop()
+
+    def test_competing_block_cancels_mining(self):
+        n1 = None
+        try:
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}), difficulty=256)
+            p1 = n1.proxy()
+            p1.mine_block().get()
+            job = p1.mining_job.get()
+            self.assertFalse(job.done())
+            p1.difficulty = None
+            competing = Block(timestamp=datetime(2017, 1, 2), prev_hash=None, data={})
+            self.assertEqual(p1.receive_blocks(0, [competing]).get(), ACCEPTED)
+            job.thread.join(5)
+            self.assertTrue(job.done())
+            self.assertIsNone(p1.mining_job.get())
+        finally:
+            n1.stop()
+
+    def test_mining_restarts_on_new_tip(self):
+        n1 = None
+        try:
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}), difficulty=256)
+            p1 = n1.proxy()
+            transactions = [Transaction(seller_id='s', buyer_id='b',
+                                        timestamp=datetime(2017, 11, 1), amount=i)
+                            for i in xrange(Node.BLOCK_SIZE)]
+            p1.register_transactions(transactions).get()
+            first = p1.mining_job.get()
+            self.assertFalse(first.done())
+
+            # A competing block without the transactions moves the tip on; mining
+            # starts again on top of it
+            p1.difficulty = None
+            competing = Block(timestamp=datetime(2017, 1, 2), prev_hash=None, data={})
+            self.assertEqual(p1.receive_blocks(0, [competing]).get(), ACCEPTED)
+            second = p1.mining_job.get()
+            self.assertIsNot(second, first)
+            self.assertFalse(second.done())
+
+            # So does a mined block that arrives after its job was cancelled
+            second.cancel()
+            second.thread.join(5)
+            stale = Block(timestamp=datetime(2017, 1, 3), prev_hash=None, data={})
+            p1.block_mined(MiningResult(block=stale, hashes=1, seconds=1.0,
+                                        hashes_per_second=1.0)).get()
+            self.assertEqual(p1.chain.get().latest_hash(), competing.hash)
+            third = p1.mining_job.get()
+            self.assertIsNotNone(third)
+            self.assertIsNot(third, second)
+            self.assertFalse(third.done())
+            third.cancel()
+        finally:
+            n1.stop()
+
+    def test_metrics(self):
+        n1 = None
+        n2 = None
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'node1.prom')
+            # Hold gossip back, so node 2 does not mine a competing block
+            n1 = Node.start(node_id='1', backend=MockFileBackend({}), gossip_window=60,
+                            metrics_path=path)
+            p1 = n1.proxy()
+            n2 = Node.start(node_id='2', backend=MockFileBackend({}))
+            p2 = n2.proxy()
+            p1.register_peer(p2)
+            transactions = [Transaction(seller_id='s', buyer_id='b',
+                                        timestamp=datetime(2017, 11, 1), amount=i)
+                            for i in xrange(Node.BLOCK_SIZE)]
+            p1.register_transactions(transactions[:1]).get()
+            p1.register_transactions(transactions).get()
+            wait_for(lambda: p1.metrics().get()['share_chain_rtt_seconds']['count'])
+
+            metrics = p1.metrics().get()
+            self.assertEqual(metrics['transactions_received_total'], 6)
+            self.assertEqual(metrics['transactions_duplicate_total'], 1)
+            self.assertEqual(metrics['blocks_mined_total'], 1)
+            self.assertEqual(metrics['mempool_transactions'], 0)
+            self.assertEqual(metrics['chain_length'], 1)
+            self.assertEqual(metrics['backend_load_seconds']['count'], 1)
+            self.assertEqual(metrics['backend_save_seconds']['count'], 1)
+            self.assertEqual(metrics['share_chain_rtt_seconds']['count'], 1)
+            self.assertEqual(metrics['mailbox_depth'], 0)
+            metrics = p2.metrics().get()
+            self.assertEqual(metrics['blocks_accepted_total'], 1)
+            self.assertEqual(metrics['blocks_rejected_total'], 0)
+
+            n1.stop()
+            with open(path) as f:
+                self.assertIn('blokka_blocks_mined_total{node="1"} 1\n', f.read())
+        finally:
+            n1.stop()
+            n2.stop()
+            shutil.rmtree(directory)
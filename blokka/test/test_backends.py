@@ -2,14 +2,18 @@
 # Author(s): 'Percy Link' <percylink@gmail.com>
 import json
 import shutil
+import threading
 import unittest
+from binascii import hexlify
 from datetime import datetime
 import os
 
 import pytz
 
-from blokka.backends import FileBackend
-from blokka.entities import Chain, Block
+from blokka.backends import FileBackend, LogFileBackend, MmapBackend, MappedBlocks, \
+    SQLiteBackend
+from blokka import signing
+from blokka.entities import Chain, Block, Transaction
 
 
 class TestFileBackend(unittest.TestCase):
@@ -43,3 +47,383 @@ class TestFileBackend(unittest.TestCase):
         json.dump(chain.to_dict(), open(os.path.join(FileBackend.FILE_DIR, 'n2.json'), 'w'))
         c2 = self.backend.load_chain('n2')
         self.assertEqual(c2.to_dict(), chain.to_dict())
+        self.assertIsNone(self.backend.load_chain('nobody'))
+
+    def test_lazy_load(self):
+        chain = make_chain(30)
+        self.backend.save_chain(chain, 'n3')
+        self.assertIsInstance(self.backend.load_chain('n3').blocks, list)
+        backend = FileBackend(lazy=True)
+        loaded = backend.load_chain('n3')
+        self.assertIsInstance(loaded.blocks, MappedBlocks)
+        self.assertEqual(loaded.latest_hash(), chain.latest_hash())
+        self.assertEqual(loaded.blocks[-5:], chain.blocks[-5:])
+        self.assertEqual(loaded, chain)
+        self.assertEqual(self.backend.load_chain('n3').blocks, chain.blocks)
+
+        # Edit the lazy chain and save it over the file it reads from. The blocks it
+        # still maps are copied over without being decoded, and the old file is closed.
+        old_file = loaded.blocks.segment.file
+        loaded.remove_latest_block()
+        extended = make_chain(31)
+        loaded.replace_from(25, extended.blocks[25:31])
+        decoded = []
+        block_at = loaded.blocks.segment.block_at
+        loaded.blocks.segment.block_at = lambda h: decoded.append(h) or block_at(h)
+        backend.save_chain(loaded, 'n3')
+        self.assertEqual(decoded, [])
+        self.assertTrue(old_file.closed)
+        self.assertEqual(loaded, extended)
+        self.assertEqual(loaded.blocks._tail, [])
+        self.assertEqual(backend.load_chain('n3'), extended)
+        self.assertEqual(json.load(open(os.path.join(FileBackend.FILE_DIR, 'n3.json'))),
+                         extended.to_dict())
+
+
+def make_chain(length, padding=0):
+    chain = Chain(blocks=[])
+    for i in xrange(length):
+        data = {'i': i, 'padding': 'x' * padding} if padding else {'i': i}
+        chain.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 12, i, tzinfo=pytz.UTC),
+            prev_hash=chain.latest_hash(),
+            data=data
+        ))
+    return chain
+
+
+class TestLogFileBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = LogFileBackend()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(LogFileBackend.FILE_DIR)
+
+    def log_size(self, node_id):
+        return os.path.getsize(os.path.join(LogFileBackend.FILE_DIR, node_id + '.log'))
+
+    def test_load_missing_chain(self):
+        self.assertIsNone(self.backend.load_chain('nope'))
+
+    def test_save_load_chain(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), chain.to_dict())
+        self.backend.close()
+        self.assertEqual(LogFileBackend().load_chain('n1').to_dict(), chain.to_dict())
+
+    def test_save_appends_only_new_blocks(self):
+        chain = make_chain(4)
+        self.backend.save_chain(Chain(blocks=chain.blocks[:3]), 'n1')
+        size = self.log_size('n1')
+        self.backend.save_chain(chain, 'n1')
+        record = LogFileBackend._encode_record(chain.blocks[3])
+        self.assertEqual(self.log_size('n1'), size + len(record))
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), chain.to_dict())
+
+    def test_save_truncates_replaced_blocks(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        fork = Chain(blocks=chain.blocks[:1])
+        fork.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+            prev_hash=fork.latest_hash(),
+            data={'fork': True}
+        ))
+        self.backend.save_chain(fork, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), fork.to_dict())
+
+    def test_remove_latest_block(self):
+        chain = make_chain(3)
+        self.backend.save_chain(Chain(blocks=chain.blocks[:2]), 'n1')
+        size = self.log_size('n1')
+        self.backend.save_chain(chain, 'n1')
+        self.backend.remove_latest_block('n1')
+        self.assertEqual(self.log_size('n1'), size)
+        chain.remove_latest_block()
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), chain.to_dict())
+
+    def test_recover_torn_tail(self):
+        chain = make_chain(2)
+        self.backend.save_chain(chain, 'n1')
+        self.backend.close()
+        size = self.log_size('n1')
+        with open(os.path.join(LogFileBackend.FILE_DIR, 'n1.log'), 'ab') as f:
+            f.write(LogFileBackend._encode_record(make_chain(3).blocks[2])[:-5])
+        backend = LogFileBackend()
+        self.assertEqual(backend.load_chain('n1').to_dict(), chain.to_dict())
+        self.assertEqual(self.log_size('n1'), size)
+        backend.close()
+
+    def test_prune(self):
+        chain = make_chain(4, padding=1000)
+        self.backend.save_chain(chain, 'n1')
+        size = self.log_size('n1')
+        chain.prune(3)
+        self.backend.save_chain(chain, 'n1')
+        self.assertEqual(self.log_size('n1'), size)
+        self.backend.prune('n1', 3)
+        self.assertLess(self.log_size('n1'), size - 3000)
+        self.assertEqual(self.backend.load_chain('n1'), chain)
+
+        # The log carries on from the rewritten one
+        extended = make_chain(5, padding=1000)
+        extended.prune(3)
+        self.backend.save_chain(extended, 'n1')
+        self.backend.close()
+        self.assertEqual(LogFileBackend().load_chain('n1'), extended)
+
+
+class TestMmapBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MmapBackend()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(MmapBackend.FILE_DIR)
+
+    def file_path(self, node_id, extension):
+        return os.path.join(MmapBackend.FILE_DIR, node_id + extension)
+
+    def test_load_missing_chain(self):
+        self.assertIsNone(self.backend.load_chain('nope'))
+
+    def test_save_load_chain(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        self.backend.close()
+        loaded = MmapBackend().load_chain('n1')
+        self.assertIsInstance(loaded.blocks, MappedBlocks)
+        self.assertEqual(loaded.length, 3)
+        self.assertEqual(loaded.latest_hash(), chain.latest_hash())
+        self.assertEqual(loaded.blocks[1].to_dict(), chain.blocks[1].to_dict())
+        self.assertEqual(loaded.to_dict(), chain.to_dict())
+        self.assertEqual(loaded, Chain.from_dict(chain.to_dict()))
+
+    def test_height_of(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        loaded = self.backend.load_chain('n1')
+        self.assertEqual(loaded.blocks.height_of(chain.blocks[2].hash), 2)
+        self.assertIsNone(loaded.blocks.height_of('abcd'))
+
+    def test_append_and_remove_on_loaded_chain(self):
+        chain = make_chain(4)
+        self.backend.save_chain(Chain(blocks=chain.blocks[:3]), 'n1')
+        loaded = self.backend.load_chain('n1')
+        loaded.add_block(chain.blocks[3])
+        self.backend.save_chain(loaded, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), chain.to_dict())
+
+        loaded.remove_latest_block()
+        loaded.remove_latest_block()
+        self.assertIsInstance(loaded.blocks, MappedBlocks)
+        self.backend.save_chain(loaded, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(),
+                         Chain(blocks=chain.blocks[:2]).to_dict())
+
+    def test_reorg_in_place(self):
+        # Rolling a deep chain back a few blocks neither copies nor reads the rest
+        chain = make_chain(1000)
+        self.backend.save_chain(chain, 'n1')
+        loaded = self.backend.load_chain('n1')
+        blocks = loaded.blocks
+        reads = []
+        block_at = blocks.segment.block_at
+        blocks.segment.block_at = lambda height: reads.append(height) or block_at(height)
+        fork = [Block(timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+                      prev_hash=chain.blocks[996].hash, data={'fork': True})]
+        loaded.replace_from(997, fork)
+        self.assertIs(loaded.blocks, blocks)
+        self.assertEqual(reads, [])
+        self.assertEqual(loaded.length, 998)
+        self.assertEqual(loaded.latest_hash(), fork[0].hash)
+
+        self.backend.save_chain(loaded, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').blocks,
+                         chain.blocks[:997] + fork)
+
+    def test_save_truncates_replaced_blocks(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        fork = Chain(blocks=chain.blocks[:1])
+        fork.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+            prev_hash=fork.latest_hash(),
+            data={'fork': True}
+        ))
+        self.backend.save_chain(fork, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), fork.to_dict())
+
+    def test_recover_torn_tail(self):
+        chain = make_chain(2)
+        self.backend.save_chain(chain, 'n1')
+        self.backend.close()
+        data_size = os.path.getsize(self.file_path('n1', '.blocks'))
+        index_size = os.path.getsize(self.file_path('n1', '.idx'))
+        with open(self.file_path('n1', '.blocks'), 'ab') as f:
+            f.write(b'\x00\x00\x10\x00partial')
+        with open(self.file_path('n1', '.idx'), 'ab') as f:
+            f.write(b'\x00' * 45)
+        backend = MmapBackend()
+        self.assertEqual(backend.load_chain('n1').to_dict(), chain.to_dict())
+        self.assertEqual(os.path.getsize(self.file_path('n1', '.blocks')), data_size)
+        self.assertEqual(os.path.getsize(self.file_path('n1', '.idx')), index_size)
+        backend.close()
+
+    def test_prune(self):
+        chain = make_chain(4, padding=1000)
+        self.backend.save_chain(chain, 'n1')
+        size = os.path.getsize(self.file_path('n1', '.blocks'))
+
+        # A loaded chain is pruned without leaving its lazy view
+        loaded = self.backend.load_chain('n1')
+        loaded.prune(3)
+        self.assertIsInstance(loaded.blocks, MappedBlocks)
+        self.assertEqual(loaded.pruned_height, 3)
+        self.backend.save_chain(loaded, 'n1')
+        self.backend.prune('n1', 3)
+        self.assertLess(os.path.getsize(self.file_path('n1', '.blocks')), size - 3000)
+        self.assertEqual(loaded.blocks[3], chain.blocks[3])
+        self.assertTrue(loaded.blocks[0].is_header())
+
+        loaded.add_block(make_chain(5, padding=1000).blocks[4])
+        self.backend.save_chain(loaded, 'n1')
+        blocks = list(loaded.blocks)
+        self.backend.close()
+        reloaded = MmapBackend().load_chain('n1')
+        self.assertEqual(reloaded.blocks, blocks)
+        self.assertEqual(reloaded.pruned_height, 3)
+
+    def test_finish_interrupted_prune(self):
+        chain = make_chain(3, padding=1000)
+        self.backend.save_chain(chain, 'n1')
+        pruned = make_chain(3, padding=1000)
+        pruned.prune(2)
+        self.backend.save_chain(pruned, 'n2')
+        self.backend.prune('n2', 2)
+        self.backend.close()
+        # As if pruning n1 stopped after writing both new files
+        for extension in ('.blocks', '.idx'):
+            shutil.copy(self.file_path('n2', extension),
+                        self.file_path('n1', extension) + '.tmp')
+        os.rename(self.file_path('n1', '.idx.tmp'), self.file_path('n1', '.idx.new'))
+        backend = MmapBackend()
+        self.assertEqual(backend.load_chain('n1'), pruned)
+        self.assertFalse(os.path.exists(self.file_path('n1', '.blocks.tmp')))
+        backend.close()
+
+
+class TestSQLiteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(SQLiteBackend.FILE_DIR)
+
+    def test_load_missing_chain(self):
+        self.assertIsNone(self.backend.load_chain('nope'))
+
+    def test_save_load_chain(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        self.backend.save_chain(Chain(blocks=chain.blocks[:1]), 'n2')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), chain.to_dict())
+        self.assertEqual(self.backend.load_chain('n2').length, 1)
+
+    def test_save_truncates_replaced_blocks(self):
+        chain = make_chain(3)
+        self.backend.save_chain(chain, 'n1')
+        fork = Chain(blocks=chain.blocks[:1])
+        fork.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+            prev_hash=fork.latest_hash(),
+            data={'fork': True}
+        ))
+        self.backend.save_chain(fork, 'n1')
+        self.assertEqual(self.backend.load_chain('n1').to_dict(), fork.to_dict())
+        self.assertIsNone(self.backend.height_of('n1', chain.blocks[2].hash))
+
+    def test_lookups(self):
+        t = Transaction(
+            seller_id='s',
+            buyer_id='b',
+            timestamp=datetime(2017, 11, 1, 1, 2, 3),
+            amount=32.1
+        )
+        chain = make_chain(2)
+        chain.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+            prev_hash=chain.latest_hash(),
+            data=json.dumps({t.hash: t.to_dict()})
+        ))
+        self.backend.save_chain(chain, 'n1')
+        self.assertEqual(self.backend.block_at('n1', 1).to_dict(),
+                         chain.blocks[1].to_dict())
+        self.assertEqual(self.backend.block_by_hash('n1', chain.blocks[2].hash).to_dict(),
+                         chain.blocks[2].to_dict())
+        self.assertEqual(self.backend.height_of('n1', chain.blocks[2].hash), 2)
+        self.assertEqual(self.backend.transaction('n1', t.hash), (t, 2))
+        self.assertIsNone(self.backend.transaction('n2', t.hash))
+
+    def test_transaction_round_trip(self):
+        # Fees, signatures and integer amounts are kept, so the hash matches
+        secret = signing.generate_secret()
+        buyer_id = hexlify(signing.public_key(secret))
+        transactions = [
+            Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                        amount=10),
+            Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                        amount=2.5, fee=1),
+            Transaction(seller_id='s', buyer_id=buyer_id,
+                        timestamp=datetime(2017, 11, 1), amount=3, fee=0.5).signed(secret),
+        ]
+        chain = make_chain(1)
+        chain.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+            prev_hash=chain.latest_hash(),
+            data={t.hash: t.to_dict() for t in transactions}
+        ))
+        self.backend.save_chain(chain, 'n1')
+        for t in transactions:
+            found, height = self.backend.transaction('n1', t.hash)
+            self.assertEqual((found.hash, height), (t.hash, 1))
+            self.assertEqual(found, t)
+
+    def test_prune(self):
+        t = Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                        amount=1)
+        chain = make_chain(1)
+        chain.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 13, tzinfo=pytz.UTC),
+            prev_hash=chain.latest_hash(),
+            data={t.hash: t.to_dict()}
+        ))
+        chain.add_block(Block(
+            timestamp=datetime(2017, 8, 9, 10, 11, 14, tzinfo=pytz.UTC),
+            prev_hash=chain.latest_hash(),
+            data={}
+        ))
+        self.backend.save_chain(chain, 'n1')
+        chain.prune(2)
+        self.backend.save_chain(chain, 'n1')
+        self.backend.prune('n1', 2)
+        self.assertEqual(self.backend.load_chain('n1'), chain)
+        self.assertTrue(self.backend.block_at('n1', 1).is_header())
+        self.assertIsNone(self.backend.transaction('n1', t.hash))
+
+    def test_concurrent_saves(self):
+        chains = {str(i): make_chain(i + 1) for i in xrange(8)}
+        threads = [threading.Thread(target=self.backend.save_chain, args=(c, node_id))
+                   for node_id, c in chains.iteritems()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for node_id, c in chains.iteritems():
+            self.assertEqual(self.backend.load_chain(node_id).to_dict(), c.to_dict())
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+
+from blokka import benchmarks
+
+
+def results(**seconds):
+    return {'format': benchmarks.FORMAT_VERSION,
+            'results': {name: {'seconds': s, 'ops': 10} for name, s in seconds.items()}}
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_compare(self):
+        rows = benchmarks.compare(results(a=1.0, b=1.0, c=1.0),
+                                  results(a=1.0, b=0.5, d=1.0), threshold=0.2)
+        self.assertEqual(rows, [('a', 0.1, 0.1, False), ('b', 0.05, 0.1, True)])
+        self.assertRaises(ValueError, benchmarks.compare, results(), {'format': 0})
+
+    def test_make_chain(self):
+        chain = benchmarks.make_chain(20)
+        chain.validate()
+        self.assertEqual(len(chain.blocks[-1].transaction_hashes()), 5)
+
+    def test_benchmarks_run(self):
+        self.assertEqual(benchmarks.bench_transaction_hash(10)['transaction_hash']['ops'],
+                         10)
+        self.assertEqual(sorted(benchmarks.bench_file_backend([10])),
+                         ['file_backend_load_10', 'file_backend_load_lazy_10',
+                          'file_backend_save_10', 'file_backend_save_lazy_10'])
+        network = benchmarks.bench_network(nodes=2, transactions=10)['network_2_nodes']
+        self.assertEqual(network['confirmed_fraction'], 1.0)
+        self.assertIsNotNone(network['latency_p50'])
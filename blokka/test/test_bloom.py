@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+
+from blokka.bloom import BloomFilter, RollingBloomFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_membership(self):
+        f = BloomFilter(capacity=1000, error_rate=0.01)
+        keys = [str(i) for i in xrange(1000)]
+        for k in keys:
+            f.add(k)
+        self.assertTrue(all(k in f for k in keys))
+        false_positives = sum(str(i) in f for i in xrange(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+
+class TestRollingBloomFilter(unittest.TestCase):
+
+    def test_rolls_over(self):
+        f = RollingBloomFilter(capacity=100, error_rate=0.001)
+        f.update(str(i) for i in xrange(150))
+        # At least the last `capacity` keys are remembered
+        self.assertTrue(all(str(i) in f for i in xrange(50, 150)))
+        f.update(str(i) for i in xrange(150, 300))
+        self.assertTrue(all(str(i) in f for i in xrange(200, 300)))
+        self.assertLess(sum(str(i) in f for i in xrange(100)), 10)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+from datetime import datetime
+from hashlib import sha256
+
+import pytz
+
+from blokka import codec
+
+
+def encode(value):
+    out = []
+    codec.encode_value(value, out)
+    return b''.join(out)
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_value_roundtrip(self):
+        digest = sha256(b'x').hexdigest()
+        value = {
+            u'n': None, u't': True, u'f': False, u'i': -3, u'big': 1 << 70,
+            u'd': 4.5, u's': u'caf\xe9', digest: [digest, u'1234', [], {}],
+        }
+        data = encode(value)
+        self.assertEqual(codec.decode_value(data), (value, len(data)))
+
+    def test_canonical(self):
+        self.assertEqual(encode({'a': 1, 'b': 2}), encode({'b': 2, 'a': 1}))
+        self.assertEqual(encode('abc'), encode(u'abc'))
+        self.assertNotEqual(encode(1), encode(1.0))
+        self.assertNotEqual(encode(1), encode(True))
+
+    def test_hashes_are_raw(self):
+        digest = sha256(b'x').hexdigest()
+        self.assertEqual(len(encode(digest)), 33)
+        # Only lowercase hex digests; anything else must come back as it went in
+        self.assertEqual(len(encode(digest.upper())), 1 + 4 + 64)
+        self.assertEqual(codec.decode_value(encode(digest.upper()))[0], digest.upper())
+
+    def test_unencodable(self):
+        self.assertRaises(ValueError, encode, object())
+        self.assertRaises(ValueError, codec.decode_value, b'?')
+
+    def test_timestamp(self):
+        t = datetime(2017, 1, 2, 3, 4, 5, 123)
+        data = codec.encode_timestamp(t)
+        self.assertEqual(len(data), 8)
+        self.assertEqual(codec.decode_timestamp(data), (t, 8))
+        # Wall-clock time, as with DATEFORMAT
+        self.assertEqual(codec.encode_timestamp(pytz.UTC.localize(t)), data)
+        self.assertEqual(codec.decode_timestamp(
+            codec.encode_timestamp(datetime(1960, 5, 6)))[0], datetime(1960, 5, 6))
+
+    def test_sized(self):
+        items = [b'', b'abc', b'\x00' * 10]
+        self.assertEqual(codec.decode_sized(codec.encode_sized(items)), items)
+        self.assertEqual(codec.decode_optional_uint64(codec.encode_optional_uint64(None)),
+                         (None, 1))
+        self.assertEqual(codec.decode_optional_uint64(codec.encode_optional_uint64(7)),
+                         (7, 9))
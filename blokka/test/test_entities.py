@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 # Author(s): 'Percy Link' <percylink@gmail.com>
+import copy
 import json
+import pickle
 import unittest
+from datetime import datetime
+from hashlib import sha256
 
-from blokka.entities import Block, Chain, Transaction
+import pytz
+
+from blokka import entities, signing
+from blokka.entities import Block, Chain, Transaction, validate_blocks
+from blokka.merkle import merkle_root, verify_proof
 
 
 class TestBlock(unittest.TestCase):
@@ -29,9 +37,78 @@ class TestBlock(unittest.TestCase):
         self.maxDiff = None
         self.assertEqual(json.loads(b.to_json()), dct)
 
+    def test_value_type(self):
+        b = Block(timestamp=datetime(2017, 1, 2), prev_hash='1234', data={'foo': 'bar'})
+        self.assertFalse(hasattr(b, '__dict__'))
+        self.assertRaises(AttributeError, setattr, b, 'data', {})
+        self.assertRaises(AttributeError, delattr, b, 'hash')
+        for copied in (copy.deepcopy(b), pickle.loads(pickle.dumps(b, 2))):
+            self.assertEqual(copied, b)
+            self.assertEqual(copied.hash, b.hash)
+        # Equal by hash and canonical encoding, so time zone awareness does not matter
+        aware = Block(timestamp=datetime(2017, 1, 2, tzinfo=pytz.UTC), prev_hash='1234',
+                      data={'foo': 'bar'})
+        self.assertEqual(aware, b)
+        self.assertEqual(len({aware, b}), 1)
+        forged = Block(timestamp=b.timestamp, prev_hash='1234', data={}, hash=b.hash)
+        self.assertNotEqual(forged, b)
+
+    def test_bytes(self):
+        parent = Block(timestamp=datetime(2017, 1, 2), prev_hash=None, data={})
+        b = Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, 123), prev_hash=parent.hash,
+                  data={'foo': [1, 2.5, None]}, nonce=12)
+        decoded = Block.from_bytes(b.to_bytes())
+        self.assertEqual(decoded, b)
+        self.assertEqual(decoded.hash, b.hash)
+        self.assertEqual(decoded.to_dict(), b.to_dict())
+        self.assertLess(len(b.to_bytes()), len(b.to_json()))
+        # The stored hash is kept as is, to be checked by validation
+        forged = Block(timestamp=b.timestamp, prev_hash='1234', data={}, hash=b.hash)
+        self.assertEqual(Block.from_bytes(forged.to_bytes()).hash, b.hash)
+        self.assertNotEqual(Block.from_bytes(forged.to_bytes()).compute_hash(), b.hash)
+
+    def test_hash_prefix(self):
+        b = Block(timestamp=datetime(2017, 1, 2), prev_hash='1234', data={}, nonce=7)
+        self.assertEqual(b.canonical_bytes(),
+                         b.hash_prefix() + entities.nonce_suffix(7))
+        self.assertEqual(b.hash, sha256(b.canonical_bytes()).hexdigest())
+
+    def test_merkle_root(self):
+        txs = [Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 1, 2),
+                           amount=i) for i in xrange(3)]
+        data = json.dumps({t.hash: t.to_dict() for t in txs})
+        root = merkle_root(sorted(t.hash for t in txs))
+        b = Block(timestamp=datetime(2017, 1, 2), prev_hash='1234', data=data,
+                  merkle_root=root)
+        unrooted = Block(timestamp=datetime(2017, 1, 2), prev_hash='1234', data=data)
+        self.assertNotEqual(b.hash, unrooted.hash)
+        self.assertEqual(Block.from_dict(b.to_dict()).hash, b.hash)
+        self.assertTrue(b.has_valid_merkle_root())
+        for t in txs:
+            self.assertTrue(verify_proof(t.hash, b.merkle_proof(t.hash), b.merkle_root))
+        forged = Block(timestamp=datetime(2017, 1, 2), prev_hash='1234', data=data,
+                       merkle_root=merkle_root([txs[0].hash]))
+        self.assertFalse(forged.has_valid_merkle_root())
+
+        # Another body under an honest hash leaves the root alone, but not the check
+        tampered = {t.hash: t.to_dict() for t in txs}
+        tampered[txs[0].hash] = dict(tampered[txs[0].hash], amount=100)
+        swapped = Block(timestamp=datetime(2017, 1, 2), prev_hash='1234', data=tampered,
+                        merkle_root=root)
+        self.assertFalse(swapped.has_valid_merkle_root())
+        self.assertRaises(ValueError, entities.validate_blocks, [swapped])
+
 
 class TestChain(unittest.TestCase):
 
+    def test_bytes(self):
+        chain = Chain(blocks=[])
+        for i in xrange(3):
+            chain.add_block(Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                                  prev_hash=chain.latest_hash(), data={'i': i}))
+        self.assertEqual(Chain.from_bytes(chain.to_bytes()), chain)
+        self.assertEqual(Chain.from_bytes(Chain(blocks=[]).to_bytes()), Chain(blocks=[]))
+
     def test_from_dict_to_dict(self):
         blk = {
             'timestamp': '2017-01-02T03:04:05.000123Z',
@@ -95,6 +172,122 @@ class TestChain(unittest.TestCase):
         self.assertIsNone(chain2.latest_hash())
 
 
+    def make_chain(self, length, tag='a'):
+        chain = Chain(blocks=[])
+        for i in xrange(length):
+            chain.add_block(Block(
+                timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                prev_hash=chain.latest_hash(),
+                data={tag: i}
+            ))
+        return chain
+
+    def test_locator(self):
+        chain = self.make_chain(40)
+        heights = [h for h, _ in chain.locator()]
+        self.assertEqual(heights, range(39, 29, -1) + [28, 24, 16, 0])
+        self.assertEqual(chain.locator()[0], (39, chain.latest_hash()))
+        self.assertEqual(Chain(blocks=[]).locator(), [])
+
+    def test_common_length(self):
+        chain = self.make_chain(40)
+        self.assertEqual(chain.common_length(chain.locator()), 40)
+        short = Chain(blocks=chain.blocks[:35])
+        self.assertEqual(short.common_length(chain.locator()), 35)
+        self.assertEqual(chain.common_length(short.locator()), 35)
+        # Forked between sparse locator entries: the common length is a lower bound
+        fork = Chain(blocks=chain.blocks[:20])
+        fork.add_block(Block(
+            timestamp=datetime(2017, 1, 2, 3, 4, 6),
+            prev_hash=fork.latest_hash(),
+            data={'fork': 1}
+        ))
+        self.assertEqual(fork.common_length(chain.locator()), 17)
+        self.assertEqual(chain.fork_height(17, fork.blocks[17:]), 20)
+        self.assertIsNone(chain.fork_height(17, chain.blocks[17:25]))
+        self.assertEqual(self.make_chain(5, tag='b').common_length(chain.locator()), 0)
+
+    def test_replace_from(self):
+        chain = self.make_chain(5)
+        other = self.make_chain(3)
+        blocks = other.blocks
+        other.replace_from(1, chain.blocks[1:])
+        self.assertEqual(other, chain)
+        # Truncated in place rather than copied
+        self.assertIs(other.blocks, blocks)
+        self.assertRaises(ValueError, other.replace_from, 1, chain.blocks[2:])
+        self.assertEqual(other, chain)
+
+    def test_validate(self):
+        chain = self.make_chain(5)
+        self.assertEqual(chain.verified_height, 0)
+        chain.validate()
+        self.assertEqual(chain.verified_height, 5)
+
+        # Stored hashes are kept by from_dict and checked by validate
+        dct = chain.to_dict()
+        dct['blocks'][2]['hash'] = '0' * 64
+        self.assertRaises(ValueError, Chain.from_dict(dct).validate)
+
+        dct = chain.to_dict()
+        dct['blocks'][3]['prev_hash'] = dct['blocks'][1]['hash']
+        del dct['blocks'][3]['hash']
+        tampered = Chain.from_dict(dct)
+        self.assertRaises(ValueError, tampered.validate)
+        self.assertEqual(tampered.verified_height, 0)
+
+    def test_validate_incremental(self):
+        chain = self.make_chain(5)
+        chain.validate()
+        # Blocks under the checkpoint are not checked again
+        b1 = chain.blocks[1]
+        chain.blocks[1] = Block(timestamp=b1.timestamp, prev_hash=b1.prev_hash,
+                                data={'tampered': True}, hash=b1.hash)
+        chain.add_block(Block(timestamp=datetime(2017, 1, 3),
+                              prev_hash=chain.latest_hash(), data={}))
+        chain.validate()
+        self.assertEqual(chain.verified_height, 6)
+        self.assertRaises(ValueError, Chain(blocks=list(chain.blocks)).validate)
+        # Replacing blocks under the checkpoint invalidates it
+        chain.replace_from(0, self.make_chain(7, tag='b').blocks)
+        self.assertEqual(chain.verified_height, 0)
+
+    def test_prune(self):
+        chain = self.make_chain(6)
+        whole = list(chain.blocks)
+        self.assertEqual(chain.pruned_height, 0)
+        self.assertEqual(chain.prune(2), whole[:2])
+        self.assertEqual(chain.prune(4), whole[2:4])
+        self.assertEqual(chain.pruned_height, 4)
+        header = chain.blocks[1]
+        self.assertTrue(header.is_header())
+        self.assertIsNone(header.data)
+        self.assertFalse(whole[1].is_header())
+        # Hashes still link the chain
+        self.assertEqual([chain.hash_at(h) for h in xrange(6)], [b.hash for b in whole])
+        self.assertEqual(chain.common_length(self.make_chain(6).locator()), 6)
+        self.assertEqual(chain.blocks[4:], whole[4:])
+        self.assertTrue(Chain.from_dict(chain.to_dict()).blocks[3].is_header())
+        self.assertRaises(ValueError, chain.prune, 7)
+        # Headers are trusted, the rest validated
+        chain.validate()
+        self.assertEqual(chain.verified_height, 6)
+        self.assertRaises(ValueError, validate_blocks, chain.blocks[:2])
+
+    def test_validate_parallel(self):
+        threshold = entities.PARALLEL_VALIDATION_THRESHOLD
+        entities.PARALLEL_VALIDATION_THRESHOLD = 10
+        try:
+            chain = self.make_chain(30)
+            chain.validate(processes=2)
+            self.assertEqual(chain.verified_height, 30)
+            dct = chain.to_dict()
+            dct['blocks'][25]['hash'] = '0' * 64
+            self.assertRaises(ValueError, Chain.from_dict(dct).validate, processes=2)
+        finally:
+            entities.PARALLEL_VALIDATION_THRESHOLD = threshold
+
+
 class TestTransaction(unittest.TestCase):
 
     def test_from_dict_to_dict(self):
@@ -105,4 +298,58 @@ class TestTransaction(unittest.TestCase):
             'amount': 4.5
         }
         t = Transaction.from_dict(d)
-        self.assertEqual(t.to_dict(), d)
\ No newline at end of file
+        self.assertEqual(t.to_dict(), d)
+
+    def test_value_type(self):
+        t = Transaction(seller_id='a', buyer_id='b', timestamp=datetime(2017, 12, 25),
+                        amount=4.5)
+        self.assertFalse(hasattr(t, '__dict__'))
+        self.assertRaises(AttributeError, setattr, t, 'amount', 5)
+        self.assertIs(t.hash, t.hash)
+        self.assertEqual(pickle.loads(pickle.dumps(t, 2)), t)
+        self.assertEqual(t, Transaction.from_dict(t.to_dict()))
+        self.assertNotEqual(t, Transaction(seller_id='a', buyer_id='b',
+                                           timestamp=datetime(2017, 12, 25), amount=5))
+
+    def test_bytes(self):
+        t = Transaction(seller_id='a', buyer_id='b',
+                        timestamp=datetime(2017, 12, 25, 1, 2, 3, 4), amount=4.5, fee=1)
+        self.assertEqual(Transaction.from_bytes(t.to_bytes()), t)
+        self.assertEqual(t.hash, sha256(t.to_bytes()).hexdigest())
+        self.assertLess(len(t.to_bytes()), len(t.to_json()))
+
+    def test_fee(self):
+        t = Transaction(seller_id='a', buyer_id='b', timestamp=datetime(2017, 12, 25),
+                        amount=4.5)
+        with_fee = Transaction(seller_id='a', buyer_id='b',
+                               timestamp=datetime(2017, 12, 25), amount=4.5, fee=0.1)
+        self.assertNotIn('fee', t.to_dict())
+        self.assertEqual(with_fee.to_dict()['fee'], 0.1)
+        self.assertNotEqual(t.hash, with_fee.hash)
+        self.assertEqual(Transaction.from_dict(with_fee.to_dict()), with_fee)
+        self.assertEqual(pickle.loads(pickle.dumps(with_fee, 2)), with_fee)
+
+    def test_signature(self):
+        secret = signing.generate_secret()
+        buyer_id = signing.account_id(signing.public_key(secret))
+        t = Transaction(seller_id='a', buyer_id=buyer_id,
+                        timestamp=datetime(2017, 12, 25), amount=4.5)
+        signed = t.signed(secret)
+        self.assertFalse(t.has_valid_signature())
+        self.assertTrue(signed.has_valid_signature())
+        self.assertNotEqual(signed.hash, t.hash)
+        self.assertEqual(signed.signed_bytes(), t.to_bytes())
+        for copied in (Transaction.from_bytes(signed.to_bytes()),
+                       Transaction.from_dict(signed.to_dict()),
+                       pickle.loads(pickle.dumps(signed, 2))):
+            self.assertEqual(copied, signed)
+            self.assertTrue(copied.has_valid_signature())
+
+        # Signed by a key other than the one buyer_id names
+        forged = Transaction(seller_id='a', buyer_id='b' * 64,
+                             timestamp=datetime(2017, 12, 25), amount=4.5).signed(secret)
+        self.assertFalse(forged.has_valid_signature())
+        tampered = Transaction(seller_id='a', buyer_id=buyer_id,
+                               timestamp=datetime(2017, 12, 25), amount=450,
+                               signature=signed.signature)
+        self.assertFalse(tampered.has_valid_signature())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+from datetime import datetime
+
+from blokka.entities import Block, Chain, Transaction
+from blokka.forks import BlockTree, block_transactions, block_work, longest_chain, \
+    most_work
+
+
+def make_branch(prev_hash, length, salt):
+    blocks = []
+    for i in xrange(length):
+        blocks.append(Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                            prev_hash=blocks[-1].hash if blocks else prev_hash,
+                            data={'salt': salt, 'i': i}))
+    return blocks
+
+
+class TestForkChoice(unittest.TestCase):
+
+    def test_block_work(self):
+        self.assertEqual(block_work('f' * 64), 1)
+        self.assertEqual(block_work('0' * 63 + 'f'), 1 << 252)
+        self.assertGreater(block_work('00' + 'f' * 62), block_work('0' + 'f' * 63))
+
+    def test_rules(self):
+        short = make_branch(None, 2, 'a')
+        long_ = make_branch(None, 3, 'b')
+        self.assertTrue(longest_chain(short, long_))
+        self.assertFalse(longest_chain(long_, short))
+        self.assertFalse(longest_chain(short, make_branch(None, 2, 'c')))
+        works = [sum(block_work(b.hash) for b in branch) for branch in (short, long_)]
+        self.assertEqual(most_work(short, long_), works[1] > works[0])
+        self.assertFalse(most_work(short, short))
+
+
+class TestBlockTree(unittest.TestCase):
+
+    def test_branch(self):
+        main = make_branch(None, 5, 'main')
+        chain = Chain(blocks=main)
+        side = make_branch(main[1].hash, 3, 'side')
+        tree = BlockTree()
+        for i, block in enumerate(side):
+            tree.add(block, 2 + i)
+        self.assertEqual(tree.branch(side[-1].hash, chain), (2, side))
+        self.assertEqual(tree.branch(side[0].hash, chain), (2, side[:1]))
+        self.assertEqual(tree.height_of(side[1].hash), 3)
+        # Cut off from the main chain
+        tree.remove(side[:1])
+        self.assertIsNone(tree.branch(side[-1].hash, chain))
+
+    def test_genesis_branch(self):
+        chain = Chain(blocks=make_branch(None, 2, 'main'))
+        side = make_branch(None, 2, 'side')
+        tree = BlockTree()
+        for i, block in enumerate(side):
+            tree.add(block, i)
+        self.assertEqual(tree.branch(side[-1].hash, chain), (0, side))
+
+    def test_prune(self):
+        tree = BlockTree(max_depth=10)
+        blocks = make_branch(None, 30, 'x')
+        for i, block in enumerate(blocks):
+            tree.add(block, i)
+        tree.prune(29)
+        self.assertEqual(len(tree), 11)
+        self.assertNotIn(blocks[18].hash, tree)
+        self.assertIn(blocks[19].hash, tree)
+
+    def test_block_transactions(self):
+        txs = [Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 1, 2),
+                           amount=i) for i in xrange(3)]
+        data = {t.hash: t.to_dict() for t in txs}
+        data['0' * 64] = txs[0].to_dict()
+        block = Block(timestamp=datetime(2017, 1, 2), prev_hash=None, data=data)
+        self.assertEqual(sorted(t.hash for t in block_transactions(block)),
+                         sorted(t.hash for t in txs))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from blokka.entities import Block, Chain, Transaction
+from blokka.ledger import Ledger
+
+
+def tx(seller_id, buyer_id, amount):
+    return Transaction(seller_id=seller_id, buyer_id=buyer_id,
+                       timestamp=datetime(2017, 11, 1), amount=amount)
+
+
+def block(prev, txs, i):
+    return Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                 prev_hash=prev.hash if prev else None,
+                 data={t.hash: t.to_dict() for t in txs})
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.t1 = tx('s', 'b', 10)
+        self.t2 = tx('b', 'c', 4)
+        self.t3 = tx('s', 'c', 1)
+        self.b0 = block(None, [self.t1], 0)
+        self.b1 = block(self.b0, [self.t2, self.t3], 1)
+
+    def test_apply_and_revert(self):
+        ledger = Ledger()
+        ledger.apply_block(self.b0)
+        ledger.apply_block(self.b1)
+        self.assertEqual(ledger.balances(), {'s': 11, 'b': -6, 'c': -5})
+        self.assertEqual(ledger.history('b'), [(0, self.t1.hash, -10),
+                                               (1, self.t2.hash, 4)])
+        self.assertEqual(ledger.history('b', since=1), [(1, self.t2.hash, 4)])
+        self.assertEqual(ledger.balance('nobody'), 0)
+        self.assertRaises(ValueError, ledger.apply_block, self.b1)
+
+        self.assertRaises(ValueError, ledger.revert_block, self.b0)
+        ledger.revert_block(self.b1)
+        self.assertEqual(ledger.balances(), {'s': 10, 'b': -10})
+        self.assertEqual(ledger.history('c'), [])
+        self.assertEqual((ledger.height, ledger.tip_hash), (1, self.b0.hash))
+
+    def test_forget(self):
+        ledger = Ledger()
+        ledger.apply_block(self.b0)
+        ledger.forget(1)
+        self.assertEqual(ledger.history('s'), [])
+        self.assertEqual(ledger.history_height, 1)
+        ledger.apply_block(self.b1)
+        ledger.revert_block(self.b1)
+        # Balances from forgotten history are kept
+        self.assertEqual(ledger.balances(), {'s': 10, 'b': -10})
+        ledger = Ledger.from_dict(ledger.to_dict())
+        self.assertEqual(ledger.history_height, 1)
+        self.assertRaises(ValueError, ledger.apply_block, self.b1.header())
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'ledger.json')
+            self.assertIsNone(Ledger.load(path))
+            chain = Chain(blocks=[self.b0])
+            Ledger.for_chain(chain).save(path)
+
+            # The blocks since the snapshot are applied on top of it
+            chain.add_block(self.b1)
+            snapshot = Ledger.load(path)
+            self.assertEqual(snapshot.height, 1)
+            ledger = Ledger.for_chain(chain, snapshot)
+            self.assertIs(ledger, snapshot)
+            self.assertEqual(ledger.to_dict(), Ledger.for_chain(chain).to_dict())
+            ledger.revert_block(self.b1)
+            self.assertEqual(ledger.history('s'), [(0, self.t1.hash, 10)])
+
+            # A snapshot of another chain is not used
+            other = Chain(blocks=[block(None, [self.t3], 2)])
+            ledger = Ledger.for_chain(other, Ledger.load(path))
+            self.assertEqual(ledger.balances(), {'s': 1, 'c': -1})
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import logging
+import threading
+import unittest
+from Queue import Queue
+
+from blokka.logs import (QueueHandler, QueueListener, RateLimitFilter, build_logger,
+                         queue_handler)
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.current_thread().name)
+
+
+class TestQueueLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = Queue(5)
+        self.handler = RecordingHandler()
+        self.listener = QueueListener(self.queue, self.handler)
+        self.logger = logging.getLogger('test_logs')
+        self.logger.propagate = False
+        self.queue_handler = QueueHandler(self.queue)
+        self.logger.addHandler(self.queue_handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+
+    def test_listener_handles_records(self):
+        self.listener.start()
+        self.logger.warning('%d of %d', 1, 2)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed')
+        self.listener.stop()
+        self.assertEqual([r.getMessage() for r in self.handler.records],
+                         ['1 of 2', 'failed'])
+        self.assertIn('ValueError: boom', self.handler.records[1].exc_text)
+        self.assertEqual(self.handler.threads, {'log-listener'})
+
+    def test_full_queue_drops(self):
+        for i in xrange(8):
+            self.logger.warning('record %d', i)
+        self.assertEqual(self.queue_handler.dropped, 3)
+        self.listener.start()
+        self.listener.stop()
+        self.assertEqual(len(self.handler.records), 5)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def test_burst_then_summary(self):
+        now = [0.0]
+        rate_limit = RateLimitFilter(burst=2, interval=1.0, clock=lambda: now[0])
+
+        def record(msg):
+            return logging.LogRecord('n', logging.DEBUG, __file__, 1, msg, ('x',), None)
+
+        self.assertEqual([rate_limit.filter(record('a %s')) for _ in xrange(5)],
+                         [True, True, False, False, False])
+        self.assertTrue(rate_limit.filter(record('b %s')))
+        now[0] = 1.5
+        summary = record('a %s')
+        self.assertTrue(rate_limit.filter(summary))
+        self.assertEqual(summary.getMessage(), 'a x (3 similar messages suppressed)')
+
+
+class TestBuildLogger(unittest.TestCase):
+
+    def test_handler_added_once(self):
+        first = build_logger('test_logs.node', rate_limit=RateLimitFilter())
+        second = build_logger('test_logs.node', level=logging.INFO,
+                              rate_limit=RateLimitFilter())
+        self.assertIs(first, second)
+        self.assertEqual(first.handlers, [queue_handler()])
+        self.assertEqual(len(first.filters), 1)
+        self.assertFalse(first.isEnabledFor(logging.DEBUG))
+
+
+if __name__ == '__main__':
+    unittest.main()
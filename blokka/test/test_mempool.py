@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+from datetime import datetime
+
+from blokka.entities import Transaction
+from blokka.mempool import Mempool, ORDER_AGE
+
+
+def make_transactions(fees):
+    return [Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 12, 25),
+                        amount=i, fee=fee)
+            for i, fee in enumerate(fees)]
+
+
+class TestMempool(unittest.TestCase):
+
+    def test_mapping(self):
+        ts = make_transactions([1, 2, 3])
+        pool = Mempool()
+        for t in ts:
+            self.assertTrue(pool.add(t))
+        self.assertFalse(pool.add(ts[0]))
+        self.assertEqual(pool, {t.hash: t for t in ts})
+        self.assertEqual(pool.nbytes, sum(len(t.canonical_bytes()) for t in ts))
+        self.assertIs(pool.remove(ts[1].hash), ts[1])
+        self.assertIsNone(pool.remove(ts[1].hash))
+        self.assertEqual(pool, {t.hash: t for t in (ts[0], ts[2])})
+        # A removed transaction can come back; a confirmed one cannot
+        self.assertTrue(pool.add(ts[1]))
+        pool.remove_confirmed([ts[0].hash])
+        self.assertNotIn(ts[0].hash, pool)
+        self.assertTrue(pool.knows(ts[0].hash))
+        self.assertFalse(pool.add(ts[0]))
+
+    def test_restore(self):
+        ts = make_transactions([1, 2])
+        pool = Mempool()
+        pool.add(ts[0])
+        pool.remove_confirmed([t.hash for t in ts])
+        pool.restore(ts)
+        self.assertEqual(pool, {t.hash: t for t in ts})
+
+    def test_best_by_fee(self):
+        fees = [5, 1, 9, 3, 9, 7, 2, 8, 6, 4]
+        ts = make_transactions(fees)
+        pool = Mempool()
+        for t in ts:
+            pool.add(t)
+        # Highest fee first, earliest first among equal fees
+        self.assertEqual(pool.best(4), [ts[2], ts[4], ts[7], ts[5]])
+        self.assertEqual(len(pool.best(100)), len(ts))
+        pool.remove_confirmed([ts[2].hash, ts[7].hash])
+        self.assertEqual(pool.best(3), [ts[4], ts[5], ts[8]])
+        self.assertEqual(Mempool().best(3), [])
+
+    def test_best_by_age(self):
+        ts = make_transactions([5, 1, 9, 3])
+        pool = Mempool(order=ORDER_AGE)
+        for t in ts:
+            pool.add(t)
+        pool.remove(ts[0].hash)
+        self.assertEqual(pool.best(2), ts[1:3])
+
+    def test_evicts_lowest_fee(self):
+        ts = make_transactions([5, 1, 9, 3])
+        pool = Mempool(max_transactions=3)
+        for t in ts[:3]:
+            pool.add(t)
+        self.assertTrue(pool.add(ts[3]))
+        self.assertEqual(set(pool), set(t.hash for t in (ts[0], ts[2], ts[3])))
+        # Not worth a place
+        self.assertFalse(pool.add(make_transactions([0, 0, 0, 0, 0])[4]))
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(pool.evicted, 2)
+
+    def test_byte_limit(self):
+        ts = make_transactions([1, 2, 3])
+        size = len(ts[0].canonical_bytes())
+        pool = Mempool(max_bytes=2 * size)
+        for t in ts:
+            pool.add(t)
+        self.assertEqual(set(pool), set(t.hash for t in ts[1:]))
+        self.assertLessEqual(pool.nbytes, 2 * size)
+        self.assertFalse(Mempool(max_bytes=size - 1).add(ts[0]))
+
+    def test_compaction(self):
+        ts = make_transactions(range(500))
+        pool = Mempool()
+        for t in ts:
+            pool.add(t)
+        pool.remove_confirmed([t.hash for t in ts[:450]])
+        self.assertLessEqual(len(pool._best), 2 * len(pool) + 64)
+        self.assertEqual(pool.best(2), [ts[499], ts[498]])
+
+    def test_unknown_order(self):
+        self.assertRaises(ValueError, Mempool, order='size')
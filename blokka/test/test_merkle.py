@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+from hashlib import sha256
+
+from blokka.merkle import merkle_proof, merkle_root, verify_proof
+
+
+class TestMerkle(unittest.TestCase):
+
+    def hashes(self, n):
+        return [sha256(str(i)).hexdigest() for i in xrange(n)]
+
+    def test_root(self):
+        self.assertEqual(merkle_root([]), sha256(b'').hexdigest())
+        hashes = self.hashes(5)
+        self.assertEqual(merkle_root(hashes), merkle_root(list(hashes)))
+        self.assertNotEqual(merkle_root(hashes), merkle_root(hashes[:4]))
+        self.assertNotEqual(merkle_root(hashes), merkle_root(hashes[::-1]))
+        # An odd node is promoted, not paired with itself
+        self.assertNotEqual(merkle_root(hashes[:3]),
+                            merkle_root(hashes[:3] + hashes[2:3]))
+
+    def test_proofs(self):
+        for n in xrange(1, 12):
+            hashes = self.hashes(n)
+            root = merkle_root(hashes)
+            for h in hashes:
+                proof = merkle_proof(hashes, h)
+                self.assertLessEqual(len(proof), n.bit_length())
+                self.assertTrue(verify_proof(h, proof, root))
+                self.assertFalse(verify_proof(sha256('x').hexdigest(), proof, root))
+
+    def test_proof_missing_hash(self):
+        self.assertRaises(ValueError, merkle_proof, self.hashes(3), 'abcd')
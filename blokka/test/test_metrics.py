@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import os
+import shutil
+import tempfile
+import unittest
+
+from blokka.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = Metrics()
+        counter = metrics.counter('things_total', 'Things')
+        histogram = metrics.histogram('wait_seconds', 'Waits', buckets=(0.1, 1.0))
+        metrics.gauge('level', 'Level', lambda: 7)
+        metrics.counter('kept_total', 'Kept elsewhere', lambda: 5)
+        counter.inc()
+        counter.inc(2)
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        with histogram.time():
+            pass
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['things_total'], 3)
+        self.assertEqual(snapshot['level'], 7)
+        self.assertEqual(snapshot['kept_total'], 5)
+        self.assertEqual(snapshot['wait_seconds']['count'], 5)
+        self.assertAlmostEqual(snapshot['wait_seconds']['sum'], 3.65, places=2)
+        self.assertEqual(snapshot['wait_seconds']['buckets'],
+                         [(0.1, 3), (1.0, 4), (float('inf'), 5)])
+
+    def test_prometheus(self):
+        metrics = Metrics(prefix='test', labels={'node': 'n"1'})
+        metrics.counter('things_total', 'Things').inc(4)
+        metrics.counter('kept_total', 'Kept', lambda: 2)
+        metrics.histogram('wait_seconds', 'Waits', buckets=(0.5,)).observe(0.25)
+        self.assertEqual(metrics.to_prometheus(), '\n'.join([
+            '# HELP test_things_total Things',
+            '# TYPE test_things_total counter',
+            'test_things_total{node="n\\"1"} 4',
+            '# HELP test_kept_total Kept',
+            '# TYPE test_kept_total counter',
+            'test_kept_total{node="n\\"1"} 2',
+            '# HELP test_wait_seconds Waits',
+            '# TYPE test_wait_seconds histogram',
+            'test_wait_seconds_bucket{le="0.5",node="n\\"1"} 1',
+            'test_wait_seconds_bucket{le="+Inf",node="n\\"1"} 1',
+            'test_wait_seconds_sum{node="n\\"1"} 0.25',
+            'test_wait_seconds_count{node="n\\"1"} 1',
+        ]) + '\n')
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'blokka.prom')
+            metrics.write_prometheus(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), metrics.to_prometheus())
+            self.assertEqual(os.listdir(directory), ['blokka.prom'])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
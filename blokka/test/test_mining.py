@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import threading
+import unittest
+from datetime import datetime
+
+from blokka.entities import Block, meets_target
+from blokka.mining import Miner
+
+
+class TestMiner(unittest.TestCase):
+
+    def make_block(self):
+        return Block(timestamp=datetime(2017, 1, 2, 3, 4, 5), prev_hash='1234',
+                     data={'foo': 'bar'})
+
+    def test_meets_target(self):
+        self.assertTrue(meets_target('0f' + 'f' * 62, 4))
+        self.assertFalse(meets_target('1' + '0' * 63, 4))
+        self.assertTrue(meets_target('f' * 64, 0))
+
+    def test_mine(self):
+        for processes in (1, 2):
+            miner = Miner(difficulty=10, processes=processes)
+            try:
+                result = miner.mine(self.make_block())
+            finally:
+                miner.close()
+            self.assertTrue(meets_target(result.block.hash, 10))
+            self.assertEqual(Block.from_dict(result.block.to_dict()).hash,
+                             result.block.hash)
+            self.assertGreater(result.hashes, result.block.nonce)
+            self.assertGreater(result.hashes_per_second, 0)
+
+    def test_mine_async_and_cancel(self):
+        miner = Miner(difficulty=4)
+        solved = threading.Event()
+        job = miner.mine_async(self.make_block(), lambda result: solved.set())
+        self.assertTrue(solved.wait(5))
+
+        # Impossible difficulty, so only cancelling can end the search
+        miner = Miner(difficulty=256)
+        job = miner.mine_async(self.make_block(), lambda result: self.fail())
+        job.cancel()
+        job.thread.join(5)
+        self.assertTrue(job.done())
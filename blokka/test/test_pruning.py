@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from blokka.entities import Block, Chain, Transaction
+from blokka.ledger import Ledger
+from blokka.pruning import Snapshot, archive_blocks
+from blokka.streams import iter_blocks
+
+
+def make_chain(length):
+    chain = Chain(blocks=[])
+    for i in xrange(length):
+        t = Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                        amount=i)
+        chain.add_block(Block(timestamp=datetime(2017, 1, 2, 3, 4, 5, i),
+                              prev_hash=chain.latest_hash(), data={t.hash: t.to_dict()}))
+    return chain
+
+
+class TestPruning(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_archive(self):
+        chain = make_chain(3)
+        path = archive_blocks(os.path.join(self.directory, 'archive'), 'n1', 0,
+                              chain.blocks)
+        self.assertTrue(path.endswith('n1.0000000000.json'))
+        with open(path, 'rb') as f:
+            self.assertEqual(list(iter_blocks(f)), chain.blocks)
+
+    def test_snapshot(self):
+        chain = make_chain(5)
+        ledger = Ledger.for_chain(chain)
+        chain.prune(3)
+        snapshot = Snapshot(chain, ledger)
+        self.assertEqual(snapshot.height, 3)
+        snapshot.validate()
+
+        path = os.path.join(self.directory, 'snapshot.json')
+        snapshot.save(path)
+        loaded = Snapshot.load(path)
+        loaded.validate()
+        self.assertEqual(loaded.chain, chain)
+        self.assertEqual(loaded.ledger.balances(), {'s': 10, 'b': -10})
+
+        # Headers must link up, whole blocks validate, and the ledger match the tip
+        self.assertRaises(ValueError, Snapshot(chain, Ledger()).validate)
+        self.assertRaises(ValueError, snapshot.validate, difficulty=64)
+        blocks = list(chain.blocks)
+        blocks[1] = blocks[0]
+        self.assertRaises(ValueError, Snapshot(Chain(blocks=blocks), ledger).validate)
+        blocks = list(chain.blocks)
+        blocks[4] = Block(timestamp=blocks[4].timestamp, prev_hash=blocks[4].prev_hash,
+                          data={}, hash=blocks[4].hash)
+        self.assertRaises(ValueError, Snapshot(Chain(blocks=blocks), ledger).validate)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import threading
+import time
+import unittest
+from datetime import datetime
+
+from blokka.actors import ACCEPTED
+from blokka.entities import Transaction
+from blokka.runtime import (RUNTIME_LOOP, RUNTIME_THREADS, EventLoop, LoopNode,
+                            start_node)
+from blokka.test import MockFileBackend
+
+
+def make_transactions(count):
+    return [Transaction(seller_id='s', buyer_id='b', timestamp=datetime(2017, 11, 1),
+                        amount=i)
+            for i in xrange(count)]
+
+
+class SmallMailboxNode(LoopNode):
+
+    MAILBOX_SIZE = 2
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def test_calls(self):
+        loop = EventLoop()
+        calls = []
+        done = threading.Event()
+
+        def first():
+            calls.append('first')
+            loop.call_later(0.05, calls.append, 'timer')
+            loop.call_later(0.1, done.set)
+            loop.call_later(0.02, calls.append, 'cancelled').cancel()
+            loop.call_soon(calls.append, 'soon')
+
+        loop.start()
+        try:
+            loop.call_soon_threadsafe(first)
+            self.assertTrue(done.wait(5))
+            self.assertEqual(calls, ['first', 'soon', 'timer'])
+        finally:
+            loop.stop()
+
+
+class TestLoopNode(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.loop.start()
+        self.refs = []
+
+    def tearDown(self):
+        for ref in self.refs:
+            ref.stop()
+        self.loop.stop()
+
+    def start(self, node_id, node_class=LoopNode, **kwargs):
+        kwargs.setdefault('backend', MockFileBackend({}))
+        ref = node_class.start(node_id, loop=self.loop, **kwargs)
+        self.refs.append(ref)
+        return ref.proxy()
+
+    def test_network(self):
+        threads = threading.active_count()
+        proxies = [self.start('n%d' % i) for i in xrange(3)]
+        for p in proxies:
+            for q in proxies:
+                if p is not q:
+                    p.register_peer(q).get()
+        self.assertEqual(threading.active_count(), threads)
+
+        transaction = make_transactions(1)[0]
+        proxies[0].register_transaction(transaction).get()
+        deadline = time.time() + 5
+        while (len(proxies[2].pending_transactions.get()) < 1 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(dict(proxies[2].pending_transactions.get()),
+                         {transaction.hash: transaction})
+
+        # A block is mined and shared with the peers
+        proxies[0].mine_block()
+        while proxies[2].chain.get().length < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        chain = proxies[0].chain.get()
+        self.assertEqual(chain.length, 1)
+        for p in proxies:
+            self.assertEqual(p.chain.get(), chain)
+        self.assertEqual(proxies[1].share_chain().get().get(timeout=5), ACCEPTED)
+
+    def test_nodes_on_two_loops(self):
+        other_loop = EventLoop()
+        other_loop.start()
+        self.addCleanup(other_loop.stop)
+        p1 = self.start('n1')
+        ref = LoopNode.start('n2', loop=other_loop, backend=MockFileBackend({}))
+        self.refs.append(ref)
+        p2 = ref.proxy()
+
+        # Each registers the other from its own loop at once; neither waits for the
+        # other's answer
+        p1.register_peer(p2)
+        p2.register_peer(p1)
+        deadline = time.time() + 5
+        while ((not p1.peer_proxies.get() or not p2.peer_proxies.get()) and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(p1._peer_ids.get(), ['n2'])
+        self.assertEqual(p2._peer_ids.get(), ['n1'])
+
+        # A share round with a peer on another loop is resumed on the node's own loop
+        p1.mine_block()
+        while p2.chain.get().length < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(p2.chain.get(), p1.chain.get())
+        self.assertEqual(p1.share_chain().get().get(timeout=5), ACCEPTED)
+
+    def test_share_chain_on_loop(self):
+        p1 = self.start('n1')
+        p1.register_peer(self.start('n2')).get()
+        outcomes = []
+        done = threading.Event()
+
+        def settled(outcome):
+            outcomes.append(outcome.get())
+            done.set()
+
+        def share():
+            # The loop thread waits for the outcome with a callback, not by blocking
+            p1.share_chain().add_callback(lambda f: f.get().add_callback(settled))
+
+        self.loop.call_soon_threadsafe(share)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(outcomes, [ACCEPTED])
+
+    def test_many_nodes_one_thread(self):
+        threads = threading.active_count()
+        proxies = [self.start('n%d' % i) for i in xrange(300)]
+        for p, q in zip(proxies, proxies[1:] + proxies[:1]):
+            p.register_peer(q)
+            q.register_peer(p)
+        proxies[0].register_transaction(make_transactions(1)[0])
+        deadline = time.time() + 10
+        while (not all(len(p.pending_transactions.get()) for p in proxies) and
+               time.time() < deadline):
+            time.sleep(0.05)
+        self.assertTrue(all(len(p.pending_transactions.get()) for p in proxies))
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_mailbox_backpressure(self):
+        node = self.start('small', SmallMailboxNode)
+        node_ref = self.refs[-1]
+        transactions = make_transactions(4)
+
+        # From the loop, messages beyond the mailbox's room are dropped
+        flooded = threading.Event()
+
+        def flood():
+            for t in transactions:
+                node_ref.proxy().register_transaction(t)
+            flooded.set()
+        self.loop.call_soon_threadsafe(flood)
+        flooded.wait(5)
+        self.assertEqual(node.metrics().get()['mailbox_dropped_total'], 2)
+        self.assertEqual(set(node.pending_transactions.get()),
+                         set(t.hash for t in transactions[:2]))
+
+        # From other threads, senders wait for room
+        blocked = threading.Event()
+        self.loop.call_soon_threadsafe(lambda: blocked.wait(5))
+        started = time.time()
+        threading.Timer(0.2, blocked.set).start()
+        for t in transactions[2:]:
+            node.register_transaction(t)
+        # The mailbox is full now
+        node.flush_gossip()
+        self.assertGreater(time.time() - started, 0.15)
+        self.assertEqual(set(node.pending_transactions.get()),
+                         set(t.hash for t in transactions))
+        self.assertEqual(node.metrics().get()['mailbox_dropped_total'], 2)
+
+    def test_tell_without_room(self):
+        node = self.start('small', SmallMailboxNode)
+        node_object = self.refs[-1]._node
+        transactions = make_transactions(3)
+        blocked = threading.Event()
+        self.loop.call_soon_threadsafe(lambda: blocked.wait(5))
+        for t in transactions[:2]:
+            node.register_transaction(t)
+        # The mailbox is full, but a tell, such as the verifier's, does not wait
+        started = time.time()
+        node_object._tell('register_transactions', transactions[2:])
+        self.assertLess(time.time() - started, 0.1)
+        blocked.set()
+        node.flush_gossip().get()
+        self.assertEqual(set(node.pending_transactions.get()),
+                         set(t.hash for t in transactions))
+
+    def test_stop(self):
+        node = self.start('n')
+        ref = self.refs.pop()
+        ref.stop()
+        self.assertFalse(ref.is_alive())
+        future = node.register_transaction(make_transactions(1)[0])
+        self.assertRaises(Exception, future.get, 1)
+
+
+class TestStartNode(unittest.TestCase):
+
+    def test_runtimes(self):
+        backend = MockFileBackend({})
+        threaded = start_node('t', runtime=RUNTIME_THREADS, backend=backend)
+        loop = EventLoop()
+        loop.start()
+        looped = start_node('l', runtime=RUNTIME_LOOP, loop=loop, backend=backend)
+        try:
+            for ref in (threaded, looped):
+                self.assertEqual(ref.proxy().chain.get().length, 0)
+        finally:
+            threaded.stop()
+            looped.stop()
+            loop.stop()
+        self.assertRaises(ValueError, start_node, 'x', runtime='greenlets')
+
+
+if __name__ == '__main__':
+    unittest.main()
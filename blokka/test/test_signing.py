@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+from binascii import hexlify, unhexlify
+
+from blokka import signing
+
+
+class TestSigning(unittest.TestCase):
+
+    def test_rfc_8032_vector(self):
+        secret = unhexlify(
+            '9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60')
+        public = signing.public_key(secret)
+        self.assertEqual(
+            hexlify(public),
+            'd75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a')
+        signature = signing.sign(secret, b'')
+        self.assertEqual(
+            hexlify(signature),
+            'e5564300c360ac729086e2cc806e828a84877f1eb8e5d974d873e065224901555fb8821590a3'
+            '3bacc61e39701cf9b46bd25bf5f0595bbe24655141438e7a100b')
+        self.assertTrue(signing.verify(public, b'', signature))
+
+    def test_verify(self):
+        secret = signing.generate_secret()
+        public = signing.public_key(secret)
+        signature = signing.sign(secret, b'message')
+        self.assertTrue(signing.verify(public, b'message', signature))
+        self.assertFalse(signing.verify(public, b'massage', signature))
+        self.assertFalse(signing.verify(public, b'message', signature[:-1]))
+        other = signing.public_key(signing.generate_secret())
+        self.assertFalse(signing.verify(other, b'message', signature))
+        self.assertRaises(ValueError, signing.public_key, secret[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
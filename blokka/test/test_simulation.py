@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import unittest
+
+from blokka.simulation import Scheduler, Simulation, _Link
+
+
+class TestSimulation(unittest.TestCase):
+
+    def test_scheduler(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_at(2.0, calls.append, 'c')
+        scheduler.call_at(1.0, calls.append, 'a')
+        scheduler.call_at(1.0, calls.append, 'b')
+        scheduler.call_at(1.5, calls.append, 'cancelled').cancel()
+        scheduler.call_at(5.0, calls.append, 'later')
+        scheduler.run(until=3.0)
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        self.assertEqual(scheduler.now, 3.0)
+        scheduler.run()
+        self.assertEqual(calls, ['a', 'b', 'c', 'later'])
+
+    def test_link(self):
+        link = _Link(latency=0.1, bandwidth=1000)
+        self.assertAlmostEqual(link.arrival(0.0, 500), 0.6)
+        # Queued behind the first message
+        self.assertAlmostEqual(link.arrival(0.0, 500), 1.1)
+        self.assertAlmostEqual(link.arrival(5.0, 100), 5.2)
+
+    def test_transactions_reach_every_node(self):
+        simulation = Simulation(nodes=5, peers=4, seed=2)
+        report = simulation.run(3.0, transaction_rate=1.0, settle=2.0)
+        self.assertGreater(report['transactions_submitted'], 0)
+        self.assertEqual(report['transaction_propagation']['count'],
+                         4 * report['transactions_submitted'])
+        self.assertLess(report['transaction_propagation']['max'], 1.0)
+        for node in simulation.nodes[1:]:
+            self.assertEqual(set(node.pending_transactions),
+                             set(simulation.nodes[0].pending_transactions))
+
+    def test_lossy_network(self):
+        simulation = Simulation(nodes=5, peers=4, seed=1, loss=1.0)
+        report = simulation.run(2.0, transaction_rate=5.0, settle=10.0)
+        self.assertEqual(report['messages_lost'], report['messages_sent'])
+        self.assertEqual(report['transaction_propagation']['count'], 0)
+        self.assertEqual(report['block_propagation']['count'], 0)
+        # Sharing chains times out on simulated time rather than hanging
+        unanswered = sum(node.metrics()['share_chain_unanswered_total']
+                         for node in simulation.nodes)
+        self.assertEqual(unanswered, 4 * report['blocks_mined'])
+
+    def test_nodes_converge(self):
+        # Nodes are connected to a few others only, so blocks reach most of them by
+        # being relayed
+        simulation = Simulation(nodes=12, peers=2, seed=3, difficulty=6, hash_rate=5.0)
+        report = simulation.run(30.0, transaction_rate=5.0)
+        self.assertGreater(report['chain_length'], 1)
+        self.assertGreater(report['consensus'], 0.5)
+        self.assertLess(report['fork_rate'], 0.3)
+        self.assertGreater(report['transactions_confirmed'], 0)
+        # Nodes mine on while the network settles, so only a block mined as the run
+        # ended may not have reached every node yet
+        reference = simulation.reference_chain()
+        for node in simulation.nodes:
+            self.assertGreaterEqual(node.chain.common_length(reference.locator()),
+                                    reference.length - 1)
+        self.assertGreaterEqual(report['block_full_propagation']['count'],
+                                report['chain_length'] - 1)
+
+    def test_deterministic(self):
+        def run(seed):
+            simulation = Simulation(nodes=12, peers=3, seed=seed, difficulty=6,
+                                    hash_rate=20.0, gossip_window=0.2)
+            return simulation.run(20.0, transaction_rate=5.0)
+
+        report = run(7)
+        self.assertGreater(report['blocks_mined'], 1)
+        self.assertGreater(report['chain_length'], 0)
+        self.assertGreater(report['block_propagation']['count'], 0)
+        self.assertEqual(run(7), report)
+        self.assertNotEqual(run(8), report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import io
+import json
+import unittest
+
+from blokka.streams import ChainFile, iter_block_dicts, iter_blocks, write_chain
+from blokka.test.test_backends import make_chain
+
+
+class TestStreams(unittest.TestCase):
+
+    def test_write_read(self):
+        chain = make_chain(50)
+        f = io.BytesIO()
+        offsets = write_chain(f, chain.blocks)
+        self.assertEqual(json.loads(f.getvalue()), chain.to_dict())
+        f.seek(0)
+        # Chunks smaller than a block still work
+        self.assertEqual(list(iter_blocks(f, chunk_size=16)), chain.blocks)
+        f.seek(0)
+        self.assertEqual([o for o, _ in iter_block_dicts(f, chunk_size=100)],
+                         list(offsets))
+
+    def test_reads_json_dump(self):
+        chain = make_chain(3)
+        for text in (json.dumps(chain.to_dict()), json.dumps(chain.to_dict(), indent=2),
+                     '{"blocks": []}'):
+            blocks = list(iter_blocks(io.BytesIO(text), chunk_size=32))
+            self.assertEqual(blocks, chain.blocks if 'hash' in text else [])
+
+    def test_bad_files(self):
+        chain = make_chain(3)
+        text = json.dumps(chain.to_dict())
+        self.assertRaises(ValueError, list, iter_blocks(io.BytesIO(text[:-10])))
+        self.assertRaises(ValueError, list, iter_blocks(io.BytesIO('{"other": 1}')))
+
+    def test_chain_file(self):
+        chain = make_chain(20)
+        f = io.BytesIO()
+        write_chain(f, chain.blocks)
+        chain_file = ChainFile(f)
+        self.assertEqual(chain_file.length, 20)
+        self.assertEqual(chain_file.block_at(7), chain.blocks[7])
+        self.assertEqual(chain_file.block_at(19), chain.blocks[19])
+        self.assertEqual(json.loads(chain_file.encoded_at(19)), chain.blocks[19].to_dict())
+        self.assertEqual(chain_file.hash_at(19), chain.latest_hash())
+        self.assertEqual(chain_file.height_of(chain.blocks[3].hash), 3)
+        self.assertIsNone(chain_file.height_of('nope'))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import pytz
+from pykka import ActorDeadError
+
+from blokka.actors import ACCEPTED, Node
+from blokka.backends import FileBackend, MappedBlocks
+from blokka.entities import Block, Chain, Transaction
+from blokka.test import MockFileBackend
+from blokka.transport import (ConnectionPool, NodeServer, RemoteError, RemotePeer,
+                              connect_peer, decode_request, decode_response,
+                              encode_request, encode_response, serve_node)
+
+
+def make_transactions(count):
+    return [Transaction(seller_id='s', buyer_id='b',
+                        timestamp=datetime(2017, 11, 1, tzinfo=pytz.UTC), amount=i)
+            for i in xrange(count)]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class TestMessages(unittest.TestCase):
+
+    def test_round_trip(self):
+        transactions = make_transactions(2)
+        block = Block(timestamp=datetime(2017, 1, 2), prev_hash=None,
+                      data={t.hash: t.to_dict() for t in transactions})
+        chain = Chain(blocks=[block])
+        pool = ConnectionPool()
+        args = [transactions, [block], chain, [(0, block.hash)], RemotePeer('/tmp/x'),
+                None, 1.5]
+        payload = encode_request(7, 'receive_blocks', args, {'sender_id': 'n1'})
+        request_id, name, decoded, kwargs = decode_request(payload, pool)
+        self.assertEqual((request_id, name, kwargs), (7, 'receive_blocks',
+                                                      {'sender_id': 'n1'}))
+        self.assertEqual(decoded[:3], [transactions, [block], chain])
+        self.assertEqual(decoded[3], [[0, block.hash]])
+        self.assertEqual(decoded[4].address, '/tmp/x')
+        self.assertEqual(decoded[5:], [None, 1.5])
+        self.assertEqual(decode_request(encode_request(8, 'chain', None, None), pool),
+                         (8, 'chain', None, None))
+
+        self.assertEqual(decode_response(encode_response(3, ACCEPTED), pool),
+                         (3, ACCEPTED, None))
+        _, _, error = decode_response(encode_response(4, error=KeyError('x')), pool)
+        self.assertIsInstance(error, RemoteError)
+        _, _, error = decode_response(encode_response(5, error=ActorDeadError('x')),
+                                      pool)
+        self.assertIsInstance(error, ActorDeadError)
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.refs = []
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        for ref in self.refs:
+            ref.stop()
+        shutil.rmtree(self.directory)
+
+    def serve(self, node_id, address, **kwargs):
+        ref = Node.start(node_id=node_id, backend=MockFileBackend({}), **kwargs)
+        self.refs.append(ref)
+        server = NodeServer(ref, address)
+        self.servers.append(server)
+        return ref.proxy(), server.address
+
+    def test_nodes_over_sockets(self):
+        # One over TCP, one over a Unix socket
+        p1, address1 = self.serve('n1', '127.0.0.1:0')
+        p2, address2 = self.serve('n2', os.path.join(self.directory, 'n2.sock'))
+        connect_peer(p1, address2)
+        connect_peer(p2, address1)
+        self.assertEqual(RemotePeer(address1).node_id.get(timeout=5), 'n1')
+
+        transactions = make_transactions(Node.BLOCK_SIZE)
+        p1.register_transaction(transactions[0])
+        wait_for(lambda: len(p2.pending_transactions.get()) == 1)
+        self.assertEqual(dict(p2.pending_transactions.get()),
+                         {transactions[0].hash: transactions[0]})
+
+        p1.mine_block().get()
+        wait_for(lambda: p2.chain.get().length == 1)
+        self.assertEqual(p2.chain.get(), p1.chain.get())
+        self.assertEqual(RemotePeer(address2).chain.get(timeout=5), p1.chain.get())
+        self.assertEqual(p2.share_chain().get().get(timeout=5), ACCEPTED)
+
+    def test_share_lazy_chain(self):
+        # A chain loaded lazily from a file is shared as a list of its blocks
+        transactions = make_transactions(2)
+        blocks = [Block(timestamp=datetime(2017, 1, 2), prev_hash=None,
+                        data={t.hash: t.to_dict() for t in transactions})]
+        blocks.append(Block(timestamp=datetime(2017, 1, 3), prev_hash=blocks[0].hash,
+                            data='x'))
+        backend = FileBackend()
+        path = os.path.join(FileBackend.FILE_DIR, 'lazy.json')
+        self.addCleanup(os.remove, path)
+        backend.save_chain(Chain(blocks=blocks), 'lazy')
+        ref = Node.start(node_id='lazy', backend=FileBackend(lazy=True))
+        self.refs.append(ref)
+        p1 = ref.proxy()
+        self.assertIsInstance(p1.chain.get().blocks, MappedBlocks)
+
+        _, address = self.serve('n2', os.path.join(self.directory, 'n2.sock'))
+        peer = RemotePeer(address)
+        p1.register_peer(peer).get()
+        self.assertEqual(p1.share_chain().get().get(timeout=5), ACCEPTED)
+        self.assertEqual(peer.chain.get(timeout=5).blocks, blocks)
+
+    def test_pipelining(self):
+        _, address = self.serve('n1', '127.0.0.1:0')
+        pool = ConnectionPool(size=1)
+        peer = RemotePeer(address, pool)
+        futures = [peer.find_common_length([]) for _ in xrange(200)]
+        self.assertEqual([f.get(timeout=5) for f in futures], [0] * 200)
+        self.assertEqual(len(pool._connections[address]), 1)
+        self.assertRaises(AttributeError, getattr, peer, 'flush')
+        pool.close()
+
+    def test_unreachable(self):
+        peer = RemotePeer(os.path.join(self.directory, 'nobody.sock'))
+        self.assertRaises(ActorDeadError, peer.node_id.get, 5)
+
+    def test_separate_process(self):
+        address = os.path.join(self.directory, 'remote.sock')
+        process = multiprocessing.Process(
+            target=serve_node, args=('remote', address),
+            kwargs={'backend': MockFileBackend({})})
+        process.start()
+        try:
+            peer = RemotePeer(address)
+            wait_for(lambda: os.path.exists(address))
+            self.assertEqual(peer.node_id.get(timeout=5), 'remote')
+            for t in make_transactions(Node.BLOCK_SIZE):
+                peer.register_transaction(t)
+            wait_for(lambda: peer.chain.get(timeout=5).length == 1)
+            self.assertEqual(peer.chain.get(timeout=5).length, 1)
+        finally:
+            process.terminate()
+            process.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+import threading
+import unittest
+from datetime import datetime
+
+from blokka import signing
+from blokka.entities import Transaction
+from blokka.verification import VerifiedCache, Verifier, shared_verifier
+
+
+def signed_transactions(count, secret):
+    buyer_id = signing.account_id(signing.public_key(secret))
+    return [Transaction(seller_id='s', buyer_id=buyer_id,
+                        timestamp=datetime(2017, 11, 1), amount=i).signed(secret)
+            for i in xrange(count)]
+
+
+class UncheckableTransaction(Transaction):
+
+    __slots__ = ()
+
+    def has_valid_signature(self):
+        raise ValueError('malformed key')
+
+
+class TestVerifiedCache(unittest.TestCase):
+
+    def test_least_recently_used_go(self):
+        cache = VerifiedCache(2)
+        cache.add('a')
+        cache.add('b')
+        self.assertIn('a', cache)
+        cache.add('c')
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(len(cache), 2)
+
+
+class TestVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = Verifier(processes=2)
+        transactions = signed_transactions(Verifier.BATCH_SIZE + 3,
+                                           signing.generate_secret())
+        # Signed by someone else
+        forged = Transaction(seller_id='s', buyer_id=transactions[0].buyer_id,
+                             timestamp=datetime(2017, 11, 1), amount=-1).signed(
+                                 signing.generate_secret())
+        self.transactions = transactions + [forged]
+        self.expected = [True] * len(transactions) + [False]
+
+    def tearDown(self):
+        self.verifier.close()
+
+    def test_verify(self):
+        self.assertEqual(self.verifier.verify(self.transactions), self.expected)
+        self.assertEqual(self.verifier.verify([]), [])
+
+    def test_verify_async(self):
+        results = []
+        done = threading.Event()
+
+        def callback(value):
+            results.append(value)
+            done.set()
+        self.verifier.verify_async(self.transactions, callback)
+        self.assertTrue(done.wait(10))
+        self.assertEqual(results, [self.expected])
+
+    def test_errors_answered(self):
+        # A signature that cannot be checked is invalid, and its batch still answered
+        broken = UncheckableTransaction(seller_id='s', buyer_id='b',
+                                        timestamp=datetime(2017, 11, 1), amount=1,
+                                        signature='ab')
+        results = []
+        done = threading.Event()
+
+        def callback(value):
+            results.append(value)
+            done.set()
+        self.verifier.verify_async(self.transactions + [broken], callback)
+        self.assertTrue(done.wait(10))
+        self.assertEqual(results, [self.expected + [False]])
+
+    def test_shared(self):
+        self.assertIs(shared_verifier(), shared_verifier())
+        self.assertEqual(shared_verifier().verify(self.transactions[-2:]),
+                         self.expected[-2:])
+
+
+if __name__ == '__main__':
+    unittest.main()
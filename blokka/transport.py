@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Nodes talking over sockets, so each can run in a process of its own.
+
+A NodeServer listens on a localhost TCP port or a Unix socket and answers calls to the
+node behind it. A RemotePeer stands in for the pykka proxy of a served node: pass it to
+register_peer, and the node's calls to that peer go over the socket instead of through
+pykka, with the same methods and futures. Peers passed as arguments, as in
+announce_transactions, travel as the address they are served at.
+
+Calls are framed: a 4-byte length, then a request (id, method, arguments) or a response
+(id, value or error). Entities travel in their canonical binary encoding (see
+blokka.codec), other values in codec's value encoding. Connections are kept open and
+pooled per address, and requests are pipelined: a caller sends as many as it likes
+without waiting, and each response is matched to its request by id. A node handles
+calls in order, so the server answers each connection's requests in order.
+
+Addresses are 'host:port' for TCP, or a filesystem path for a Unix socket. A
+RemotePeer's futures are pykka ThreadingFutures, so the nodes calling it run on the
+threads runtime (see blokka.runtime).
+
+Run a node in a process of its own with
+
+    python -m blokka.transport --node-id ID --listen ADDRESS [--peer ADDRESS ...]
+"""
+import argparse
+import itertools
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from Queue import Queue
+from collections import Sequence
+
+from pykka import ActorDeadError, ThreadingFuture, Timeout
+from pykka.proxy import ActorProxy
+
+from blokka import codec
+from blokka.actors import Node
+from blokka.entities import Block, Chain, Transaction
+from blokka.runtime import CallbackFuture, LoopProxy
+
+# What a RemotePeer exposes of a node: Node's methods that peers call, and attributes
+REMOTE_METHODS = frozenset([
+    'register_transaction', 'register_transactions', 'announce_transactions',
+    'request_transactions', 'find_common_length', 'receive_blocks', 'receive_chain',
+    'metrics',
+])
+REMOTE_ATTRIBUTES = frozenset(['node_id', 'chain'])
+
+# Seconds the server waits for the node to answer a call
+CALL_TIMEOUT = 30.0
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+FRAME_HEADER = struct.Struct('>I')
+
+_REQUEST = b'Q'
+_RESPONSE = b'R'
+_OK = b'\x00'
+_ERROR = b'\x01'
+_NO_ARGS = b'\xff'
+
+_VALUE = b'v'
+_TRANSACTION = b't'
+_BLOCK = b'b'
+_CHAIN = b'c'
+_PEER = b'p'
+_LIST = b'l'
+_DICT = b'd'
+
+logger = logging.getLogger(__name__)
+
+# Actor URN of each node served in this process -> address it is served at
+_served = {}
+
+
+class RemoteError(Exception):
+    """
+    A call to a remote node raised an error there
+    """
+
+
+def parse_address(address):
+    """
+    :param address: 'host:port', or a path for a Unix socket
+    :type address: str
+    :return: socket family and address
+    :rtype: (int, str | (str, int))
+    """
+    if '/' not in address and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def _encode(value, out):
+    if isinstance(value, Transaction):
+        out.append(_TRANSACTION + codec.encode_sized([value.to_bytes()]))
+    elif isinstance(value, Block):
+        out.append(_BLOCK + codec.encode_sized([value.to_bytes()]))
+    elif isinstance(value, Chain):
+        out.append(_CHAIN + codec.encode_sized([value.to_bytes()]))
+    elif isinstance(value, (ActorProxy, LoopProxy, RemotePeer)):
+        out.append(_PEER + codec.encode_sized([_peer_address(value)]))
+    elif isinstance(value, Sequence) and not isinstance(value, basestring):
+        # Lists, tuples, and lazy sequences of blocks such as MappedBlocks
+        out.append(_LIST + codec.UINT32.pack(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(_DICT + codec.UINT32.pack(len(value)))
+        for key in sorted(value):
+            _encode(key, out)
+            _encode(value[key], out)
+    else:
+        out.append(_VALUE)
+        codec.encode_value(value, out)
+
+
+def _decode(data, offset, pool):
+    tag = data[offset]
+    offset += 1
+    if tag == _VALUE:
+        return codec.decode_value(data, offset)
+    if tag == _LIST:
+        count = codec.UINT32.unpack_from(data, offset)[0]
+        offset += codec.UINT32.size
+        items = []
+        for _ in xrange(count):
+            item, offset = _decode(data, offset, pool)
+            items.append(item)
+        return items, offset
+    if tag == _DICT:
+        count = codec.UINT32.unpack_from(data, offset)[0]
+        offset += codec.UINT32.size
+        dct = {}
+        for _ in xrange(count):
+            key, offset = _decode(data, offset, pool)
+            dct[key], offset = _decode(data, offset, pool)
+        return dct, offset
+    # The rest hold one sized item
+    length = codec.UINT32.unpack_from(data, offset + codec.UINT32.size)[0]
+    start = offset + 2 * codec.UINT32.size
+    item = data[start:start + length]
+    offset = start + length
+    if tag == _TRANSACTION:
+        return Transaction.from_bytes(item), offset
+    if tag == _BLOCK:
+        return Block.from_bytes(item), offset
+    if tag == _CHAIN:
+        return Chain.from_bytes(item), offset
+    if tag == _PEER:
+        return RemotePeer(item, pool), offset
+    raise ValueError('Unknown message tag {!r} at offset {}'.format(tag, offset - 1))
+
+
+def _peer_address(proxy):
+    if isinstance(proxy, RemotePeer):
+        return proxy.address
+    if isinstance(proxy, ActorProxy):
+        urn = proxy.actor_ref.actor_urn
+    else:
+        urn = proxy._node.actor_urn
+    if urn not in _served:
+        raise ValueError('Cannot pass a peer that no NodeServer serves')
+    return _served[urn]
+
+
+def encode_request(request_id, name, args, kwargs):
+    """
+    :param args: None to read the attribute `name`
+    :rtype: bytes
+    """
+    out = [_REQUEST, codec.UINT64.pack(request_id)]
+    codec.encode_value(name, out)
+    if args is None:
+        out.append(_NO_ARGS)
+    else:
+        _encode(list(args), out)
+        _encode(kwargs, out)
+    return b''.join(out)
+
+
+def decode_request(data, pool):
+    """
+    :return: request id, name, and args and kwargs (None for an attribute)
+    :rtype: (int, str, list, dict)
+    """
+    if data[:1] != _REQUEST:
+        raise ValueError('Not a request')
+    request_id = codec.UINT64.unpack_from(data, 1)[0]
+    name, offset = codec.decode_value(data, 1 + codec.UINT64.size)
+    if data[offset:offset + 1] == _NO_ARGS:
+        return request_id, str(name), None, None
+    args, offset = _decode(data, offset, pool)
+    kwargs, _ = _decode(data, offset, pool)
+    return request_id, str(name), args, {str(k): v for k, v in kwargs.iteritems()}
+
+
+def encode_response(request_id, value=None, error=None):
+    """
+    :type error: Exception
+    :rtype: bytes
+    """
+    out = [_RESPONSE, codec.UINT64.pack(request_id)]
+    if error is None:
+        out.append(_OK)
+        _encode(value, out)
+    else:
+        out.append(_ERROR)
+        codec.encode_value([type(error).__name__, unicode(error)], out)
+    return b''.join(out)
+
+
+def decode_response(data, pool):
+    """
+    :return: request id, value and error
+    :rtype: (int, object, Exception)
+    """
+    if data[:1] != _RESPONSE:
+        raise ValueError('Not a response')
+    request_id = codec.UINT64.unpack_from(data, 1)[0]
+    offset = 1 + codec.UINT64.size
+    if data[offset:offset + 1] == _OK:
+        return request_id, _decode(data, offset + 1, pool)[0], None
+    (kind, message), _ = codec.decode_value(data, offset + 1)
+    if kind == 'ActorDeadError':
+        return request_id, None, ActorDeadError(message)
+    if kind == 'Timeout':
+        return request_id, None, Timeout(message)
+    return request_id, None, RemoteError('{}: {}'.format(kind, message))
+
+
+def _write_frame(sock, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def _read_frame(f):
+    """
+    :type f: file
+    :return: the payload, or None at the end of the stream
+    :rtype: bytes
+    """
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    size = FRAME_HEADER.unpack(header)[0]
+    if size > MAX_FRAME_SIZE:
+        raise ValueError('Frame of {} bytes is too large'.format(size))
+    payload = f.read(size)
+    if len(payload) < size:
+        return None
+    return payload
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class NodeServer(object):
+    """
+    Answers calls to a node from RemotePeers
+    """
+
+    def __init__(self, node_ref, address, pool=None):
+        """
+        :param node_ref: the started node, as returned by Node.start or
+            blokka.runtime.start_node
+        :param address: to listen at; port 0 picks a free port
+        :type address: str
+        :param pool: for calls to peers passed in as arguments (default: see
+            default_pool)
+        :type pool: ConnectionPool
+        """
+        self.node_ref = node_ref
+        self.proxy = node_ref.proxy()
+        self.pool = pool or default_pool()
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.remove(sockaddr)
+        self._listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(sockaddr)
+        self._listener.listen(64)
+        if family == socket.AF_INET:
+            self.address = '{}:{}'.format(*self._listener.getsockname())
+        else:
+            self.address = sockaddr
+        self._urn = _node_urn(node_ref)
+        _served[self._urn] = self.address
+        self._connections = []
+        self._closed = False
+        _start_thread(self._accept)
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error:
+                return
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connections.append(sock)
+            answers = Queue()
+            _start_thread(self._read_requests, sock, answers)
+            _start_thread(self._write_responses, sock, answers)
+
+    def _read_requests(self, sock, answers):
+        f = sock.makefile('rb')
+        try:
+            while True:
+                payload = _read_frame(f)
+                if payload is None:
+                    break
+                request_id, name, args, kwargs = decode_request(payload, self.pool)
+                answers.put((request_id, self._call(name, args, kwargs)))
+        except (socket.error, ValueError) as e:
+            logger.warning('dropping connection to %s: %s', self.address, e)
+        finally:
+            answers.put(None)
+            f.close()
+
+    def _call(self, name, args, kwargs):
+        future = ThreadingFuture()
+        if args is None and name in REMOTE_ATTRIBUTES:
+            return getattr(self.proxy, name)
+        if args is not None and name in REMOTE_METHODS:
+            try:
+                return getattr(self.proxy, name)(*args, **kwargs)
+            except ActorDeadError as e:
+                future.set_exception(e)
+                return future
+        future.set_exception(ValueError('{} is not available remotely'.format(name)))
+        return future
+
+    def _write_responses(self, sock, answers):
+        # Answers are awaited in the order the calls were made, which is the order
+        # the node handles them in
+        try:
+            while True:
+                answer = answers.get()
+                if answer is None:
+                    break
+                request_id, future = answer
+                try:
+                    value = future.get(CALL_TIMEOUT)
+                    # A future for the answer (see Node.receive_blocks)
+                    while isinstance(value, (ThreadingFuture, CallbackFuture)):
+                        value = value.get(CALL_TIMEOUT)
+                    payload = encode_response(request_id, value)
+                except Exception as e:
+                    payload = encode_response(request_id, error=e)
+                _write_frame(sock, payload)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def close(self):
+        self._closed = True
+        _served.pop(self._urn, None)
+        self._listener.close()
+        for sock in self._connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if not isinstance(parse_address(self.address)[1], tuple):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+
+
+def _node_urn(node_ref):
+    return getattr(node_ref, 'actor_urn', None) or node_ref._node.actor_urn
+
+
+class _Connection(object):
+    """
+    One open connection, with the requests sent on it that await a response
+    """
+
+    def __init__(self, address, pool):
+        family, sockaddr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(sockaddr)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.address = address
+        self.pool = pool
+        self.pending = {}
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        _start_thread(self._read_responses)
+
+    def request(self, name, args, kwargs):
+        """
+        :rtype: pykka.ThreadingFuture
+        """
+        future = ThreadingFuture()
+        with self._lock:
+            if self.closed:
+                future.set_exception(ActorDeadError('Connection to {} is closed'
+                                                    .format(self.address)))
+                return future
+            request_id = next(self._ids)
+            try:
+                payload = encode_request(request_id, name, args, kwargs)
+            except ValueError as e:
+                future.set_exception(e)
+                return future
+            self.pending[request_id] = future
+            try:
+                _write_frame(self.sock, payload)
+            except socket.error as e:
+                self._close(e)
+        return future
+
+    def _read_responses(self):
+        f = self.sock.makefile('rb')
+        reason = 'closed by peer'
+        try:
+            while True:
+                payload = _read_frame(f)
+                if payload is None:
+                    break
+                request_id, value, error = decode_response(payload, self.pool)
+                with self._lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if error is None:
+                    future.set(value)
+                else:
+                    future.set_exception(error)
+        except (socket.error, ValueError) as e:
+            reason = e
+        finally:
+            f.close()
+            with self._lock:
+                self._close(reason)
+
+    def _close(self, reason):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        for future in self.pending.values():
+            future.set_exception(ActorDeadError('Connection to {} lost: {}'
+                                                .format(self.address, reason)))
+        self.pending.clear()
+
+    def close(self):
+        with self._lock:
+            self._close('closed')
+
+
+class ConnectionPool(object):
+    """
+    Open connections to each address, reused across calls
+    """
+
+    def __init__(self, size=2):
+        """
+        :param size: connections to open to each address at most; a new one is opened
+            only while every open one has requests in flight
+        :type size: int
+        """
+        self.size = size
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def request(self, address, name, args, kwargs):
+        """
+        :param args: None to read the attribute `name`
+        :return: the answer; fails with pykka.ActorDeadError if the node cannot be
+            reached
+        :rtype: pykka.ThreadingFuture
+        """
+        try:
+            connection = self._connection(address)
+        except socket.error as e:
+            future = ThreadingFuture()
+            future.set_exception(ActorDeadError('Cannot reach {}: {}'.format(address, e)))
+            return future
+        return connection.request(name, args, kwargs)
+
+    def _connection(self, address):
+        with self._lock:
+            connections = [c for c in self._connections.get(address, []) if not c.closed]
+            idle = [c for c in connections if not c.pending]
+            if idle:
+                connection = idle[0]
+            elif len(connections) < self.size:
+                connection = _Connection(address, self)
+                connections.append(connection)
+            else:
+                connection = min(connections, key=lambda c: len(c.pending))
+            self._connections[address] = connections
+            return connection
+
+    def close(self):
+        with self._lock:
+            for connections in self._connections.values():
+                for connection in connections:
+                    connection.close()
+            self._connections = {}
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """
+    :return: a pool shared by the process
+    :rtype: ConnectionPool
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+class RemotePeer(object):
+    """
+    Stands in for a pykka proxy to a node served by a NodeServer: calling a method, or
+    reading an attribute, returns a future for the answer
+    """
+
+    def __init__(self, address, pool=None):
+        """
+        :type address: str
+        :type pool: ConnectionPool
+        """
+        self.address = address
+        self._pool = pool or default_pool()
+
+    def __getattr__(self, name):
+        if name in REMOTE_ATTRIBUTES:
+            return self._pool.request(self.address, name, None, None)
+        if name not in REMOTE_METHODS:
+            raise AttributeError('{} is not available remotely'.format(name))
+
+        def call(*args, **kwargs):
+            return self._pool.request(self.address, name, args, kwargs)
+        return call
+
+
+def connect_peer(node_proxy, address, timeout=30.0):
+    """
+    Register a served node as a peer, waiting for it to come up
+    :param node_proxy: of the local node
+    :type address: str
+    :type timeout: float
+    :raise pykka.ActorDeadError: if it cannot be reached within `timeout` seconds
+    """
+    deadline = time.time() + timeout
+    peer = RemotePeer(address)
+    while True:
+        try:
+            peer.node_id.get(timeout=max(deadline - time.time(), 0.1))
+            break
+        except (ActorDeadError, Timeout):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    node_proxy.register_peer(peer).get()
+
+
+def serve_node(node_id, address, peers=(), **kwargs):
+    """
+    Run a node and serve it at `address` until the process is terminated; for the
+    entry point of a process
+    :type node_id: str
+    :type address: str
+    :param peers: addresses of served nodes to register as peers
+    :type peers: list[str]
+    :param kwargs: as for Node
+    """
+    node_ref = Node.start(node_id=node_id, **kwargs)
+    server = NodeServer(node_ref, address)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    try:
+        for peer in peers:
+            connect_peer(node_ref.proxy(), peer)
+        while not stopped.is_set():
+            stopped.wait(1)
+    finally:
+        server.close()
+        node_ref.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a blokka node in this process')
+    parser.add_argument('--node-id', required=True)
+    parser.add_argument('--listen', required=True,
+                        help='host:port, or a path for a Unix socket')
+    parser.add_argument('--peer', action='append', default=[],
+                        help='address of a peer node (repeatable)')
+    parser.add_argument('--difficulty', type=int)
+    args = parser.parse_args(argv)
+    serve_node(args.node_id, args.listen, args.peer, difficulty=args.difficulty)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Author(s): 'Percy Link' <percylink@gmail.com>
+"""
+Checking transaction signatures off the actors' threads.
+
+A Verifier splits the transactions it is given into batches and checks them on a
+multiprocessing pool, so a node's thread only hands work out and takes results back.
+A VerifiedCache remembers the hashes of transactions whose signatures checked out: the
+same transaction gossiped by many peers, or confirmed in a block later, is checked once.
+
+Nodes share one Verifier per process (see shared_verifier), so running many nodes in a
+process does not start a pool for each.
+"""
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+
+
+def _verify_batch(transactions):
+    """
+    :type transactions: list[blokka.entities.Transaction]
+    :return: whether each transaction's signature is valid
+    :rtype: list[bool]
+    """
+    return [_is_valid(t) for t in transactions]
+
+
+def _is_valid(transaction):
+    # Python 2's apply_async has no error callback, so a batch that raised would never
+    # be answered: a signature that cannot be checked is taken as invalid
+    try:
+        return transaction.has_valid_signature()
+    except Exception:
+        return False
+
+
+class VerifiedCache(object):
+    """
+    The hashes of the last `capacity` transactions verified or looked up
+    """
+
+    def __init__(self, capacity):
+        """
+        :type capacity: int
+        """
+        self.capacity = capacity
+        self._hashes = OrderedDict()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, tx_hash):
+        try:
+            self._hashes[tx_hash] = self._hashes.pop(tx_hash)
+        except KeyError:
+            return False
+        return True
+
+    def add(self, tx_hash):
+        """
+        :type tx_hash: str
+        """
+        self._hashes.pop(tx_hash, None)
+        self._hashes[tx_hash] = None
+        if len(self._hashes) > self.capacity:
+            self._hashes.popitem(last=False)
+
+
+class VerificationJob(object):
+    """
+    Batches being verified in the background
+    """
+
+    def __init__(self, transactions, batches, callback):
+        self.transactions = transactions
+        self._results = [None] * batches
+        self._remaining = batches
+        self._callback = callback
+
+    def _batch_done(self, index, results):
+        # Called on the pool's result thread, one batch at a time
+        self._results[index] = results
+        self._remaining -= 1
+        if self._remaining == 0:
+            self._callback([ok for results in self._results for ok in results])
+
+
+class Verifier(object):
+
+    BATCH_SIZE = 32
+
+    def __init__(self, processes=None):
+        """
+        :param processes: size of the worker pool (default: one per CPU)
+        :type processes: int
+        """
+        self.processes = processes
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # Started on first use, and again in a forked child, which cannot use its
+        # parent's workers
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.processes)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _batches(self, transactions):
+        return [transactions[i:i + self.BATCH_SIZE]
+                for i in xrange(0, len(transactions), self.BATCH_SIZE)]
+
+    def verify_async(self, transactions, callback):
+        """
+        :type transactions: list[blokka.entities.Transaction]
+        :param callback: called from another thread with whether each transaction's
+            signature is valid, in order. The pool has one such thread for all of its
+            callers, so the callback must not block.
+        :type callback: (list[bool]) -> None
+        :rtype: VerificationJob
+        """
+        batches = self._batches(transactions)
+        job = VerificationJob(transactions, len(batches), callback)
+        if not batches:
+            callback([])
+            return job
+        pool = self._get_pool()
+        for i, batch in enumerate(batches):
+            pool.apply_async(_verify_batch, (batch,),
+                             callback=lambda results, i=i: job._batch_done(i, results))
+        return job
+
+    def verify(self, transactions):
+        """
+        Verify on the pool and wait for the results
+        :type transactions: list[blokka.entities.Transaction]
+        :return: whether each transaction's signature is valid, in order
+        :rtype: list[bool]
+        """
+        pool = self._get_pool()
+        pending = [pool.apply_async(_verify_batch, (batch,))
+                   for batch in self._batches(transactions)]
+        return [ok for result in pending for ok in result.get()]
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_verifier():
+    """
+    :return: a verifier shared by the process, with one worker per CPU, started on
+        first use
+    :rtype: Verifier
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Verifier()
+        return _shared